@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark of the HTTP backends. Sends requests to a local server in another process, so it doesn't need an
+Exchange server. Measures the CPU time this process spends per request.
+
+    python bench_http.py
+"""
+import multiprocessing
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from exchangelib.credentials import Credentials
+from exchangelib.protocol import BaseProtocol
+from exchangelib.sessions import HTTP_BACKENDS, set_http_backend
+from exchangelib.transport import BASIC
+from exchangelib.util import post_ratelimited
+
+RESPONSE = b'<?xml version="1.0" encoding="utf-8"?><s:Envelope>%s</s:Envelope>' % (b'x' * 4000)
+REQUEST = b'<?xml version="1.0" encoding="utf-8"?><s:Envelope>%s</s:Envelope>' % (b'x' * 1000)
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    wbufsize = -1  # Send the response in one piece, so we don't wait for delayed ACKs
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml; charset=utf-8')
+        self.send_header('Content-Length', str(len(RESPONSE)))
+        self.end_headers()
+        self.wfile.write(RESPONSE)
+
+
+def serve(port):
+    HTTPServer(('127.0.0.1', port), Handler).serve_forever()
+
+
+def bench_backends(port, number=1000):
+    # Like the services do, POST through post_ratelimited() on a session of a protocol, with basic auth
+    print('%-25s %12s %12s' % ('Sending requests:', 'usec CPU', 'usec wall'))
+    for backend in HTTP_BACKENDS:
+        set_http_backend(backend)
+        protocol = BaseProtocol(service_endpoint='http://127.0.0.1:%s/EWS/Exchange.asmx' % port,
+                                credentials=Credentials('DOMAIN\\user', 'secret'), auth_type=BASIC, verify_ssl=True)
+        session = protocol.create_session()
+        best_cpu, best_wall = None, None
+        for _ in range(5):
+            cpu, wall = time.process_time(), time.time()
+            for _ in range(number):
+                r, session = post_ratelimited(protocol=protocol, session=session, url=protocol.service_endpoint,
+                                              headers=None, data=REQUEST, timeout=10)
+                assert len(r.content) == len(RESPONSE)
+            cpu, wall = time.process_time() - cpu, time.time() - wall
+            best_cpu = cpu if best_cpu is None else min(best_cpu, cpu)
+            best_wall = wall if best_wall is None else min(best_wall, wall)
+        session.close_socket(protocol.service_endpoint)
+        print('%-25s %12.1f %12.1f' % (backend, best_cpu / number * 1000000, best_wall / number * 1000000))
+
+
+if __name__ == '__main__':
+    port = 18080
+    server = multiprocessing.Process(target=serve, args=(port,), daemon=True)
+    server.start()
+    time.sleep(0.5)
+    try:
+        bench_backends(port)
+    finally:
+        server.terminate()
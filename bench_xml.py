@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmarks for building and serializing XML requests. Doesn't need an Exchange server.
+
+    python bench_xml.py
+"""
+from copy import copy, deepcopy
+import timeit
+from xml.etree.ElementTree import Element, fromstring
+
+from exchangelib.ewsdatetime import EWSDateTime, EWSTimeZone
+from exchangelib.folders import ItemId, CalendarItem, Message, Mailbox, Attendee, Body
+from exchangelib.services import TNS, MNS, write_item_ids
+from exchangelib.transport import SOAPNS
+from exchangelib.util import LRUCache, XMLWriter, ElementStream, XML_BACKENDS, create_element, add_xml_child, \
+    set_xml_value, xml_to_str, to_xml, get_xml_backend, set_xml_backend
+from exchangelib.version import Build, Version
+
+# Element names and attributes as used by services.py. IndexedPageItemView gets a new Offset for every page.
+ELEMENTS = [
+    ('t:FieldURI', {'FieldURI': 'item:Subject'}),
+    ('t:ItemId', {'Id': 'AAMkADk5NTA2OWVjLWM1ZGMtNDliZC04YjA3LWFhZWJmOGUxMGU2NQBGAAAAAAA', 'ChangeKey': 'CQAAABYAAAA'}),
+    ('m:IndexedPageItemView', {'MaxEntriesReturned': '100', 'Offset': '12300', 'BasePoint': 'Beginning'}),
+    ('t:Subject', {}),
+]
+
+_deepcopy_cache = dict()
+
+
+def deepcopy_factory(name, **attrs):
+    # The create_element() of exchangelib 1.7.4, including the bug that stops the cache from ever getting a hit
+    key = (name, tuple(attrs.items()))
+    if name not in _deepcopy_cache:
+        _deepcopy_cache[key] = Element(name, **attrs)
+    return deepcopy(_deepcopy_cache[key])
+
+
+_templates = LRUCache(maxsize=1000)
+
+
+def template_factory(name, **attrs):
+    # A bounded cache of empty template Elements, keyed by name. Attributes are applied after copying.
+    template = _templates.get(name)
+    if template is None:
+        template = Element(name)
+        _templates[name] = template
+    elem = copy(template)
+    for k, v in attrs.items():
+        elem.set(k, v)
+    return elem
+
+
+def element_factory(name, **attrs):
+    return Element(name, **attrs)
+
+
+def bench(func, number):
+    # Best of 5 runs, in microseconds per call
+    return min(timeit.repeat(func, number=number, repeat=5)) / number * 1000000
+
+
+def bench_factories(number=100000):
+    print('Creating one element (usec):')
+    print('%-25s %10s %10s %10s %15s' % ('', 'deepcopy', 'template', 'Element()', 'create_element'))
+    for name, attrs in ELEMENTS:
+        print('%-25s %10.3f %10.3f %10.3f %15.3f' % (
+            name,
+            bench(lambda: deepcopy_factory(name, **attrs), number),
+            bench(lambda: template_factory(name, **attrs), number),
+            bench(lambda: element_factory(name, **attrs), number),
+            bench(lambda: create_element(name, **attrs), number),
+        ))
+
+
+def bench_payload(number=1000):
+    # A GetItem-like payload with 100 item IDs and 20 fields
+    def build():
+        payload = create_element('m:GetItem')
+        shape = create_element('m:ItemShape')
+        add_xml_child(shape, 't:BaseShape', 'IdOnly')
+        props = create_element('t:AdditionalProperties')
+        for i in range(20):
+            props.append(create_element('t:FieldURI', FieldURI='item:Field%s' % i))
+        shape.append(props)
+        payload.append(shape)
+        ids = create_element('m:ItemIds')
+        for i in range(100):
+            ids.append(create_element('t:ItemId', Id='AAMkADk5NTA2OWVj%s' % i, ChangeKey='CQAAABYAAAA'))
+        payload.append(ids)
+        return payload
+
+    print('Building a GetItem payload with 100 IDs (usec): %.1f' % bench(build, number))
+    payload = build()
+    print('Serializing it (usec): %.1f' % bench(lambda: xml_to_str(payload), number))
+
+
+def bench_item_ids(number=1000):
+    # The m:ItemIds element of GetItem, DeleteItem and ExportItems, with 100 IDs, as tree + tostring() vs. XMLWriter
+    ids = [('AAMkADk5NTA2OWVjLWM1ZGMtNDliZC04YjA3LWFhZWJmOGUxMGU2NQBGAAAAAAA%s' % i, 'CQAAABYAAAA') for i in range(100)]
+
+    version = Version(build=Build(15, 0, 1178, 4), api_version='Exchange2013_SP1')
+
+    def tree():
+        # What the services did before XMLWriter
+        item_ids = create_element('m:ItemIds')
+        for item in ids:
+            set_xml_value(item_ids, ItemId(*item), version)
+        return xml_to_str(item_ids).encode('utf-8')
+
+    def writer():
+        w = XMLWriter()
+        write_item_ids(w, ids)
+        return w.getvalue()
+
+    assert tree() == writer()
+    print('Serializing 100 item IDs (usec): tree %.1f, XMLWriter %.1f' % (bench(tree, number), bench(writer, number)))
+
+
+def bench_items(number=1000):
+    # Item.to_xml() as used by CreateItem
+    version = Version(build=Build(15, 0, 1178, 4), api_version='Exchange2013_SP1')
+    tz = EWSTimeZone.timezone('Europe/Copenhagen')
+    start = tz.localize(EWSDateTime(2017, 1, 2, 3, 4, 5))
+    mailbox = Mailbox(email_address='foo@example.com')
+    items = [
+        CalendarItem(subject='Meeting', body=Body('Agenda'), start=start, end=start, location='Room 1',
+                     categories=['foo', 'bar'], required_attendees=[Attendee(mailbox=mailbox, response_type='Accept')]),
+        Message(subject='Hello', body=Body('World'), to_recipients=[mailbox], is_read=True),
+    ]
+    for item in items:
+        print('Serializing a %s (usec): %.1f' % (
+            item.__class__.__name__, bench(lambda: item.to_xml(version=version), number)))
+
+
+MESSAGE = (
+    '<t:Message><t:ItemId Id="AAMkADk5NTA2OWVj%s" ChangeKey="CQAAABYAAAA"/><t:Subject>Hello</t:Subject>'
+    '<t:Sensitivity>Normal</t:Sensitivity><t:Body BodyType="Text">World</t:Body>'
+    '<t:DateTimeReceived>2017-01-02T03:04:05Z</t:DateTimeReceived><t:Importance>Normal</t:Importance>'
+    '<t:Categories><t:String>foo</t:String></t:Categories><t:ReminderIsSet>false</t:ReminderIsSet>'
+    '<t:From><t:Mailbox><t:Name>Foo</t:Name><t:EmailAddress>foo@example.com</t:EmailAddress></t:Mailbox></t:From>'
+    '<t:ToRecipients><t:Mailbox><t:EmailAddress>bar@example.com</t:EmailAddress></t:Mailbox></t:ToRecipients>'
+    '<t:IsRead>true</t:IsRead></t:Message>'
+)
+
+
+def bench_parse_items(number=100):
+    # Item.from_xml() on a FindItem page with 100 messages
+    page = '<t:Items xmlns:t="%s">%s</t:Items>' % (TNS, ''.join(MESSAGE % i for i in range(100)))
+
+    def parse():
+        # from_xml() clears the elements, so parse the XML every time
+        return [Message.from_xml(elem=e) for e in fromstring(page)]
+
+    print('Parsing 100 messages (usec): %.1f, of which XML parsing %.1f' % (
+        bench(parse, number), bench(lambda: fromstring(page), number)))
+
+
+def soap_response(body):
+    return (
+        '<?xml version="1.0" encoding="utf-8"?><s:Envelope xmlns:s="%s" xmlns:m="%s" xmlns:t="%s"><s:Header>'
+        '<h:ServerVersionInfo xmlns:h="%s" MajorVersion="15" MinorVersion="0" MajorBuildNumber="1178" '
+        'MinorBuildNumber="4" Version="V2_23"/></s:Header><s:Body>%s</s:Body></s:Envelope>'
+        % (SOAPNS, MNS, TNS, TNS, body)
+    ).encode('utf-8')
+
+
+def bench_backends(number=20):
+    # Parsing SOAP responses with each XML backend: a FindItem page with 1000 messages, and a GetItem response with 100
+    # messages that have a 100 KB HTML body each
+    find_item = soap_response(
+        '<m:FindItemResponse><m:ResponseMessages><m:FindItemResponseMessage ResponseClass="Success">'
+        '<m:ResponseCode>NoError</m:ResponseCode><m:RootFolder TotalItemsInView="1000" IncludesLastItemInRange="true">'
+        '<t:Items>%s</t:Items></m:RootFolder></m:FindItemResponseMessage></m:ResponseMessages></m:FindItemResponse>'
+        % ''.join(MESSAGE % i for i in range(1000))
+    )
+    body = '&lt;p&gt;%s&lt;/p&gt;' % ('Lorem ipsum dolor sit amet. ' * 3600)
+    get_item = soap_response(
+        '<m:GetItemResponse><m:ResponseMessages>%s</m:ResponseMessages></m:GetItemResponse>' % ''.join(
+            '<m:GetItemResponseMessage ResponseClass="Success"><m:ResponseCode>NoError</m:ResponseCode><m:Items>%s'
+            '</m:Items></m:GetItemResponseMessage>' % MESSAGE.replace('World', body) % i for i in range(100)
+        )
+    )
+
+    def items(root):
+        # Like the services do, find the items in the parsed response and decode them
+        res = []
+        for container in root.iter('{%s}Items' % TNS):
+            res.extend(Message.from_xml(elem=e) for e in container)
+        return res
+
+    def consume(s, elem):
+        # Like the streaming services do, consume the children of Items elements as they are parsed
+        if elem.tag == '{%s}Items' % TNS:
+            return sum(1 for _ in s.iter_children(elem))
+        n = 0
+        child = s.next_child(elem)
+        while child is not None:
+            n += consume(s, child)
+            child = s.next_child(elem)
+        return n
+
+    def stream(data):
+        s = ElementStream(data[i:i + 16384] for i in range(0, len(data), 16384))
+        return consume(s, s.root())
+
+    old_backend = get_xml_backend()
+    print('%-40s %s' % ('Parsing responses (msec):', ' '.join('%10s' % b for b in XML_BACKENDS)))
+    try:
+        for name, data in (('FindItem, %s KB' % (len(find_item) // 1024), find_item),
+                           ('GetItem, %s KB' % (len(get_item) // 1024), get_item)):
+            parse, decode, iterparse = [], [], []
+            for backend in XML_BACKENDS:
+                set_xml_backend(backend)
+                parse.append(bench(lambda: to_xml(data), number) / 1000)
+                decode.append(bench(lambda: items(to_xml(data)), number) / 1000)
+                iterparse.append(bench(lambda: stream(data), number) / 1000)
+            print('%-40s %s' % (name + ' to_xml()', ' '.join('%10.1f' % t for t in parse)))
+            print('%-40s %s' % (name + ' to_xml() + from_xml()', ' '.join('%10.1f' % t for t in decode)))
+            print('%-40s %s' % (name + ' ElementStream', ' '.join('%10.1f' % t for t in iterparse)))
+    finally:
+        set_xml_backend(old_backend)
+
+
+if __name__ == '__main__':
+    bench_factories()
+    bench_payload()
+    bench_item_ids()
+    bench_items()
+    bench_parse_items()
+    bench_backends()
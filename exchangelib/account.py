@@ -13,12 +13,11 @@ from .autodiscover import discover
 from .credentials import DELEGATE, IMPERSONATION
 from .errors import ErrorFolderNotFound, ErrorAccessDenied
 from .folders import Root, Calendar, DeletedItems, Drafts, Inbox, Outbox, SentItems, JunkEmail, Tasks, Contacts, \
-    RecoverableItemsRoot, RecoverableItemsDeletions, Folder, Item, SHALLOW, DEEP, HARD_DELETE, \
+    RecoverableItemsRoot, RecoverableItemsDeletions, Folder, Item, ItemDecoder, SHALLOW, DEEP, HARD_DELETE, \
     AUTO_RESOLVE, SEND_TO_NONE, SAVE_ONLY, SEND_AND_SAVE_COPY, SEND_ONLY, SPECIFIED_OCCURRENCE_ONLY, \
     DELETE_TYPE_CHOICES, MESSAGE_DISPOSITION_CHOICES, CONFLICT_RESOLUTION_CHOICES, AFFECTED_TASK_OCCURRENCES_CHOICES, \
     SEND_MEETING_INVITATIONS_CHOICES, SEND_MEETING_INVITATIONS_AND_CANCELLATIONS_CHOICES, \
     SEND_MEETING_CANCELLATIONS_CHOICES
-from .services import ExportItems, UploadItems
 from .queryset import QuerySet
 from .protocol import Protocol
 from .services import ExportItems, UploadItems
@@ -28,6 +27,13 @@ from .util import get_domain, peek
 log = getLogger(__name__)
 
 
+def _map_results(func, results, ordered):
+    # Applies 'func' to the results of a pooled service. Unordered results are (input_index, result) tuples.
+    if ordered:
+        return (func(r) for r in results)
+    return ((i, func(r)) for i, r in results)
+
+
 @python_2_unicode_compatible
 class Account(object):
     """
@@ -57,8 +63,9 @@ class Account(object):
                 raise AttributeError('non-autodiscover requires a config')
             self.protocol = config.protocol
         # We may need to override the default server version on a per-account basis because Microsoft may report one
-        # server version up-front but delegate account requests to an older backend server.
-        self.version = self.protocol.version
+        # server version up-front but delegate account requests to an older backend server. We may have learned the
+        # version of the account in a previous process.
+        self.version = self.protocol.get_cached_version(account=self) or self.protocol.version
         self.root = Root.get_distinguished(account=self)
 
         assert isinstance(self.protocol, Protocol)
@@ -164,7 +171,14 @@ class Account(object):
         Returns:
         A list strings, the exported representation of the object
         """
-        return list(ExportItems(self).call(items))
+        return list(self.iter_export(items))
+
+    def iter_export(self, items, ordered=True):
+        """
+        Like export(), but returns a generator. Items are exported in chunks as the generator is consumed. If 'ordered'
+        is False, (input_index, export_string) tuples are returned in the order the chunks complete.
+        """
+        return ExportItems(self).call(items, ordered=ordered)
 
     def upload(self, upload_data):
         """
@@ -185,13 +199,8 @@ class Account(object):
         """
         return list(UploadItems(self).call(upload_data))
 
-    def bulk_create(self, folder, items, message_disposition=SAVE_ONLY, send_meeting_invitations=SEND_TO_NONE):
-        """
-        Creates new items in the folder. 'items' is an iterable of Item objects. Returns a list of (id, changekey)
-        tuples in the same order as the input.
-        'message_disposition' is only applicable to Message items.
-        'send_meeting_invitations' is only applicable to CalendarItem items.
-        """
+    def _bulk_create_folder(self, folder, message_disposition, send_meeting_invitations):
+        # Validates the arguments to bulk_create() and returns the folder to create the items in
         assert message_disposition in MESSAGE_DISPOSITION_CHOICES
         assert send_meeting_invitations in SEND_MEETING_INVITATIONS_CHOICES
         if folder is not None:
@@ -211,20 +220,45 @@ class Account(object):
             message_disposition,
             send_meeting_invitations,
         )
+        return folder
+
+    def bulk_create(self, folder, items, message_disposition=SAVE_ONLY, send_meeting_invitations=SEND_TO_NONE):
+        """
+        Creates new items in the folder. 'items' is an iterable of Item objects. Returns a list of (id, changekey)
+        tuples in the same order as the input.
+        'message_disposition' is only applicable to Message items.
+        'send_meeting_invitations' is only applicable to CalendarItem items.
+        """
+        return list(self.iter_bulk_create(folder=folder, items=items, message_disposition=message_disposition,
+                                          send_meeting_invitations=send_meeting_invitations))
+
+    def iter_bulk_create(self, folder, items, message_disposition=SAVE_ONLY, send_meeting_invitations=SEND_TO_NONE,
+                         ordered=True):
+        """
+        Like bulk_create(), but returns a generator. 'items' is consumed lazily, and items are created in chunks as the
+        generator is consumed, so arbitrarily large inputs can be processed in constant memory.
+
+        If 'ordered' is False, (input_index, item) tuples are returned in the order the chunks complete, so a slow chunk
+        doesn't hold back the results of later chunks. This also applies to the other iter_* methods.
+        """
+        folder = self._bulk_create_folder(folder=folder, message_disposition=message_disposition,
+                                          send_meeting_invitations=send_meeting_invitations)
         is_empty, items = peek(items)
         if is_empty:
             # We accept generators, so it's not always convenient for caller to know up-front if 'items' is empty. Allow
             # empty 'items' and return early.
-            return []
-        return list(map(
+            return iter([])
+        return _map_results(
             lambda i: folder.item_model_from_tag(i.tag).from_xml(elem=i, account=self, folder=folder),
             CreateItem(account=self).call(
                 items=items,
                 folder=folder,
                 message_disposition=message_disposition,
                 send_meeting_invitations=send_meeting_invitations,
-            )
-        ))
+                ordered=ordered,
+            ),
+            ordered=ordered,
+        )
 
     def bulk_update(self, items, conflict_resolution=AUTO_RESOLVE, message_disposition=SAVE_ONLY,
                     send_meeting_invitations_or_cancellations=SEND_TO_NONE, suppress_read_receipts=True):
@@ -238,6 +272,18 @@ class Account(object):
         'send_meeting_invitations_or_cancellations' is only applicable to CalendarItem items.
         'suppress_read_receipts' is only supported from Exchange 2013.
         """
+        return list(self.iter_bulk_update(
+            items=items, conflict_resolution=conflict_resolution, message_disposition=message_disposition,
+            send_meeting_invitations_or_cancellations=send_meeting_invitations_or_cancellations,
+            suppress_read_receipts=suppress_read_receipts,
+        ))
+
+    def iter_bulk_update(self, items, conflict_resolution=AUTO_RESOLVE, message_disposition=SAVE_ONLY,
+                         send_meeting_invitations_or_cancellations=SEND_TO_NONE, suppress_read_receipts=True,
+                         ordered=True):
+        """
+        Like bulk_update(), but returns a generator of (item_id, changekey) tuples. 'items' is consumed lazily.
+        """
         assert conflict_resolution in CONFLICT_RESOLUTION_CHOICES
         assert message_disposition in MESSAGE_DISPOSITION_CHOICES
         assert send_meeting_invitations_or_cancellations in SEND_MEETING_INVITATIONS_AND_CANCELLATIONS_CHOICES
@@ -255,8 +301,8 @@ class Account(object):
         if is_empty:
             # We accept generators, so it's not always convenient for caller to know up-front if 'items' is empty. Allow
             # empty 'items' and return early.
-            return []
-        return list(map(
+            return iter([])
+        return _map_results(
             Item.id_from_xml,
             UpdateItem(account=self).call(
                 items=items,
@@ -264,18 +310,14 @@ class Account(object):
                 message_disposition=message_disposition,
                 send_meeting_invitations_or_cancellations=send_meeting_invitations_or_cancellations,
                 suppress_read_receipts=suppress_read_receipts,
-            )
-        ))
+                ordered=ordered,
+            ),
+            ordered=ordered,
+        )
 
-    def bulk_delete(self, ids, delete_type=HARD_DELETE, send_meeting_cancellations=SEND_TO_NONE,
-                    affected_task_occurrences=SPECIFIED_OCCURRENCE_ONLY, suppress_read_receipts=True):
-        """
-        Deletes items.
-        'ids' is an iterable of either (item_id, changekey) tuples or Item objects.
-        'send_meeting_cancellations' is only applicable to CalendarItem items.
-        'affected_task_occurrences' is only applicable for recurring Task items.
-        'suppress_read_receipts' is only supported from Exchange 2013.
-        """
+    def _bulk_delete_ids(self, ids, delete_type, send_meeting_cancellations, affected_task_occurrences,
+                         suppress_read_receipts):
+        # Validates the arguments to bulk_delete() and returns the ids to delete
         assert delete_type in DELETE_TYPE_CHOICES
         assert send_meeting_cancellations in SEND_MEETING_CANCELLATIONS_CHOICES
         assert affected_task_occurrences in AFFECTED_TASK_OCCURRENCES_CHOICES
@@ -291,19 +333,46 @@ class Account(object):
         # that case, we want to evaluate it now. Otherwise, peek() will start a count() which is wasteful because we
         # need the item IDs immediately afterwards. iterator() will do the bare minimum.
         if isinstance(ids, QuerySet):
-            ids = ids.iterator()
+            return ids.iterator()
+        return ids
+
+    def bulk_delete(self, ids, delete_type=HARD_DELETE, send_meeting_cancellations=SEND_TO_NONE,
+                    affected_task_occurrences=SPECIFIED_OCCURRENCE_ONLY, suppress_read_receipts=True):
+        """
+        Deletes items.
+        'ids' is an iterable of either (item_id, changekey) tuples or Item objects.
+        'send_meeting_cancellations' is only applicable to CalendarItem items.
+        'affected_task_occurrences' is only applicable for recurring Task items.
+        'suppress_read_receipts' is only supported from Exchange 2013.
+        """
+        return list(self.iter_bulk_delete(
+            ids=ids, delete_type=delete_type, send_meeting_cancellations=send_meeting_cancellations,
+            affected_task_occurrences=affected_task_occurrences, suppress_read_receipts=suppress_read_receipts,
+        ))
+
+    def iter_bulk_delete(self, ids, delete_type=HARD_DELETE, send_meeting_cancellations=SEND_TO_NONE,
+                         affected_task_occurrences=SPECIFIED_OCCURRENCE_ONLY, suppress_read_receipts=True,
+                         ordered=True):
+        """
+        Like bulk_delete(), but returns a generator. 'ids' is consumed lazily.
+        """
+        ids = self._bulk_delete_ids(ids=ids, delete_type=delete_type,
+                                    send_meeting_cancellations=send_meeting_cancellations,
+                                    affected_task_occurrences=affected_task_occurrences,
+                                    suppress_read_receipts=suppress_read_receipts)
         is_empty, ids = peek(ids)
         if is_empty:
             # We accept generators, so it's not always convenient for caller to know up-front if 'items' is empty. Allow
             # empty 'items' and return early.
-            return []
-        return list(DeleteItem(account=self).call(
+            return iter([])
+        return DeleteItem(account=self).call(
             items=ids,
             delete_type=delete_type,
             send_meeting_cancellations=send_meeting_cancellations,
             affected_task_occurrences=affected_task_occurrences,
             suppress_read_receipts=suppress_read_receipts,
-        ))
+            ordered=ordered,
+        )
 
     def bulk_send(self, ids, save_copy=True, copy_to_folder=None):
         # Send existing draft messages. If requested, save a copy in 'copy_to_folder'
@@ -322,26 +391,51 @@ class Account(object):
             MoveItem(account=self).call(items=ids, to_folder=to_folder)
         ))
 
-    def fetch(self, ids, folder=None, only_fields=None):
+    @staticmethod
+    def _fetch_fields(validation_folder, only_fields):
+        # Validates 'only_fields' for fetch() and returns the fields to fetch
+        if only_fields:
+            allowed_field_names = validation_folder._allowed_field_names()
+            for f in only_fields:
+                assert f in allowed_field_names
+            return only_fields
+        return validation_folder._allowed_field_names()
+
+    def fetch(self, ids, folder=None, only_fields=None, lazy=False):
         # 'folder' is used for validating only_fields
         # 'only_fields' specifies which fields to fetch, instead of all possible fields.
+        # 'lazy' decodes the fields of the returned items on first access. See Item.from_xml()
+        return list(self.iter_fetch(ids=ids, folder=folder, only_fields=only_fields, lazy=lazy))
+
+    def iter_fetch(self, ids, folder=None, only_fields=None, ordered=True, lazy=False):
+        # Like fetch(), but returns a generator. 'ids' is consumed lazily.
         validation_folder = folder or Folder  # Use a folder type that supports all item types
         is_empty, ids = peek(ids)
         if is_empty:
             # We accept generators, so it's not always convenient for caller to know up-front if 'items' is empty. Allow
             # empty 'items' and return early.
-            return []
-        if only_fields:
-            allowed_field_names = validation_folder.allowed_field_names()
-            for f in only_fields:
-                assert f in allowed_field_names
-        else:
-            only_fields = validation_folder.allowed_field_names()
-        items = GetItem(account=self).call(items=ids, folder=validation_folder, additional_fields=only_fields)
-        return list(map(
-            lambda i: validation_folder.item_model_from_tag(i.tag).from_xml(elem=i, account=self, folder=folder),
-            items
-        ))
+            return iter([])
+        only_fields = self._fetch_fields(validation_folder=validation_folder, only_fields=only_fields)
+        if self.protocol.PARSE_IN_PROCESSES and not lazy:
+            # The items are decoded in worker processes. We just need to connect them to the account. Lazy items are
+            # cheap to create, so they are always created here.
+            def _attach(item):
+                if isinstance(item, Item):
+                    item.account, item.folder = self, folder
+                return item
+
+            folder_cls = validation_folder if isinstance(validation_folder, type) else validation_folder.__class__
+            items = GetItem(account=self).call(items=ids, folder=validation_folder, additional_fields=only_fields,
+                                               ordered=ordered, decoder=ItemDecoder(folder_cls))
+            return _map_results(_attach, items, ordered=ordered)
+        items = GetItem(account=self).call(items=ids, folder=validation_folder, additional_fields=only_fields,
+                                           ordered=ordered)
+        return _map_results(
+            lambda i: validation_folder.item_model_from_tag(i.tag).from_xml(elem=i, account=self, folder=folder,
+                                                                             lazy=lazy),
+            items,
+            ordered=ordered,
+        )
 
     def __str__(self):
         txt = '%s' % self.primary_smtp_address
@@ -0,0 +1,222 @@
+# coding=utf-8
+"""
+An asyncio interface to the EWS services, for Python 3.5 and later.
+
+Requests are still sent through post_ratelimited() and the session pool, so authentication (including the NTLM
+handshake), retries, redirects and rate-limiting behave exactly like in the synchronous API. What changes is how
+requests are scheduled: requests that are waiting to be sent are plain coroutines on the event loop instead of blocked
+threads, and no more requests are handed to worker threads than there are sessions in the session pool. An application
+can have thousands of requests outstanding without running thousands of threads.
+
+This module is not imported by the exchangelib package because Python 2 can't parse it. Import it explicitly:
+
+    from exchangelib.aio import AsyncAccount
+
+    async_account = AsyncAccount(account)
+    items = await async_account.fetch(ids=ids)
+    async for item in account.inbox.filter(subject='foo'):
+        print(item.subject)
+"""
+import asyncio
+import itertools
+import logging
+import weakref
+from threading import Lock
+
+from .folders import Folder, SEND_TO_NONE, SAVE_ONLY, HARD_DELETE, SPECIFIED_OCCURRENCE_ONLY
+from .services import EWSPooledMixIn, GetItem, CreateItem, DeleteItem
+from .util import peek
+
+log = logging.getLogger(__name__)
+
+
+def _get_running_loop():
+    # asyncio.get_running_loop() is new in Python 3.7. Before that, get_event_loop() returns the running loop when
+    # called from a coroutine.
+    try:
+        return asyncio.get_running_loop()
+    except AttributeError:
+        return asyncio.get_event_loop()
+
+
+class AsyncProtocol(object):
+    """
+    Schedules service requests for a Protocol on an asyncio event loop. Use from_protocol() to get the instance shared
+    by everyone using the same Protocol. An AsyncProtocol may be used from more than one event loop, e.g. by consecutive
+    asyncio.run() calls.
+    """
+    # Keyed by protocol. Protocols that are no longer used elsewhere are garbage collected, with their sessions.
+    _instances = weakref.WeakKeyDictionary()
+    _instances_lock = Lock()
+
+    def __init__(self, protocol):
+        # A weak reference, so our entry in _instances doesn't keep the protocol alive
+        self._protocol_ref = weakref.ref(protocol)
+        self._semaphores = weakref.WeakKeyDictionary()  # One per event loop
+
+    @property
+    def protocol(self):
+        return self._protocol_ref()
+
+    @classmethod
+    def from_protocol(cls, protocol):
+        with cls._instances_lock:
+            async_protocol = cls._instances.get(protocol)
+            if async_protocol is None:
+                async_protocol = cls(protocol=protocol)
+                cls._instances[protocol] = async_protocol
+        return async_protocol
+
+    def _get_semaphore(self):
+        # Each request holds a session while it waits for the response, so handing more requests than sessions to
+        # worker threads would just block the threads in get_session(). asyncio primitives bind to the event loop that
+        # is running when they are first used, so each event loop gets its own semaphore.
+        loop = _get_running_loop()
+        semaphore = self._semaphores.get(loop)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self.protocol.pool_controller.maximum)
+            self._semaphores[loop] = semaphore
+        return semaphore
+
+    async def run(self, func, *args):
+        # Run a blocking function in a worker thread of the protocol
+        loop = _get_running_loop()
+        future = loop.create_future()
+
+        def _resolve(method, value):
+            if not future.cancelled():
+                method(value)
+
+        self.protocol.thread_pool.apply_async(
+            func, args,
+            callback=lambda value: loop.call_soon_threadsafe(_resolve, future.set_result, value),
+            error_callback=lambda e: loop.call_soon_threadsafe(_resolve, future.set_exception, e),
+        )
+        return await future
+
+    async def call(self, service, **kwargs):
+        """
+        Async version of service.call(). 'kwargs' are the arguments to the _get_payload() method of the service. Returns
+        a list of the elements in the response. For pooled services, 'items' is split into chunks of
+        service.CHUNKSIZE and the chunks are sent concurrently. The order of the output is the same as the input.
+        """
+        if not isinstance(service, EWSPooledMixIn):
+            return await self._get_elements(service, **kwargs)
+        items = kwargs.pop('items')
+        tuner = service._get_chunksize_tuner()
+        chunksize = service.CHUNKSIZE if tuner is None else tuner.chunksize
+        results = await asyncio.gather(*[
+            self._get_elements(service, tuner=tuner, measure=len(chunk) == chunksize, items=chunk, **kwargs)
+            for chunk in service._chunkify(items, chunksize)
+        ])
+        return list(itertools.chain(*results))
+
+    async def _get_elements(self, service, tuner=None, measure=False, **kwargs):
+        async with self._get_semaphore():
+            # Build the payload only when we're allowed to send it, so payloads of queued requests don't pile up
+            payload = service._get_payload(**kwargs)
+            if tuner is None:
+                return await self.run(lambda: list(service._get_elements(payload=payload)))
+            with tuner.measure(n_items=len(kwargs['items']) if measure else None):
+                return await self.run(lambda: list(service._get_elements(payload=payload)))
+
+
+class AsyncAccount(object):
+    """
+    Async versions of the bulk methods on Account. Arguments and return values are the same as on Account.
+    """
+    def __init__(self, account):
+        self.account = account
+        self.protocol = AsyncProtocol.from_protocol(account.protocol)
+
+    async def bulk_create(self, folder, items, message_disposition=SAVE_ONLY, send_meeting_invitations=SEND_TO_NONE):
+        # Validation may need to look up the 'Sent' folder, which is a blocking request
+        folder = await self.protocol.run(
+            self.account._bulk_create_folder, folder, message_disposition, send_meeting_invitations)
+        is_empty, items = peek(items)
+        if is_empty:
+            return []
+        elements = await self.protocol.call(
+            CreateItem(account=self.account),
+            items=items,
+            folder=folder,
+            message_disposition=message_disposition,
+            send_meeting_invitations=send_meeting_invitations,
+        )
+        return [folder.item_model_from_tag(e.tag).from_xml(elem=e, account=self.account, folder=folder)
+                for e in elements]
+
+    async def bulk_delete(self, ids, delete_type=HARD_DELETE, send_meeting_cancellations=SEND_TO_NONE,
+                          affected_task_occurrences=SPECIFIED_OCCURRENCE_ONLY, suppress_read_receipts=True):
+        ids = self.account._bulk_delete_ids(
+            ids=ids, delete_type=delete_type, send_meeting_cancellations=send_meeting_cancellations,
+            affected_task_occurrences=affected_task_occurrences, suppress_read_receipts=suppress_read_receipts)
+        # 'ids' may be a lazy QuerySet iterator which does blocking requests when consumed
+        ids = await self.protocol.run(list, ids)
+        if not ids:
+            return []
+        return await self.protocol.call(
+            DeleteItem(account=self.account),
+            items=ids,
+            delete_type=delete_type,
+            send_meeting_cancellations=send_meeting_cancellations,
+            affected_task_occurrences=affected_task_occurrences,
+            suppress_read_receipts=suppress_read_receipts,
+        )
+
+    async def fetch(self, ids, folder=None, only_fields=None):
+        validation_folder = folder or Folder  # Use a folder type that supports all item types
+        is_empty, ids = peek(ids)
+        if is_empty:
+            return []
+        only_fields = self.account._fetch_fields(validation_folder=validation_folder, only_fields=only_fields)
+        elements = await self.protocol.call(
+            GetItem(account=self.account), items=ids, folder=validation_folder, additional_fields=only_fields)
+        return [validation_folder.item_model_from_tag(e.tag).from_xml(elem=e, account=self.account, folder=folder)
+                for e in elements]
+
+
+class AsyncQuerySetIterator(object):
+    """
+    Supports 'async for' over a QuerySet. Results are pulled from the server in worker threads, in batches of
+    BATCH_SIZE, and end up in the QuerySet cache just like with synchronous iteration.
+    """
+    BATCH_SIZE = 100
+
+    def __init__(self, queryset):
+        self.queryset = queryset
+        self._source = None
+        self._results = []
+        self._batch = iter(())
+        self._done = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while True:
+            try:
+                return next(self._batch)
+            except StopIteration:
+                pass
+            if self._done:
+                raise StopAsyncIteration
+            qs = self.queryset
+            if self._source is None and qs._cache is not None:
+                self._batch = qs._format_items(iter(qs._cache))
+                self._done = True
+                continue
+            protocol = AsyncProtocol.from_protocol(qs.folder.account.protocol)
+            batch = await protocol.run(self._next_batch)
+            if len(batch) < self.BATCH_SIZE:
+                qs._cache = self._results
+                self._done = True
+            self._batch = qs._format_items(iter(batch))
+
+    def _next_batch(self):
+        # Runs in a worker thread. _query() may start a request before it yields anything
+        if self._source is None:
+            self._source = iter(()) if self.queryset.q is None else iter(self.queryset._query())
+        batch = list(itertools.islice(self._source, self.BATCH_SIZE))
+        self._results.extend(batch)
+        return batch
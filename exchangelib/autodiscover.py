@@ -13,14 +13,12 @@ from __future__ import unicode_literals
 
 import logging
 import os
-import shelve
 import tempfile
 from threading import Lock
 
 import dns.resolver
-import queue
 import requests.exceptions
-from future.utils import raise_from, PY2, python_2_unicode_compatible
+from future.utils import raise_from, python_2_unicode_compatible
 from six import text_type
 
 from . import transport
@@ -29,7 +27,7 @@ from .errors import AutoDiscoverFailed, AutoDiscoverRedirect, AutoDiscoverCircul
     RedirectError, ErrorNonExistentMailbox
 from .protocol import BaseProtocol, Protocol
 from .util import create_element, get_xml_attr, add_xml_child, to_xml, is_xml, post_ratelimited, get_redirect_url, \
-    xml_to_str, get_domain
+    xml_to_str, get_domain, shelve_open
 
 log = logging.getLogger(__name__)
 
@@ -42,20 +40,6 @@ TIMEOUT = 10  # Seconds
 
 AUTODISCOVER_PERSISTENT_STORAGE = os.path.join(tempfile.gettempdir(), 'exchangelib.cache')
 
-if PY2:
-    from contextlib import contextmanager
-
-
-    @contextmanager
-    def shelve_open(*args, **kwargs):
-        shelve_handle = shelve.open(*args, **kwargs)
-        try:
-            yield shelve_handle
-        finally:
-            shelve_handle.close()
-else:
-    shelve_open = shelve.open
-
 
 @python_2_unicode_compatible
 class AutodiscoverCache(object):
@@ -498,9 +482,7 @@ class AutodiscoverProtocol(BaseProtocol):
 
     def __init__(self, *args, **kwargs):
         super(AutodiscoverProtocol, self).__init__(*args, **kwargs)
-        self._session_pool = queue.LifoQueue(maxsize=self.SESSION_POOLSIZE)
-        for _ in range(self.SESSION_POOLSIZE):
-            self._session_pool.put(self.create_session(), block=False)
+        self._create_session_pool()
 
     def __str__(self):
         return '''\
@@ -0,0 +1,238 @@
+# coding=utf-8
+"""
+A thread pool that is shared by all Protocol instances in the process.
+
+Pooled services (GetItem, CreateItem etc.) send their requests from worker threads. Previously, each Protocol had its
+own ThreadPool with 4 * SESSION_POOLSIZE threads that were started up-front and lived forever, so a process talking to
+many endpoints or with many credentials had hundreds of idle threads. Now, all protocols share one SharedExecutor whose
+threads are started on demand and stop again when they have been idle for a while. Each protocol submits work through
+an ExecutorQuota, which limits the number of tasks a single protocol can run concurrently so one busy endpoint can't
+starve the others.
+
+CPU-bound work that would otherwise hold the GIL, like decoding large responses, can be sent to the worker processes of
+a SharedProcessPool.
+"""
+from __future__ import unicode_literals
+
+import logging
+import multiprocessing
+import sys
+import time
+from collections import deque
+from multiprocessing import TimeoutError
+from threading import Condition, Event, Lock, Thread, local
+
+from six import reraise
+
+log = logging.getLogger(__name__)
+
+
+class AsyncResult(object):
+    """
+    The result of a task submitted with ExecutorQuota.apply_async(). Mimics multiprocessing.pool.AsyncResult.
+    """
+    def __init__(self, callback=None, error_callback=None):
+        self._callback = callback
+        self._error_callback = error_callback
+        self._event = Event()
+        self._value = None
+        self._exc_info = None
+
+    def ready(self):
+        return self._event.is_set()
+
+    def successful(self):
+        assert self.ready()
+        return self._exc_info is None
+
+    def wait(self, timeout=None):
+        self._event.wait(timeout)
+
+    def get(self, timeout=None):
+        if not self._event.wait(timeout):
+            raise TimeoutError()
+        if self._exc_info is not None:
+            reraise(*self._exc_info)
+        return self._value
+
+    def _run(self, func, args, kwargs):
+        try:
+            self._value = func(*args, **kwargs)
+        except Exception as e:
+            self._exc_info = sys.exc_info()
+            if self._error_callback is not None:
+                self._error_callback(e)
+        else:
+            if self._callback is not None:
+                self._callback(self._value)
+        finally:
+            self._event.set()
+
+
+class SharedExecutor(object):
+    """
+    Runs tasks in at most 'max_workers' threads. Threads are started when there is more work than idle threads, and
+    stop after IDLE_TIMEOUT seconds without work. Use get_instance() to get the executor shared by all protocols.
+    """
+    # The default maximum number of threads of the shared executor. Change this before the first Protocol is created,
+    # or change 'max_workers' on the shared instance.
+    MAX_WORKERS = 64
+    # Number of seconds a thread waits for new work before it stops
+    IDLE_TIMEOUT = 60
+
+    _instance = None
+    _instance_lock = Lock()
+
+    def __init__(self, max_workers):
+        assert max_workers >= 1
+        self.max_workers = max_workers
+        self._tasks = deque()
+        self._cond = Condition()
+        self._threads = 0
+        self._idle = 0
+
+    @classmethod
+    def get_instance(cls):
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls(max_workers=cls.MAX_WORKERS)
+            return cls._instance
+
+    @property
+    def num_threads(self):
+        return self._threads
+
+    def submit(self, task):
+        # Run 'task', which is a callable without arguments, in a worker thread
+        with self._cond:
+            self._tasks.append(task)
+            start_thread = len(self._tasks) > self._idle and self._threads < self.max_workers
+            if start_thread:
+                self._threads += 1
+            else:
+                self._cond.notify()
+        if start_thread:
+            log.debug('Starting executor thread %s', self._threads)
+            t = Thread(target=self._worker)
+            t.daemon = True
+            t.start()
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                self._idle += 1
+                idle_since = time.time()
+                while not self._tasks:
+                    remaining = self.IDLE_TIMEOUT - (time.time() - idle_since)
+                    if remaining <= 0:
+                        self._idle -= 1
+                        self._threads -= 1
+                        log.debug('Stopping idle executor thread')
+                        return
+                    self._cond.wait(remaining)
+                self._idle -= 1
+                task = self._tasks.popleft()
+            try:
+                task()
+            except Exception:
+                # E.g. a failing callback. Don't let a bad task kill the thread.
+                log.exception('Unhandled exception in executor task')
+            # Don't keep the task, and e.g. the protocol it references, alive while we wait for the next one
+            task = None
+
+
+class ExecutorQuota(object):
+    """
+    Submits tasks to a SharedExecutor on behalf of one protocol, with at most 'max_tasks' tasks running at any time.
+    Tasks exceeding the quota wait here instead of occupying threads of the executor. Has the apply_async() method of
+    multiprocessing.pool.ThreadPool, so it can be used in its place.
+
+    A task may itself submit tasks to the same quota and wait for them, e.g. an async query that fetches its items
+    with a pooled service. If all slots are taken, such nested tasks run right away in the thread of the parent task
+    instead of waiting in the backlog, where they would wait forever for slots held by their own parents.
+    """
+    # The quotas whose tasks are running in the current thread
+    _local = local()
+
+    def __init__(self, executor, max_tasks):
+        assert max_tasks >= 1
+        self.executor = executor
+        self.max_tasks = max_tasks
+        self._running = 0
+        self._backlog = deque()
+        self._lock = Lock()
+
+    def apply_async(self, func, args=(), kwds=None, callback=None, error_callback=None):
+        result = AsyncResult(callback=callback, error_callback=error_callback)
+        task = (result, func, args, kwds or {})
+        with self._lock:
+            if self._running >= self.max_tasks:
+                if self._in_task():
+                    run_inline = True
+                else:
+                    self._backlog.append(task)
+                    return result
+            else:
+                self._running += 1
+                run_inline = False
+        if run_inline:
+            result._run(func, args, kwds or {})
+        else:
+            self.executor.submit(lambda: self._run(task))
+        return result
+
+    def _in_task(self):
+        return self in getattr(self._local, 'quotas', ())
+
+    def _run(self, task):
+        result, func, args, kwds = task
+        quotas = getattr(self._local, 'quotas', None)
+        if quotas is None:
+            quotas = self._local.quotas = []
+        quotas.append(self)
+        try:
+            result._run(func, args, kwds)
+        finally:
+            quotas.pop()
+            with self._lock:
+                if self._backlog and self._running <= self.max_tasks:
+                    # Hand over our slot to the next waiting task. Submit it to the back of the executor queue instead
+                    # of running it right here, so tasks of other protocols get their turn.
+                    next_task = self._backlog.popleft()
+                else:
+                    self._running -= 1
+                    next_task = None
+            if next_task is not None:
+                self.executor.submit(lambda: self._run(next_task))
+
+
+class SharedProcessPool(object):
+    """
+    A multiprocessing.Pool that is shared by all protocols in the process. The worker processes are started when the
+    pool is first used. Use get_instance() to get the pool.
+
+    Tasks and their results are pickled, so they must not contain accounts, protocols or anything else that holds
+    sessions or locks. On platforms that don't fork, the worker processes import the __main__ module of the application,
+    which must then be guarded with "if __name__ == '__main__'".
+    """
+    # The number of worker processes. None means one per CPU. Change this before the pool is first used.
+    PROCESSES = None
+
+    _instance = None
+    _instance_lock = Lock()
+
+    def __init__(self, processes):
+        self.processes = processes or multiprocessing.cpu_count()
+        self._pool = multiprocessing.Pool(processes=self.processes)
+
+    @classmethod
+    def get_instance(cls):
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls(processes=cls.PROCESSES)
+                log.debug('Started %s parser processes', cls._instance.processes)
+            return cls._instance
+
+    def apply(self, func, args=()):
+        # Run func(*args) in a worker process and wait for the result. Exceptions are re-raised in the calling thread.
+        return self._pool.apply(func, args)
@@ -12,6 +12,7 @@ import base64
 import mimetypes
 import warnings
 from decimal import Decimal
+from functools import wraps
 from logging import getLogger
 
 from future.utils import python_2_unicode_compatible
@@ -23,7 +24,7 @@ from .restriction import Restriction, Q
 from .services import TNS, IdOnly, SHALLOW, DEEP, FindFolder, GetFolder, FindItem, GetAttachment, CreateAttachment, \
     DeleteAttachment, MNS, ITEM_TRAVERSAL_CHOICES, FOLDER_TRAVERSAL_CHOICES, SHAPE_CHOICES
 from .util import create_element, add_xml_child, get_xml_attrs, get_xml_attr, set_xml_value, value_to_xml_text, \
-    xml_text_to_value, isanysubclass
+    xml_text_to_value, isanysubclass, LRUCache, XMLWriter
 from .version import EXCHANGE_2010
 
 string_type = string_types[0]
@@ -65,6 +66,38 @@ SOFT_DELETE = 'SoftDelete'
 MOVE_TO_DELETED_ITEMS = 'MoveToDeletedItems'
 DELETE_TYPE_CHOICES = (HARD_DELETE, SOFT_DELETE, MOVE_TO_DELETED_ITEMS)
 
+# Field metadata of item and folder classes, as a {(cls, method name): value} dict. See field_metadata()
+_field_metadata = {}
+# Serialized AdditionalProperties elements. See Folder.additional_properties_xml()
+_additional_properties_cache = LRUCache(maxsize=1000)
+
+
+def field_metadata(func):
+    """
+    Decorator for classmethods without arguments that derive field metadata (field names, XML serialization plans etc.)
+    from ITEM_FIELDS and friends. The value is computed once per class and then served from a registry. Values must
+    be immutable, e.g. tuples and frozensets, since they are shared by all callers. Public methods that return lists or
+    sets wrap a cached method and return a copy, so callers can modify the result.
+
+    ItemMixIn.register() and deregister() change the fields of a class, and call clear_field_metadata(). Do the same
+    after changing ITEM_FIELDS, REQUIRED_FIELDS etc. of a class at runtime.
+    """
+    @wraps(func)
+    def wrapper(cls):
+        key = (cls, func.__name__)
+        try:
+            return _field_metadata[key]
+        except KeyError:
+            value = func(cls)
+            _field_metadata[key] = value
+            return value
+    return classmethod(wrapper)
+
+
+def clear_field_metadata():
+    _field_metadata.clear()
+    _additional_properties_cache.clear()
+
 
 class Choice(text_type):
     # A helper class used for string enums
@@ -153,7 +186,6 @@ class MessageHeader(EWSElement):
 
     def to_xml(self, version):
         elem = create_element(self.request_tag())
-        # Use .set() to not fill up the create_element() cache with unique values
         elem.set(self.NAME_ATTR, self.name)
         set_xml_value(elem, self.value, version)
         return elem
@@ -186,7 +218,6 @@ class ItemId(EWSElement):
 
     def to_xml(self, version):
         elem = create_element(self.request_tag())
-        # Use .set() to not fill up the create_element() cache with unique values
         elem.set(self.ID_ATTR, self.id)
         elem.set(self.CHANGEKEY_ATTR, self.changekey)
         return elem
@@ -263,7 +294,6 @@ class AttachmentId(EWSElement):
 
     def to_xml(self, version):
         elem = create_element(self.request_tag())
-        # Use .set() to not fill up the create_element() cache with unique values
         elem.set(self.ID_ATTR, self.id)
         if self.root_id:
             elem.set(self.ROOT_ID_ATTR, self.root_id)
@@ -857,6 +887,63 @@ class Attendee(EWSElement):
         return hash(self.mailbox)
 
 
+def _text_field_from_xml(kwargs, fieldname, field_elem, field_type):
+    val = field_elem.text.strip() if field_elem.text else None
+    if val is None:
+        return
+    try:
+        val = xml_text_to_value(value=val, field_type=field_type)
+    except ValueError:
+        pass
+    except KeyError:
+        assert False, 'Field %s type %s not supported' % (fieldname, field_type)
+    kwargs[fieldname] = val
+
+
+def _body_field_from_xml(kwargs, fieldname, field_elem, field_type):
+    _text_field_from_xml(kwargs, fieldname, field_elem, field_type)
+    if fieldname not in kwargs:
+        return
+    body_type = field_elem.get('BodyType')
+    try:
+        kwargs[fieldname] = {
+            Body.body_type: lambda v: Body(v),
+            HTMLBody.body_type: lambda v: HTMLBody(v),
+        }[body_type](kwargs[fieldname])
+    except KeyError:
+        assert False, "Unknown BodyType '%s'" % body_type
+
+
+def _string_list_field_from_xml(kwargs, fieldname, field_elem, string_tag):
+    kwargs[fieldname] = get_xml_attrs(field_elem, string_tag)
+
+
+def _attachments_field_from_xml(kwargs, fieldname, field_elem, _):
+    # Look for both FileAttachment and ItemAttachment
+    attachments = []
+    for att_type in (FileAttachment, ItemAttachment):
+        attachments.extend([att_type.from_xml(e) for e in field_elem.findall(att_type.response_tag())])
+    kwargs[fieldname] = attachments
+
+
+def _list_field_from_xml(kwargs, fieldname, field_elem, list_type):
+    kwargs[fieldname] = [list_type.from_xml(e) for e in field_elem.findall(list_type.response_tag())]
+
+
+def _mailbox_field_from_xml(kwargs, fieldname, field_elem, field_type):
+    # We want the nested Mailbox, not the wrapper element
+    kwargs[fieldname] = field_type.from_xml(field_elem.find(Mailbox.response_tag()))
+
+
+def _element_field_from_xml(kwargs, fieldname, field_elem, field_type):
+    kwargs[fieldname] = field_type.from_xml(field_elem)
+
+
+def _extended_property_from_xml(kwargs, fieldname, field_elems, field_type):
+    # 'field_elems' is the list of all ExtendedProperty elements of the item
+    kwargs[fieldname] = field_type.get_value(field_elems)
+
+
 class Item(EWSElement):
     ELEMENT_NAME = 'Item'
     # The prefix part of the FieldURI for items of this type. See
@@ -909,42 +996,27 @@ class Item(EWSElement):
     # Fields that are readonly when an item is no longer a draft. Updating these would result in
     # ErrorInvalidPropertyUpdateSentMessage
     READONLY_AFTER_SEND_FIELDS = set()
+    # Whether from_xml() can create lazy items of this class. Classes whose __init__() adjusts some fields based on the
+    # values of other fields must decode all fields up-front.
+    LAZY_FROM_XML = True
 
     # 'account' is optional but allows calling 'send()'
     # 'folder' is optional but allows calling 'save()' and 'delete()'
-    __slots__ = ('account', 'folder') + tuple(ITEM_FIELDS)
+    # '_lazy' contains the field elements that have not been decoded yet, if this is a lazy item. See from_xml()
+    __slots__ = ('account', 'folder', '_lazy') + tuple(ITEM_FIELDS)
 
     def __init__(self, **kwargs):
-        for k in Item.__slots__:
+        self._lazy = None
+        for k in ('account', 'folder') + tuple(Item.ITEM_FIELDS):
             default = False if k == 'reminder_is_set' else [] if k == 'attachments' else None
             v = kwargs.pop(k, default)
-            if v is not None:
-                # Test if arguments have the correct type. Some types, e.g. ExtendedProperty and Body, are special
-                # because we want to allow setting the attribute as a simple Python type for simplicity and ease of use,
-                # while allowing the actual class instances.
-                # 'field_type' may be a list with a single type. In that case we want to check all list members.
-                if k == 'account':
-                    from .account import Account
-                    field_type = Account
-                elif k == 'folder':
-                    field_type = Folder
-                else:
-                    field_type = self.type_for_field(k)
-                if isinstance(field_type, list):
-                    elem_type = field_type[0]
-                    assert isinstance(v, list)
-                    for item in v:
-                        if not isinstance(item, elem_type):
-                            raise TypeError('Field %s value "%s" must be of type %s' % (k, v, field_type))
-                else:
-                    if isanysubclass(field_type, ExtendedProperty):
-                        valid_field_types = (field_type, field_type.python_type())
-                    elif field_type in (Body, HTMLBody, Choice, MimeContent):
-                        valid_field_types = (field_type, string_type)
-                    else:
-                        valid_field_types = (field_type,)
-                    if not isinstance(v, valid_field_types):
-                        raise TypeError('Field %s value "%s" must be of type %s' % (k, v, field_type))
+            if k == 'account':
+                from .account import Account
+                self._check_type(k, v, Account)
+            elif k == 'folder':
+                self._check_type(k, v, Folder)
+            else:
+                self._check_field(k, v)
             setattr(self, k, v)
         for k, v in kwargs.items():
             raise TypeError("'%s' is an invalid keyword argument for this function" % k)
@@ -955,6 +1027,37 @@ class Item(EWSElement):
                 a.parent_item = self
             self.attach(self.attachments)
 
+    @classmethod
+    def _check_field(cls, fieldname, value):
+        # Validates the value of a field. Called by __init__ and when a field of a lazy item is decoded, so lazy and
+        # eager items accept the same values.
+        if fieldname in Item.ITEM_FIELDS:
+            cls._check_type(fieldname, value, cls.type_for_field(fieldname))
+
+    @staticmethod
+    def _check_type(fieldname, value, field_type):
+        # Test if arguments have the correct type. Some types, e.g. ExtendedProperty and Body, are special because we
+        # want to allow setting the attribute as a simple Python type for simplicity and ease of use, while allowing the
+        # actual class instances.
+        # 'field_type' may be a list with a single type. In that case we want to check all list members.
+        if value is None:
+            return
+        if isinstance(field_type, list):
+            elem_type = field_type[0]
+            assert isinstance(value, list)
+            for item in value:
+                if not isinstance(item, elem_type):
+                    raise TypeError('Field %s value "%s" must be of type %s' % (fieldname, value, field_type))
+        else:
+            if isanysubclass(field_type, ExtendedProperty):
+                valid_field_types = (field_type, field_type.python_type())
+            elif field_type in (Body, HTMLBody, Choice, MimeContent):
+                valid_field_types = (field_type, string_type)
+            else:
+                valid_field_types = (field_type,)
+            if not isinstance(value, valid_field_types):
+                raise TypeError('Field %s value "%s" must be of type %s' % (fieldname, value, field_type))
+
     def save(self, conflict_resolution=AUTO_RESOLVE, send_meeting_invitations=SEND_TO_NONE):
         item = self._save(message_disposition=SAVE_ONLY, conflict_resolution=conflict_resolution,
                                         send_meeting_invitations=send_meeting_invitations)
@@ -976,6 +1079,7 @@ class Item(EWSElement):
     def _save(self, message_disposition, conflict_resolution, send_meeting_invitations):
         if not self.account:
             raise ValueError('Item must have an account')
+        self._hydrate()
         if self.item_id:
             assert self.changekey
             update_fields = []
@@ -983,13 +1087,13 @@ class Item(EWSElement):
                 if f == 'attachments':
                     # Attachments are handled separately after item creation
                     continue
-                if f in self.readonly_fields():
+                if f in self._readonly_fields():
                     # These cannot be changed
                     continue
-                if not self.is_draft and f in self.readonly_after_send_fields():
+                if not self.is_draft and f in self._readonly_after_send_fields():
                     # These cannot be changed when the item is no longer a draft
                     continue
-                if f in self.required_fields() and getattr(self, f) is None:
+                if f in self._required_fields() and getattr(self, f) is None:
                     continue
                 update_fields.append(f)
             res = self.account.bulk_update(
@@ -1026,6 +1130,7 @@ class Item(EWSElement):
         fresh_item = res[0]
         for k in self.__slots__:
             setattr(self, k, getattr(fresh_item, k))
+        self._lazy = None
 
     def move(self, to_folder):
         if not self.account:
@@ -1109,13 +1214,13 @@ class Item(EWSElement):
             if a in self.attachments:
                 self.attachments.remove(a)
 
-    @classmethod
+    @field_metadata
     def fieldnames(cls):
         # Return non-ID field names
         return tuple(f for f in cls.ITEM_FIELDS if f not in ('item_id', 'changekey'))
 
-    @classmethod
-    def ordered_fieldnames(cls):
+    @field_metadata
+    def _ordered_fieldnames(cls):
         res = []
         for f in cls.ORDERED_FIELDS:
             if isinstance(f, list):
@@ -1123,7 +1228,11 @@ class Item(EWSElement):
                 res.extend(f)
             else:
                 res.append(f)
-        return res
+        return tuple(res)
+
+    @classmethod
+    def ordered_fieldnames(cls):
+        return list(cls._ordered_fieldnames())
 
     @classmethod
     def uri_for_field(cls, fieldname):
@@ -1164,17 +1273,29 @@ class Item(EWSElement):
 
     @classmethod
     def required_fields(cls):
-        return Item.REQUIRED_FIELDS
+        return set(cls._required_fields())
 
     @classmethod
     def readonly_fields(cls):
-        return Item.READONLY_FIELDS
+        return set(cls._readonly_fields())
 
     @classmethod
     def readonly_after_send_fields(cls):
-        return Item.READONLY_AFTER_SEND_FIELDS
+        return set(cls._readonly_after_send_fields())
 
-    @classmethod
+    @field_metadata
+    def _required_fields(cls):
+        return frozenset(Item.REQUIRED_FIELDS)
+
+    @field_metadata
+    def _readonly_fields(cls):
+        return frozenset(Item.READONLY_FIELDS)
+
+    @field_metadata
+    def _readonly_after_send_fields(cls):
+        return frozenset(Item.READONLY_AFTER_SEND_FIELDS)
+
+    @field_metadata
     def complex_fields(cls):
         # Return fields that are not complex EWS types. Quoting the EWS FindItem docs:
         #
@@ -1218,71 +1339,154 @@ class Item(EWSElement):
             return None, None
         return id_elem.get(ItemId.ID_ATTR), id_elem.get(ItemId.CHANGEKEY_ATTR)
 
-    @classmethod
-    def from_xml(cls, elem, account=None, folder=None):
-        assert elem.tag == cls.response_tag(), (cls, elem.tag, cls.response_tag())
-        item_id, changekey = cls.id_from_xml(elem)
-        kwargs = {}
-        extended_properties = elem.findall(ExtendedProperty.response_tag())
+    @field_metadata
+    def from_xml_table(cls):
+        """
+        Returns a ({tag: (fieldname, func, arg)}, extended_property_fields) tuple for parsing items of this class.
+        func(kwargs, fieldname, field_elem, arg) adds the value of the field in 'field_elem' to 'kwargs', if it has one.
+        'extended_property_fields' is a tuple of (fieldname, ExtendedProperty subclass) tuples.
+
+        Element names and value types are resolved once per class, so from_xml() can dispatch on the tag of each child
+        element instead of searching the item element for every field.
+        """
+        text_types = (EWSDateTime, bool, int, Decimal, string_type, Choice, Email, AnyURI, Body, HTMLBody, MimeContent)
+        tags = {}
+        extended_property_fields = []
         for fieldname in cls.fieldnames():
             field_type = cls.type_for_field(fieldname)
-            if field_type in (EWSDateTime, bool, int, Decimal, string_type, Choice, Email, AnyURI, Body, HTMLBody, MimeContent):
-                field_elem = elem.find(cls.response_xml_elem_for_field(fieldname))
-                val = None if field_elem is None else field_elem.text.strip() if field_elem.text else None
-                if val is not None:
-                    try:
-                        val = xml_text_to_value(value=val, field_type=field_type)
-                    except ValueError:
-                        pass
-                    except KeyError:
-                        assert False, 'Field %s type %s not supported' % (fieldname, field_type)
-                    if fieldname == 'body':
-                        body_type = field_elem.get('BodyType')
-                        try:
-                            val = {
-                                Body.body_type: lambda v: Body(v),
-                                HTMLBody.body_type: lambda v: HTMLBody(v),
-                            }[body_type](val)
-                        except KeyError:
-                            assert False, "Unknown BodyType '%s'" % body_type
-                    kwargs[fieldname] = val
-            elif isinstance(field_type, list):
+            if isinstance(field_type, list):
                 list_type = field_type[0]
                 if list_type == string_type:
-                    iter_elem = elem.find(cls.response_xml_elem_for_field(fieldname))
-                    if iter_elem is not None:
-                        kwargs[fieldname] = get_xml_attrs(iter_elem, '{%s}String' % TNS)
+                    step = (fieldname, _string_list_field_from_xml, '{%s}String' % TNS)
                 elif list_type == Attachment:
-                    # Look for both FileAttachment and ItemAttachment
-                    iter_elem = elem.find(cls.response_xml_elem_for_field(fieldname))
-                    if iter_elem is not None:
-                        attachments = []
-                        for att_type in (FileAttachment, ItemAttachment):
-                            attachments.extend(
-                                [att_type.from_xml(e) for e in iter_elem.findall(att_type.response_tag())]
-                            )
-                        kwargs[fieldname] = attachments
+                    step = (fieldname, _attachments_field_from_xml, None)
                 elif issubclass(list_type, EWSElement):
-                    iter_elem = elem.find(cls.response_xml_elem_for_field(fieldname))
-                    if iter_elem is not None:
-                        kwargs[fieldname] = [list_type.from_xml(e) for e in iter_elem.findall(list_type.response_tag())]
+                    step = (fieldname, _list_field_from_xml, list_type)
                 else:
                     assert False, 'Field %s type %s not supported' % (fieldname, field_type)
+            elif field_type in text_types:
+                if fieldname == 'body':
+                    step = (fieldname, _body_field_from_xml, field_type)
+                else:
+                    step = (fieldname, _text_field_from_xml, field_type)
             elif issubclass(field_type, ExtendedProperty):
-                kwargs[fieldname] = field_type.get_value(extended_properties)
+                extended_property_fields.append((fieldname, field_type))
+                continue
+            elif field_type == Mailbox:
+                step = (fieldname, _mailbox_field_from_xml, field_type)
             elif issubclass(field_type, EWSElement):
-                sub_elem = elem.find(cls.response_xml_elem_for_field(fieldname))
-                if sub_elem is not None:
-                    if field_type == Mailbox:
-                        # We want the nested Mailbox, not the wrapper element
-                        kwargs[fieldname] = field_type.from_xml(sub_elem.find(Mailbox.response_tag()))
-                    else:
-                        kwargs[fieldname] = field_type.from_xml(sub_elem)
+                step = (fieldname, _element_field_from_xml, field_type)
             else:
                 assert False, 'Field %s type %s not supported' % (fieldname, field_type)
+            tag = cls.response_xml_elem_for_field(fieldname)
+            assert tag not in tags, (tag, fieldname, tags[tag][0])
+            tags[tag] = step
+        return tags, tuple(extended_property_fields)
+
+    @field_metadata
+    def from_xml_fields(cls):
+        """
+        Returns a {fieldname: (tag, func, arg)} dict for decoding single fields of lazy items. See from_xml_table().
+        Extended properties are decoded from the list of all ExtendedProperty elements, which is stored under their tag.
+        """
+        tags, extended_property_fields = cls.from_xml_table()
+        fields = {fieldname: (tag, func, arg) for tag, (fieldname, func, arg) in tags.items()}
+        for fieldname, field_type in extended_property_fields:
+            fields[fieldname] = (ExtendedProperty.response_tag(), _extended_property_from_xml, field_type)
+        return fields
+
+    @field_metadata
+    def field_defaults(cls):
+        # The values __init__() gives to fields that are not in the XML. Lists must be copied before use.
+        item = cls()
+        return {f: getattr(item, f) for f in cls.fieldnames()}
+
+    @classmethod
+    def from_xml(cls, elem, account=None, folder=None, lazy=False):
+        """
+        If 'lazy' is True, the item keeps its field elements and decodes each field the first time it is accessed.
+        This saves a lot of work when many fields were fetched but only a few are used.
+        """
+        assert elem.tag == cls.response_tag(), (cls, elem.tag, cls.response_tag())
+        if lazy and cls.LAZY_FROM_XML:
+            return cls._lazy_from_xml(elem=elem, account=account, folder=folder)
+        tags, extended_property_fields = cls.from_xml_table()
+        item_id, changekey = None, None
+        item_id_tag, extended_property_tag = ItemId.response_tag(), ExtendedProperty.response_tag()
+        kwargs = {}
+        extended_properties = []
+        # Walk the children of the item element once, and dispatch on the tag
+        for field_elem in elem:
+            tag = field_elem.tag
+            try:
+                fieldname, func, arg = tags[tag]
+            except KeyError:
+                if tag == item_id_tag:
+                    item_id, changekey = field_elem.get(ItemId.ID_ATTR), field_elem.get(ItemId.CHANGEKEY_ATTR)
+                elif tag == extended_property_tag:
+                    extended_properties.append(field_elem)
+                continue
+            func(kwargs, fieldname, field_elem, arg)
+        for fieldname, field_type in extended_property_fields:
+            kwargs[fieldname] = field_type.get_value(extended_properties)
         elem.clear()
         return cls(item_id=item_id, changekey=changekey, account=account, folder=folder, **kwargs)
 
+    @classmethod
+    def _lazy_from_xml(cls, elem, account, folder):
+        item = cls.__new__(cls)
+        item.account, item.folder, item.item_id, item.changekey = account, folder, None, None
+        item_id_tag, extended_property_tag = ItemId.response_tag(), ExtendedProperty.response_tag()
+        field_elems = {}
+        extended_properties = []
+        for field_elem in elem:
+            tag = field_elem.tag
+            if tag == item_id_tag:
+                item.item_id, item.changekey = field_elem.get(ItemId.ID_ATTR), field_elem.get(ItemId.CHANGEKEY_ATTR)
+            elif tag == extended_property_tag:
+                extended_properties.append(field_elem)
+            else:
+                field_elems[tag] = field_elem
+        field_elems[extended_property_tag] = extended_properties
+        item._lazy = field_elems
+        return item
+
+    def __getattr__(self, name):
+        # Only called when regular attribute lookup fails, i.e. for fields of lazy items that have not been decoded yet
+        try:
+            if name.startswith('_') or self._lazy is None:
+                raise KeyError(name)
+            tag, func, arg = self.from_xml_fields()[name]
+        except KeyError:
+            raise AttributeError("'%s' object has no attribute '%s'" % (self.__class__.__name__, name))
+        kwargs = {}
+        field_elem = self._lazy.get(tag)
+        if field_elem is not None:
+            func(kwargs, name, field_elem, arg)
+        try:
+            value = kwargs[name]
+        except KeyError:
+            value = self.field_defaults()[name]
+            if isinstance(value, list):
+                value = list(value)
+        self._check_field(name, value)
+        if name == 'attachments':
+            for a in value:
+                a.parent_item = self
+        setattr(self, name, value)
+        return value
+
+    def _hydrate(self):
+        # Decode the remaining fields of a lazy item
+        if self._lazy is None:
+            return
+        for f in self.from_xml_fields():
+            try:
+                object.__getattribute__(self, f)
+            except AttributeError:
+                getattr(self, f)
+        self._lazy = None
+
     def __eq__(self, other):
         if isinstance(other, tuple):
             item_id, changekey = other
@@ -1299,7 +1503,7 @@ class Item(EWSElement):
 
     def __str__(self):
         return '\n'.join('%s: %s' % (f, getattr(self, f))
-                         for f in ('item_id', 'changekey') + tuple(self.ordered_fieldnames()))
+                         for f in ('item_id', 'changekey') + tuple(self._ordered_fieldnames()))
 
     def __repr__(self):
         return self.__class__.__name__ + '(%s)' % ', '.join(
@@ -1307,31 +1511,83 @@ class Item(EWSElement):
         )
 
 
+# Value types that value_to_xml_text() supports
+_XML_TEXT_TYPES = string_types + (bool, int, Decimal, EWSDateTime)
+
+
+def _text_field_to_xml(item_elem, tag, value, version):
+    # Fields of the types that value_to_xml_text() supports. The plan is chosen by the field type, but values of other
+    # types, e.g. an Element, are serialized by their own type like set_xml_value() does.
+    field_elem = create_element(tag)
+    if isinstance(value, _XML_TEXT_TYPES):
+        field_elem.text = value_to_xml_text(value)
+    else:
+        set_xml_value(field_elem, value, version)
+    item_elem.append(field_elem)
+
+
+def _body_field_to_xml(item_elem, tag, value, version):
+    body_type = HTMLBody.body_type if isinstance(value, HTMLBody) else Body.body_type
+    field_elem = create_element(tag, BodyType=body_type)
+    if isinstance(value, _XML_TEXT_TYPES):
+        field_elem.text = value_to_xml_text(value)
+    else:
+        set_xml_value(field_elem, value, version)
+    item_elem.append(field_elem)
+
+
+def _complex_field_to_xml(item_elem, tag, value, version):
+    # Lists and EWSElement values
+    item_elem.append(set_xml_value(create_element(tag), value, version))
+
+
+def _extended_property_to_xml(item_elem, field_cls, value, version):
+    set_xml_value(item_elem, field_cls(value), version)
+
+
 class ItemMixIn(Item):
+    @field_metadata
+    def to_xml_plan(cls):
+        """
+        Returns the steps to serialize an item of this class as a tuple of (fieldname, func, arg) tuples, in the order
+        Exchange expects the fields. func(item_elem, arg, value, version) adds the XML for a value of the field.
+
+        Field URIs, element names and value types are resolved once per class instead of once per field of every item.
+        """
+        text_types = (bool, int, Decimal, string_type, Choice, Email, AnyURI, MimeContent, EWSDateTime)
+        readonly_fields = cls._readonly_fields()
+        steps = []
+        for f in cls._ordered_fieldnames():
+            assert f not in readonly_fields, (f, readonly_fields)
+            field_uri = cls.fielduri_for_field(f)
+            if isinstance(field_uri, string_types):
+                tag = cls.elem_for_field(f).tag
+                field_type = cls.type_for_field(f)
+                if f == 'body':
+                    steps.append((f, _body_field_to_xml, tag))
+                elif field_type in text_types:
+                    steps.append((f, _text_field_to_xml, tag))
+                else:
+                    steps.append((f, _complex_field_to_xml, tag))
+            elif issubclass(field_uri, IndexedField):
+                steps.append((f, _complex_field_to_xml, 't:%s' % field_uri.PARENT_ELEMENT_NAME))
+            elif issubclass(field_uri, ExtendedProperty):
+                steps.append((f, _extended_property_to_xml, field_uri))
+            else:
+                assert False, 'Unknown field_uri type: %s' % field_uri
+        return tuple(steps)
+
     def to_xml(self, version):
         # WARNING: The order of addition of XML elements is VERY important. Exchange expects XML elements in a
         # specific, non-documented order and will fail with meaningless errors if the order is wrong.
         i = create_element(self.request_tag())
-        for f in self.ordered_fieldnames():
-            assert f not in self.readonly_fields(), (f, self.readonly_fields())
-            field_uri = self.fielduri_for_field(f)
+        for f, func, arg in self.to_xml_plan():
             v = getattr(self, f)
             if v is None:
                 continue
             if isinstance(v, (tuple, list)) and not v:
                 continue
-            if isinstance(field_uri, string_types):
-                field_elem = self.elem_for_field(f)
-                if f == 'body':
-                    body_type = HTMLBody.body_type if isinstance(v, HTMLBody) else Body.body_type
-                    field_elem.set('BodyType', body_type)
-                i.append(set_xml_value(field_elem, v, version))
-            elif issubclass(field_uri, IndexedField):
-                i.append(set_xml_value(create_element('t:%s' % field_uri.PARENT_ELEMENT_NAME), v, version))
-            elif issubclass(field_uri, ExtendedProperty):
-                set_xml_value(i, field_uri(getattr(self, f)), version)
-            else:
-                assert False, 'Unknown field_uri type: %s' % field_uri
+            func(i, arg, v, version)
         return i
 
     @classmethod
@@ -1346,6 +1602,7 @@ class ItemMixIn(Item):
         assert attr_name not in cls.EXTENDED_PROPERTIES
         cls.ITEM_FIELDS[attr_name] = (attr_cls, attr_cls)
         cls.EXTENDED_PROPERTIES.append(attr_name)
+        clear_field_metadata()
 
     @classmethod
     def deregister(cls, attr_name):
@@ -1360,8 +1617,9 @@ class ItemMixIn(Item):
         assert attr_name in cls.EXTENDED_PROPERTIES
         cls.EXTENDED_PROPERTIES.remove(attr_name)
         del cls.ITEM_FIELDS[attr_name]
+        clear_field_metadata()
 
-    @classmethod
+    @field_metadata
     def fieldnames(cls):
         return tuple(cls.ITEM_FIELDS) + Item.fieldnames()
 
@@ -1396,17 +1654,26 @@ class ItemMixIn(Item):
             return '{%s}%s' % (TNS, uri.PARENT_ELEMENT_NAME)
         assert False, 'Unknown uri for fieldname %s: %s' % (fieldname, uri)
 
-    @classmethod
-    def required_fields(cls):
-        return cls.REQUIRED_FIELDS | Item.required_fields()
+    @field_metadata
+    def _required_fields(cls):
+        return frozenset(cls.REQUIRED_FIELDS) | Item._required_fields()
 
-    @classmethod
-    def readonly_fields(cls):
-        return cls.READONLY_FIELDS | Item.readonly_fields()
+    @field_metadata
+    def _readonly_fields(cls):
+        return frozenset(cls.READONLY_FIELDS) | Item._readonly_fields()
+
+    @field_metadata
+    def _readonly_after_send_fields(cls):
+        return frozenset(cls.READONLY_AFTER_SEND_FIELDS) | Item._readonly_after_send_fields()
 
     @classmethod
-    def readonly_after_send_fields(cls):
-        return cls.READONLY_AFTER_SEND_FIELDS | Item.readonly_after_send_fields()
+    def _check_field(cls, fieldname, value):
+        if fieldname in cls.ITEM_FIELDS:
+            if cls.ITEM_FIELDS[fieldname][1] == Choice:
+                assert value is None or value in cls.choices_for_field(fieldname), \
+                    (value, cls.choices_for_field(fieldname))
+            return
+        super(ItemMixIn, cls)._check_field(fieldname, value)
 
     @classmethod
     def choices_for_field(cls, fieldname):
@@ -1462,15 +1729,18 @@ class CalendarItem(ItemMixIn):
         for k in self.ITEM_FIELDS:
             field_type = self.ITEM_FIELDS[k][1]
             default = 'Busy' if k == 'legacy_free_busy_status' \
-                else False if (k in self.required_fields() and field_type == bool) else None
+                else False if (k in self._required_fields() and field_type == bool) else None
             v = kwargs.pop(k, default)
-            if k in ('start', 'end') and v and not getattr(v, 'tzinfo'):
-                raise ValueError("'%s' must be timezone aware" % k)
-            if field_type == Choice:
-                assert v is None or v in self.choices_for_field(k), (v, self.choices_for_field(k))
+            self._check_field(k, v)
             setattr(self, k, v)
         super(CalendarItem, self).__init__(**kwargs)
 
+    @classmethod
+    def _check_field(cls, fieldname, value):
+        if fieldname in ('start', 'end') and value and not getattr(value, 'tzinfo'):
+            raise ValueError("'%s' must be timezone aware" % fieldname)
+        super(CalendarItem, cls)._check_field(fieldname, value)
+
     def to_xml(self, version):
         # WARNING: The order of addition of XML elements is VERY important. Exchange expects XML elements in a
         # specific, non-documented order and will fail with meaningless errors if the order is wrong.
@@ -1520,10 +1790,9 @@ class Message(ItemMixIn):
     def __init__(self, **kwargs):
         for k in self.ITEM_FIELDS:
             field_type = self.ITEM_FIELDS[k][1]
-            default = False if (k in self.required_fields() and field_type == bool) else None
+            default = False if (k in self._required_fields() and field_type == bool) else None
             v = kwargs.pop(k, default)
-            if field_type == Choice:
-                assert v is None or v in self.choices_for_field(k), (v, self.choices_for_field(k))
+            self._check_field(k, v)
             setattr(self, k, v)
         super(Message, self).__init__(**kwargs)
 
@@ -1615,15 +1884,16 @@ class Task(ItemMixIn):
     READONLY_FIELDS = {'is_recurring', 'is_complete', 'is_team_task', 'assigned_time', 'change_count',
                        'delegation_state', 'delegator', 'owner', 'status_description', 'complete_date'}
 
+    LAZY_FROM_XML = False
+
     __slots__ = tuple(ITEM_FIELDS) + tuple(Item.ITEM_FIELDS)
 
     def __init__(self, **kwargs):
         for k in self.ITEM_FIELDS:
             field_type = self.ITEM_FIELDS[k][1]
-            default = False if (k in self.required_fields() and field_type == bool) else None
+            default = False if (k in self._required_fields() and field_type == bool) else None
             v = kwargs.pop(k, default)
-            if field_type == Choice:
-                assert v is None or v in self.choices_for_field(k), (v, self.choices_for_field(k))
+            self._check_field(k, v)
             setattr(self, k, v)
         if self.due_date and self.start_date and self.due_date < self.start_date:
             log.warning("'due_date' must be greater than 'start_date' (%s vs %s). Resetting 'due_date'",
@@ -1718,10 +1988,9 @@ class Contact(ItemMixIn):
     def __init__(self, **kwargs):
         for k in self.ITEM_FIELDS:
             field_type = self.ITEM_FIELDS[k][1]
-            default = False if (k in self.required_fields() and field_type == bool) else None
+            default = False if (k in self._required_fields() and field_type == bool) else None
             v = kwargs.pop(k, default)
-            if field_type == Choice:
-                assert v is None or v in self.choices_for_field(k), (v, self.choices_for_field(k))
+            self._check_field(k, v)
             setattr(self, k, v)
         super(Contact, self).__init__(**kwargs)
 
@@ -1746,7 +2015,7 @@ class MeetingRequest(ItemMixIn):
     def __init__(self, **kwargs):
         for k in self.ITEM_FIELDS:
             field_type = self.ITEM_FIELDS[k][1]
-            default = False if (k in self.required_fields() and field_type == bool) else None
+            default = False if (k in self._required_fields() and field_type == bool) else None
             v = kwargs.pop(k, default)
             setattr(self, k, v)
         super(MeetingRequest, self).__init__(**kwargs)
@@ -1772,7 +2041,7 @@ class MeetingResponse(ItemMixIn):
     def __init__(self, **kwargs):
         for k in self.ITEM_FIELDS:
             field_type = self.ITEM_FIELDS[k][1]
-            default = False if (k in self.required_fields() and field_type == bool) else None
+            default = False if (k in self._required_fields() and field_type == bool) else None
             v = kwargs.pop(k, default)
             setattr(self, k, v)
         super(MeetingResponse, self).__init__(**kwargs)
@@ -1798,7 +2067,7 @@ class MeetingCancellation(ItemMixIn):
     def __init__(self, **kwargs):
         for k in self.ITEM_FIELDS:
             field_type = self.ITEM_FIELDS[k][1]
-            default = False if (k in self.required_fields() and field_type == bool) else None
+            default = False if (k in self._required_fields() and field_type == bool) else None
             v = kwargs.pop(k, default)
             setattr(self, k, v)
         super(MeetingCancellation, self).__init__(**kwargs)
@@ -1908,6 +2177,26 @@ class ItemAttachment(Attachment):
 ITEM_CLASSES = (CalendarItem, Contact, Message, Task, MeetingRequest, MeetingResponse, MeetingCancellation)
 
 
+class ItemDecoder(object):
+    """
+    Decodes item elements with the item classes supported by 'folder_cls'. Can be pickled, so services can decode
+    responses in worker processes (see EWSService._get_elements_decoded()). The items have no account or folder.
+
+    A worker process doesn't know about custom fields that were registered after it started. check() tells if the
+    current process has the same fields as the one that created the decoder.
+    """
+    def __init__(self, folder_cls):
+        assert issubclass(folder_cls, Folder)
+        self.folder_cls = folder_cls
+        self.field_names = folder_cls._allowed_field_names()
+
+    def check(self):
+        return self.folder_cls._allowed_field_names() == self.field_names
+
+    def __call__(self, elem):
+        return self.folder_cls.item_model_from_tag(elem.tag).from_xml(elem=elem)
+
+
 @python_2_unicode_compatible
 class Folder(EWSElement):
     DISTINGUISHED_FOLDER_ID = None  # See https://msdn.microsoft.com/en-us/library/office/aa580808(v=exchg.150).aspx
@@ -1960,17 +2249,25 @@ class Folder(EWSElement):
 
     @classmethod
     def allowed_field_names(cls):
+        return set(cls._allowed_field_names())
+
+    @classmethod
+    def complex_field_names(cls):
+        return set(cls._complex_field_names())
+
+    @field_metadata
+    def _allowed_field_names(cls):
         field_names = set()
         for item_model in cls.supported_item_models:
             field_names.update(item_model.fieldnames())
-        return field_names
+        return frozenset(field_names)
 
-    @classmethod
-    def complex_field_names(cls):
+    @field_metadata
+    def _complex_field_names(cls):
         field_names = set()
         for item_model in cls.supported_item_models:
             field_names.update(item_model.complex_fields())
-        return field_names
+        return frozenset(field_names)
 
     @classmethod
     def additional_property_elems(cls, fieldnames):
@@ -1996,6 +2293,26 @@ class Folder(EWSElement):
                 raise ValueError("No fielduri defined for fieldname '%s'" % f)
         return unique_elems
 
+    @classmethod
+    def additional_properties_xml(cls, fieldnames, version):
+        """
+        Returns the serialized t:AdditionalProperties element for 'fieldnames'. Every page of a paged query and every
+        chunk of a GetItem request asks for the same fields, so the result is cached per folder class, set of field
+        names and API version. Fields are written in sorted order, so the order of 'fieldnames' doesn't matter.
+        """
+        fieldnames = frozenset(fieldnames)
+        key = (cls, fieldnames, version.api_version)
+        xml = _additional_properties_cache.get(key)
+        if xml is None:
+            writer = XMLWriter()
+            writer.start('t:AdditionalProperties')
+            for elem in cls.additional_property_elems(sorted(fieldnames)):
+                writer.element(elem)
+            writer.end('t:AdditionalProperties')
+            xml = writer.getvalue(encoding=None)
+            _additional_properties_cache[key] = xml
+        return xml
+
     @classmethod
     def fielduri_for_field(cls, fieldname):
         for item_model in cls.supported_item_models:
@@ -2029,6 +2346,8 @@ class Folder(EWSElement):
 
         'depth' controls the whether to return soft-deleted items or not.
 
+        'lazy' controls whether the fields of items are decoded up-front or on first access. See Item.from_xml()
+
         Non-keyword args may be a search expression as supported by Restriction.from_source(), or a list of Q instances.
 
         Optional extra keyword arguments follow a Django-like QuerySet filter syntax (see
@@ -2055,14 +2374,15 @@ class Folder(EWSElement):
 
         shape = kwargs.pop('shape', IdOnly)
         depth = kwargs.pop('depth', SHALLOW)
+        lazy = kwargs.pop('lazy', False)
         assert shape in SHAPE_CHOICES
         assert depth in ITEM_TRAVERSAL_CHOICES
 
         # Define the extra properties we want on the return objects
         additional_fields = kwargs.pop('additional_fields', tuple())
         if additional_fields:
-            allowed_field_names = self.allowed_field_names()
-            complex_field_names = self.complex_field_names()
+            allowed_field_names = self._allowed_field_names()
+            complex_field_names = self._complex_field_names()
             for f in additional_fields:
                 if f not in allowed_field_names:
                     raise ValueError("'%s' is not a field on %s" % (f, self.supported_item_models))
@@ -2097,7 +2417,7 @@ class Folder(EWSElement):
         if shape == IdOnly and additional_fields is None:
             return map(Item.id_from_xml, items)
         return map(
-            lambda i: self.item_model_from_tag(i.tag).from_xml(elem=i, account=self.account, folder=self),
+            lambda i: self.item_model_from_tag(i.tag).from_xml(elem=i, account=self.account, folder=self, lazy=lazy),
             items
         )
 
@@ -2262,7 +2582,6 @@ class CalendarView(EWSElement):
 
     def to_xml(self, version):
         elem = create_element(self.request_tag())
-        # Use .set() to not fill up the create_element() cache with unique values
         elem.set('StartDate', value_to_xml_text(self.start.astimezone(UTC)))
         elem.set('EndDate', value_to_xml_text(self.end.astimezone(UTC)))
         if self.max_items is not None:
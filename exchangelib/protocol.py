@@ -8,24 +8,29 @@ when creating an Account.
 from __future__ import unicode_literals
 
 import logging
-import random
 import socket
-from multiprocessing.pool import ThreadPool
-from threading import Lock
+import sys
+import time
+from collections import deque
+from threading import Lock, Condition, Thread
 
 import queue
 from future.utils import with_metaclass, python_2_unicode_compatible, raise_from
-from requests import adapters, Session
-from six import text_type
+from six import reraise
 
 from .credentials import Credentials
 from .errors import TransportError
+from .executor import SharedExecutor, ExecutorQuota
+from .sessions import new_session
+from .tuning import ChunkSizeTuner
 from .transport import get_auth_instance, get_service_authtype, get_docs_authtype, test_credentials, AUTH_TYPE_MAP
-from .util import split_url
-from .version import Version, API_VERSIONS
+from .util import split_url, locked_shelve_open, user_cache_file
+from .version import Build, Version, API_VERSIONS
 
 log = logging.getLogger(__name__)
 
+ENDPOINT_PERSISTENT_STORAGE = user_cache_file('endpoints')
+
 
 def close_connections():
     for key, protocol in CachingProtocol._protocol_cache.items():
@@ -36,6 +41,120 @@ def close_connections():
     CachingProtocol._protocol_cache.clear()
 
 
+class EndpointCache(object):
+    """
+    Persists what we learned about a service endpoint by probing it: the auth types of the service and the docs, and the
+    server version. Also persists the server versions of accounts that differ from the version of their endpoint. This
+    allows a new process to create a usable Protocol for a known endpoint with a single request, which checks the
+    credentials and the server version.
+
+    Entries expire after TTL seconds. They are deleted when the server tells us they are wrong, i.e. when we get a 401
+    or no API version works for an account.
+
+    Like the autodiscover cache, the persistent storage could be readable by unprivileged users, so we never store any
+    credentials info. Only endpoint URLs, auth types, versions and the email addresses of accounts with a deviating
+    version.
+
+    The cache is best-effort. If the storage file can't be read or written, e.g. because it is corrupt, we log the error
+    and treat it as a cache miss. The file is private to the current user and locked while in use, so processes don't
+    corrupt it.
+    """
+    TTL = 24 * 3600  # Seconds
+
+    def __init__(self):
+        self._lock = Lock()
+
+    @property
+    def _storage_file(self):
+        return ENDPOINT_PERSISTENT_STORAGE
+
+    @staticmethod
+    def _endpoint_key(service_endpoint):
+        return str(service_endpoint)
+
+    @staticmethod
+    def _account_key(service_endpoint, primary_smtp_address):
+        return str('%s %s' % (service_endpoint, primary_smtp_address.lower()))
+
+    @staticmethod
+    def _dump_version(version):
+        # Don't pickle Version objects. Stored entries should survive changes to the class.
+        b = version.build
+        return (b.major_version, b.minor_version, b.major_build, b.minor_build), version.api_version
+
+    @staticmethod
+    def _load_version(value):
+        build, api_version = value
+        return Version(build=Build(*build), api_version=api_version)
+
+    def _get(self, key):
+        try:
+            with self._lock:
+                with locked_shelve_open(self._storage_file) as db:
+                    value = db.get(key)
+        except Exception as e:
+            # E.g. the file is corrupt or can't be opened
+            log.warning('Could not read endpoint cache %s: %s', self._storage_file, e)
+            return None
+        if value is None:
+            return None
+        timestamp, value = value
+        if time.time() - timestamp > self.TTL:
+            return None
+        return value
+
+    def _set(self, key, value):
+        try:
+            with self._lock:
+                with locked_shelve_open(self._storage_file) as db:
+                    db[key] = (time.time(), value)
+        except Exception as e:
+            log.warning('Could not write endpoint cache %s: %s', self._storage_file, e)
+
+    def get(self, service_endpoint):
+        # Returns an (auth_type, docs_auth_type, version) tuple, or None
+        value = self._get(self._endpoint_key(service_endpoint))
+        if value is None:
+            return None
+        auth_type, docs_auth_type, version = value
+        return auth_type, docs_auth_type, self._load_version(version)
+
+    def set(self, service_endpoint, auth_type, docs_auth_type, version):
+        self._set(self._endpoint_key(service_endpoint), (auth_type, docs_auth_type, self._dump_version(version)))
+
+    def get_account_version(self, service_endpoint, primary_smtp_address):
+        value = self._get(self._account_key(service_endpoint, primary_smtp_address))
+        if value is None:
+            return None
+        return self._load_version(value)
+
+    def set_account_version(self, service_endpoint, primary_smtp_address, version):
+        self._set(self._account_key(service_endpoint, primary_smtp_address), self._dump_version(version))
+
+    def delete(self, service_endpoint):
+        # Delete the endpoint entry and all account entries of the endpoint
+        endpoint_key = self._endpoint_key(service_endpoint)
+        try:
+            with self._lock:
+                with locked_shelve_open(self._storage_file) as db:
+                    for key in list(db.keys()):
+                        if key == endpoint_key or key.startswith(endpoint_key + ' '):
+                            del db[key]
+        except Exception as e:
+            log.warning('Could not write endpoint cache %s: %s', self._storage_file, e)
+
+    def clear(self):
+        try:
+            with self._lock:
+                with locked_shelve_open(self._storage_file) as db:
+                    db.clear()
+        except Exception as e:
+            log.warning('Could not write endpoint cache %s: %s', self._storage_file, e)
+
+
+endpoint_cache = EndpointCache()
+
+
 class BaseProtocol(object):
     # Base class for Protocol which implements the bare essentials
 
@@ -43,6 +162,15 @@ class BaseProtocol(object):
     # low unless you have an agreement with the Exchange admin on the receiving end to hammer the server and
     # rate-limiting policies have been disabled for the connecting user.
     SESSION_POOLSIZE = 4
+    # The session pool starts out with SESSION_POOLSIZE sessions. The number of sessions that may be used concurrently
+    # is adjusted at runtime by a SessionPoolController: it shrinks when the server tells us to back off and grows
+    # while the server is healthy. It never grows beyond MAX_SESSION_POOLSIZE. If this is None, the limit is twice
+    # SESSION_POOLSIZE. Set it to SESSION_POOLSIZE to never use more sessions than that. The same warning as above
+    # applies before raising this.
+    MAX_SESSION_POOLSIZE = None
+    # Pooled services send items in chunks of CHUNKSIZE items per request. If this is True, the chunk size for each
+    # service is instead tuned at runtime for best throughput, and persisted per endpoint. See tuning.ChunkSizeTuner.
+    AUTOTUNE_CHUNKSIZE = False
     # We want only 1 TCP connection per Session object. We may have lots of different credentials hitting the server and
     # each credential needs its own session (NTLM auth will only send credentials once and then secure the connection,
     # so a connection can only handle requests for one credential). Having multiple connections ser Session could
@@ -50,6 +178,14 @@ class BaseProtocol(object):
     CONNECTIONS_PER_SESSION = 1
     # Timeout for HTTP requests
     TIMEOUT = 120
+    # Pooled services run their requests in worker threads of an executor that is shared by all protocols in the process
+    # (see executor.SharedExecutor). This is the maximum number of worker threads one protocol may use at a time. It
+    # should be larger than the session pool, so we have time to process data without idling the connections. If None,
+    # this is 4 times the maximum number of sessions.
+    MAX_WORKER_THREADS = None
+    # If True, Account.fetch() decodes items in the worker processes of executor.SharedProcessPool instead of in this
+    # process. Decoding many items is CPU-bound and holds the GIL, so this lets one process use more than one CPU.
+    PARSE_IN_PROCESSES = False
 
     def __init__(self, service_endpoint, credentials, auth_type, verify_ssl):
         assert isinstance(credentials, Credentials)
@@ -61,6 +197,12 @@ class BaseProtocol(object):
         self.auth_type = auth_type
         self.verify_ssl = verify_ssl
         self._session_pool = None  # Consumers need to fill the session pool themselves
+        self._sessions_in_use = 0
+        self._session_pool_cond = Condition()
+        self.pool_controller = SessionPoolController(
+            initial=self.SESSION_POOLSIZE,
+            maximum=self.MAX_SESSION_POOLSIZE or 2 * self.SESSION_POOLSIZE,
+        )
 
     def __del__(self):
         try:
@@ -77,21 +219,57 @@ class BaseProtocol(object):
             except (queue.Empty, ReferenceError, AttributeError):
                 break
 
+    def _create_session_pool(self, session=None):
+        # Called by consumers when they are ready to create sessions. 'session' is an existing session to add to the
+        # pool, e.g. one that already has an open connection to the server.
+        self._session_pool = queue.LifoQueue(maxsize=self.pool_controller.maximum)
+        for _ in range(self.SESSION_POOLSIZE if session is None else self.SESSION_POOLSIZE - 1):
+            self._session_pool.put(self.create_session(), block=False)
+        if session is not None:
+            # Put it last, so it's the first session to be used
+            self._session_pool.put(session, block=False)
+
+    def invalidate_cached_metadata(self):
+        # Called when the server tells us that something we know about it is wrong, e.g. the auth type
+        log.debug('Server %s: Deleting cached endpoint metadata', self.server)
+        endpoint_cache.delete(self.service_endpoint)
+
     def get_session(self):
         _timeout = 60  # Rate-limit messages about session starvation
-        while True:
+        log.debug('Server %s: Waiting for session', self.server)
+        with self._session_pool_cond:
+            while self._sessions_in_use >= self.pool_controller.concurrency:
+                # This is normal when we have many worker threads starving for available sessions
+                if not self._session_pool_cond.wait(_timeout):
+                    log.debug('Server %s: No sessions available for %s seconds', self.server, _timeout)
+            self._sessions_in_use += 1
+        try:
             try:
-                log.debug('Server %s: Waiting for session', self.server)
-                session = self._session_pool.get(timeout=_timeout)
-                log.debug('Server %s: Got session %s', self.server, session.session_id)
-                return session
+                session = self._session_pool.get(block=False)
             except queue.Empty:
-                # This is normal when we have many worker threads starving for available sessions
-                log.debug('Server %s: No sessions available for %s seconds', self.server, _timeout)
+                # The controller allows more concurrent sessions than we have created so far
+                session = self.create_session()
+        except Exception:
+            # Give the slot back, or callers waiting for a session would wait forever
+            with self._session_pool_cond:
+                self._sessions_in_use -= 1
+                self._session_pool_cond.notify()
+            raise
+        log.debug('Server %s: Got session %s', self.server, session.session_id)
+        return session
 
     def release_session(self, session):
-        # This should never fail, as we don't have more sessions than the queue contains
         log.debug('Server %s: Releasing session %s', self.server, session.session_id)
+        with self._session_pool_cond:
+            self._sessions_in_use -= 1
+            # The controller may have lowered the limit while the session was in use. Don't keep more connections to
+            # the server open than we are allowed to use.
+            surplus = self._sessions_in_use + self._session_pool.qsize() >= self.pool_controller.concurrency
+            self._session_pool_cond.notify()
+        if surplus:
+            log.debug('Server %s: Closing surplus session %s', self.server, session.session_id)
+            session.close_socket(self.service_endpoint)
+            return
         try:
             self._session_pool.put(session, block=False)
         except queue.Full:
@@ -112,19 +290,10 @@ class BaseProtocol(object):
         return self.create_session()
 
     def create_session(self):
-        session = EWSSession(self)
-        session.auth = get_auth_instance(credentials=self.credentials, auth_type=self.auth_type)
-        # Leave this inside the loop because headers are mutable
-        headers = {'Content-Type': 'text/xml; charset=utf-8', 'Accept-Encoding': 'compress, gzip'}
-        session.headers.update(headers)
-        scheme = 'https' if self.has_ssl else 'http'
-        # We want just one connection per session. No retries, since we wrap all requests in our own retry handler
-        session.mount('%s://' % scheme, adapters.HTTPAdapter(
-            pool_block=True,
-            pool_connections=self.CONNECTIONS_PER_SESSION,
-            pool_maxsize=self.CONNECTIONS_PER_SESSION,
-            max_retries=0
-        ))
+        session = new_session(protocol=self)
+        if self.auth_type is not None:
+            # The auth type is unknown while Protocol.__init__ probes the server for it
+            session.auth = get_auth_instance(credentials=self.credentials, auth_type=self.auth_type)
         log.debug('Server %s: Created session %s', self.server, session.session_id)
         return session
 
@@ -170,6 +339,64 @@ class CachingProtocol(type):
         return protocol
 
 
+class SessionPoolController(object):
+    """
+    Controls the number of sessions that may be in use concurrently, using AIMD (additive increase, multiplicative
+    decrease) like TCP congestion control. Every successful request grows the limit by 1/limit, i.e. by one session per
+    round of requests. When the server signals that it is overloaded (ErrorServerBusy, ErrorTooManyObjectsOpened, HTTP
+    503) or the p95 response time rises well above what we have seen before, the limit is halved.
+    """
+    # Number of response times to calculate the p95 response time from
+    LATENCY_WINDOW = 50
+    # Back off when the p95 response time exceeds the baseline p95 by this factor
+    LATENCY_THRESHOLD = 2.0
+    DECREASE_FACTOR = 0.5
+
+    def __init__(self, initial, maximum, minimum=1):
+        assert 1 <= minimum <= initial <= maximum
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = float(initial)
+        self._latencies = deque(maxlen=self.LATENCY_WINDOW)
+        self._baseline = None  # Baseline p95 response time
+        self._last_decrease = 0
+        self._lock = Lock()
+
+    @property
+    def concurrency(self):
+        return int(self.limit)
+
+    def success(self, started, response_time):
+        # Register a response that did not signal overload. 'started' is the time.time() when the request was sent
+        with self._lock:
+            self._latencies.append(response_time)
+            if len(self._latencies) == self.LATENCY_WINDOW:
+                p95 = sorted(self._latencies)[int(0.95 * (self.LATENCY_WINDOW - 1))]
+                self._latencies.clear()
+                if self._baseline is None or p95 < self._baseline:
+                    self._baseline = p95
+                elif p95 > self.LATENCY_THRESHOLD * self._baseline:
+                    log.debug('p95 response time rose from %.2f to %.2f seconds', self._baseline, p95)
+                    # Let the baseline follow slowly, so a permanently slower server doesn't pin us at the minimum
+                    self._baseline = 0.9 * self._baseline + 0.1 * p95
+                    self._decrease(started)
+                    return
+            self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+
+    def throttled(self, started):
+        # Register a response that signaled overload
+        with self._lock:
+            self._decrease(started)
+
+    def _decrease(self, started):
+        if started < self._last_decrease:
+            # The request was sent before we last backed off, so we already reacted to this congestion
+            return
+        self.limit = max(self.minimum, self.limit * self.DECREASE_FACTOR)
+        self._last_decrease = time.time()
+        log.info('Lowered session pool limit to %s', self.concurrency)
+
+
 @python_2_unicode_compatible
 class Protocol(with_metaclass(CachingProtocol, BaseProtocol)):
     def __init__(self, *args, **kwargs):
@@ -180,25 +407,93 @@ class Protocol(with_metaclass(CachingProtocol, BaseProtocol)):
         self.messages_url = '%s://%s/EWS/messages.xsd' % (scheme, self.server)
         self.types_url = '%s://%s/EWS/types.xsd' % (scheme, self.server)
 
-        # Autodetect authentication type if necessary
+        # Used by services to process service requests that are able to run in parallel. Threads are shared with other
+        # protocols and only started when there is work to do.
+        self.thread_pool = ExecutorQuota(
+            executor=SharedExecutor.get_instance(),
+            max_tasks=self.MAX_WORKER_THREADS or 4 * self.pool_controller.maximum,
+        )
+        self._chunksize_tuners = {}
+        self._chunksize_tuners_lock = Lock()
+
+        cached = endpoint_cache.get(self.service_endpoint)
+        if cached is None:
+            self._probe()
+            endpoint_cache.set(service_endpoint=self.service_endpoint, auth_type=self.auth_type,
+                               docs_auth_type=self.docs_auth_type, version=self.version)
+        else:
+            log.debug('Server %s: Using cached endpoint metadata', self.server)
+            auth_type, self.docs_auth_type, version = cached
+            if self.auth_type is None:
+                self.auth_type = auth_type
+            self._create_session_pool()
+            # Probing checks the credentials, so we do that here too. Asking for the version is a cheap way to do it.
+            # Start with the cached API version, so this is a single request unless the server has changed.
+            self.version = Version.guess_with_hint(protocol=self, api_version=version.api_version)
+            if (self.version.build, self.version.api_version) != (version.build, version.api_version):
+                self.cache_version(version=self.version)
+
+    def _probe(self):
+        # Ask the server for what we need to know about it. Probing the server takes a chain of round trips. The
+        # requests for docs don't depend on the requests to the service endpoint, so send them in a separate thread.
+        self.docs_auth_type = None
+        self._docs_shortname = None
+        self._docs_probe_exc_info = None
+        docs_probe = Thread(target=self._probe_docs)
+        docs_probe.daemon = True
+        docs_probe.start()
+
+        # Autodetect authentication type if necessary. Use a session that we add to the session pool afterwards, so the
+        # connection it opened is reused when we ask the server for its version.
+        session = self.create_session()
         if self.auth_type is None:
             self.auth_type = get_service_authtype(service_endpoint=self.service_endpoint, versions=API_VERSIONS,
-                                                  verify=self.verify_ssl)
-        self.docs_auth_type = get_docs_authtype(verify=self.verify_ssl, docs_url=self.types_url)
+                                                  verify=self.verify_ssl, session=session)
+            session.auth = get_auth_instance(credentials=self.credentials, auth_type=self.auth_type)
 
         # Try to behave nicely with the Exchange server. We want to keep the connection open between requests.
         # We also want to re-use sessions, to avoid the NTLM auth handshake on every request.
-        self._session_pool = queue.LifoQueue(maxsize=self.SESSION_POOLSIZE)
-        for _ in range(self.SESSION_POOLSIZE):
-            self._session_pool.put(self.create_session(), block=False)
+        self._create_session_pool(session=session)
 
-        # Used by services to process service requests that are able to run in parallel. Thread pool should be
-        # larger than connection the pool so we have time to process data without idling the connection.
-        thread_poolsize = 4 * self.SESSION_POOLSIZE
-        self.thread_pool = ThreadPool(processes=thread_poolsize)
+        docs_probe.join()
+        if self._docs_probe_exc_info is not None:
+            reraise(*self._docs_probe_exc_info)
 
         # Needs auth objects and a working session pool
-        self.version = Version.guess(self)
+        self.version = Version.guess_with_hint(protocol=self, shortname=self._docs_shortname)
+
+    def _probe_docs(self):
+        # Runs in a separate thread. Gets the auth type for docs and the server version from types.xsd, using one
+        # connection.
+        try:
+            with new_session() as s:
+                self.docs_auth_type = get_docs_authtype(docs_url=self.types_url, verify=self.verify_ssl, session=s)
+                self._docs_shortname = Version.get_shortname(protocol=self, session=s)
+        except Exception:
+            self._docs_probe_exc_info = sys.exc_info()
+
+    def cache_version(self, version, account=None):
+        # Persist a server version we learned from the server. If 'account' is set, the version only applies to that
+        # account.
+        if account is None:
+            endpoint_cache.set(service_endpoint=self.service_endpoint, auth_type=self.auth_type,
+                               docs_auth_type=self.docs_auth_type, version=version)
+        else:
+            endpoint_cache.set_account_version(service_endpoint=self.service_endpoint,
+                                               primary_smtp_address=account.primary_smtp_address, version=version)
+
+    def get_cached_version(self, account):
+        # Returns the persisted server version of 'account', if it differs from the version of the endpoint
+        return endpoint_cache.get_account_version(service_endpoint=self.service_endpoint,
+                                                  primary_smtp_address=account.primary_smtp_address)
+
+    def get_chunksize_tuner(self, service_cls):
+        with self._chunksize_tuners_lock:
+            tuner = self._chunksize_tuners.get(service_cls.SERVICE_NAME)
+            if tuner is None:
+                tuner = ChunkSizeTuner(service_endpoint=self.service_endpoint, service_cls=service_cls)
+                self._chunksize_tuners[service_cls.SERVICE_NAME] = tuner
+        return tuner
 
     def __str__(self):
         return '''\
@@ -215,32 +510,3 @@ XSD auth: %s''' % (
             self.auth_type,
             self.docs_auth_type,
         )
-
-
-class EWSSession(Session):
-    # A requests Session object that closes the underlying socket when we need it
-    def __init__(self, protocol):
-        self.session_id = random.randint(1, 32767)  # Used for debugging messages in services
-        self.protocol = protocol
-        super(EWSSession, self).__init__()
-
-    def close_socket(self, url):
-        # Close underlying socket. This ensures we don't leave stray sockets around after program exit.
-        adapter = self.get_adapter(url)
-        pool = adapter.get_connection(url)
-        for i in range(pool.pool.qsize()):
-            conn = pool._get_conn()
-            if conn.sock:
-                log.debug('Closing socket %s', text_type(conn.sock.getsockname()))
-                conn.sock.shutdown(socket.SHUT_RDWR)
-                conn.sock.close()
-
-    def __enter__(self):
-        return super(EWSSession, self).__enter__()
-
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        if exc_type is None:
-            self.protocol.release_session(self)
-        else:
-            self.protocol.retire_session(self)
-        # return super().__exit__()  # We want to close the session socket explicitly
@@ -2,7 +2,6 @@
 from __future__ import unicode_literals
 
 import logging
-from copy import deepcopy
 from operator import attrgetter
 
 from future.utils import python_2_unicode_compatible
@@ -44,6 +43,7 @@ class QuerySet(object):
         self.reversed = False
         self.return_format = self.NONE
         self.calendar_view = None
+        self.lazy_items = False
 
         self._cache = None
 
@@ -62,33 +62,34 @@ class QuerySet(object):
         assert isinstance(self.order_fields, (type(None), tuple))
         assert self.reversed in (True, False)
         assert self.return_format in self.RETURN_TYPES
-        # Only mutable objects need to be deepcopied. Folder should be the same object
+        # Folder should be the same object. Q objects are immutable, so they can be shared too
         new_qs = self.__class__(self.folder)
-        new_qs.q = None if self.q is None else deepcopy(self.q)
+        new_qs.q = self.q
         new_qs.only_fields = self.only_fields
         new_qs.order_fields = self.order_fields
         new_qs.reversed = self.reversed
         new_qs.return_format = self.return_format
         new_qs.calendar_view = self.calendar_view
+        new_qs.lazy_items = self.lazy_items
         return new_qs
 
     def _check_fields(self, field_names):
-        allowed_field_names = set(self.folder.allowed_field_names()) | {'item_id', 'changekey'}
+        allowed_field_names = self.folder._allowed_field_names()
         for f in field_names:
             if not isinstance(f, string_types):
                 raise ValueError("Fieldname '%s' must be a string" % f)
-            if f not in allowed_field_names:
+            if f not in allowed_field_names and f not in ('item_id', 'changekey'):
                 raise ValueError("Unknown fieldname '%s'" % f)
 
     def _query(self):
         if self.only_fields is None:
             # The list of fields was not restricted. Get all fields we support, as a set
-            additional_fields = self.folder.allowed_field_names()
+            additional_fields = set(self.folder._allowed_field_names())
         else:
             assert isinstance(self.only_fields, tuple)
             # Remove ItemId and ChangeKey. We get them unconditionally
             additional_fields = {f for f in self.only_fields if f not in {'item_id', 'changekey'}}
-        complex_fields_requested = bool(additional_fields & self.folder.complex_field_names())
+        complex_fields_requested = bool(additional_fields & self.folder._complex_field_names())
         if self.order_fields:
             extra_order_fields = {f.lstrip('-') for f in self.order_fields} - additional_fields
         else:
@@ -104,13 +105,16 @@ class QuerySet(object):
             return self.folder.find_items(
                 self.q, additional_fields=None, shape=IdOnly, calendar_view=self.calendar_view)
         if complex_fields_requested:
-            # The FindItems service does not support complex field types. Fallback to getting ids and calling GetItems
-            ids = self.folder.find_items(
-                self.q, additional_fields=None, shape=IdOnly, calendar_view=self.calendar_view)
-            items = self.folder.fetch(ids=ids, only_fields=additional_fields)
+            # The FindItems service does not support complex field types. Fallback to getting ids and calling GetItems.
+            # Get all ids before calling GetItems. The FindItem response holds its session until it is consumed, and
+            # GetItems may not get a session of its own until then.
+            ids = list(self.folder.find_items(
+                self.q, additional_fields=None, shape=IdOnly, calendar_view=self.calendar_view))
+            items = self.folder.fetch(ids=ids, only_fields=additional_fields, lazy=self.lazy_items)
         else:
             items = self.folder.find_items(
-                self.q, additional_fields=additional_fields, shape=IdOnly, calendar_view=self.calendar_view)
+                self.q, additional_fields=additional_fields, shape=IdOnly, calendar_view=self.calendar_view,
+                lazy=self.lazy_items)
         if self.order_fields:
             assert isinstance(self.order_fields, tuple)
             # Sorting in Python is stable, so when we search on multiple fields, we can do a sort on each of the
@@ -138,12 +142,20 @@ class QuerySet(object):
             else:
                 # TODO: This is still eager processing
                 self._cache = list(self._query())
-        cache_iter = iter(self._cache)
+        return self._format_items(iter(self._cache))
+
+    def __aiter__(self):
+        # Support 'async for item in qs' on Python 3.5+. The asyncio machinery lives in a separate module because it
+        # uses syntax that Python 2 can't parse.
+        from .aio import AsyncQuerySetIterator
+        return AsyncQuerySetIterator(self)
+
+    def _format_items(self, items):
         return {
-            self.VALUES: lambda: self.as_values(cache_iter),
-            self.VALUES_LIST: lambda: self.as_values_list(cache_iter),
-            self.FLAT: lambda: self.as_flat_values_list(cache_iter),
-            self.NONE: lambda: cache_iter,
+            self.VALUES: lambda: self.as_values(items),
+            self.VALUES_LIST: lambda: self.as_values_list(items),
+            self.FLAT: lambda: self.as_flat_values_list(items),
+            self.NONE: lambda: items,
         }[self.return_format]()
 
     def __len__(self):
@@ -266,6 +278,13 @@ class QuerySet(object):
         new_qs.order_fields = args
         return new_qs
 
+    def lazy(self):
+        # Decode the fields of the returned items on first access instead of up-front. Useful when many fields are
+        # fetched but only a few of them are used.
+        new_qs = self.copy()
+        new_qs.lazy_items = True
+        return new_qs
+
     def reverse(self):
         new_qs = self.copy()
         if not self.order_fields:
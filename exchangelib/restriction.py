@@ -1,23 +1,38 @@
 # coding=utf-8
 from __future__ import unicode_literals
 
+import ast
 import functools
 import logging
-from threading import Lock
+import sys
 
 from future.utils import python_2_unicode_compatible
+from six import string_types
 
 from .ewsdatetime import EWSDateTime, UTC
-from .util import create_element, xml_to_str, value_to_xml_text
+from .util import create_element, xml_to_str, value_to_xml_text, LRUCache
 
 log = logging.getLogger(__name__)
 
-_source_cache = dict()
-_source_cache_lock = Lock()
+# Translated Q objects parsed from search expressions, keyed by (folder class, source). See Restriction.from_source()
+# and Restriction.set_source_cache_size().
+_source_cache = LRUCache(maxsize=1000)
+# Serialized Restriction elements, keyed by the repr() of the translated Q object. See Q.to_xml_str()
+_xml_cache = LRUCache(maxsize=1000)
+
+
+def _restore_q(cls, conn_type, field, op, value, children, translated):
+    # Unpickles a Q object. See Q.__reduce__()
+    return cls._new(conn_type=conn_type, field=field, op=op, value=value, children=children, translated=translated)
 
 
 @python_2_unicode_compatible
 class Q(object):
+    """
+    A node in a tree of search restrictions. Q objects are immutable: operators, translate_fields() etc. return new
+    objects that share the unchanged parts of the tree, so a Q object can safely be shared by many QuerySets and
+    threads without copying.
+    """
     # Connection types
     AND = 'AND'
     OR = 'OR'
@@ -55,21 +70,15 @@ class Q(object):
     LOOKUP_STARTSWITH = 'startswith'
     LOOKUP_ISTARTSWITH = 'istartswith'
 
-    def __init__(self, *args, **kwargs):
-        if 'conn_type' in kwargs:
-            self.conn_type = kwargs.pop('conn_type')
-        else:
-            self.conn_type = self.AND
-        assert self.conn_type in self.CONN_TYPES
+    __slots__ = ('conn_type', 'field', 'op', 'value', 'children', 'translated')
 
-        self.translated = False  # Make sure we don't translate field names twice
-
-        self.field = None
-        self.op = None
-        self.value = None
+    def __init__(self, *args, **kwargs):
+        conn_type = kwargs.pop('conn_type', self.AND)
+        assert conn_type in self.CONN_TYPES
+        field, op, value = None, None, None
 
         # Build children of Q objects from *args and **kwargs
-        self.children = []
+        children = []
         for q in args:
             if not isinstance(q, self.__class__):
                 if isinstance(q, Restriction):
@@ -77,7 +86,7 @@ class Q(object):
                 else:
                     raise AttributeError("'%s' must be a Q or Restriction instance" % q)
             if not q.is_empty():
-                self.children.append(q)
+                children.append(q)
 
         for key, value in kwargs.items():
             if '__' in key:
@@ -85,15 +94,15 @@ class Q(object):
                 if lookup == self.LOOKUP_RANGE:
                     # EWS doesn't have a 'range' operator. Emulate 'foo__range=(1, 2)' as 'foo__gte=1 and foo__lte=2'
                     # (both values inclusive).
-                    self.children.append(self.__class__(**{'%s__gte' % field: value[0]}))
-                    self.children.append(self.__class__(**{'%s__lte' % field: value[1]}))
+                    children.append(self.__class__(**{'%s__gte' % field: value[0]}))
+                    children.append(self.__class__(**{'%s__lte' % field: value[1]}))
                     continue
                 if lookup == self.LOOKUP_IN:
                     # EWS doesn't have an 'in' operator. Emulate 'foo in (1, 2, ...)' as 'foo==1 or foo==2 or ...'
                     or_args = []
                     for val in value:
                         or_args.append(self.__class__(**{field: val}))
-                    self.children.append(Q(*or_args, conn_type=self.OR))
+                    children.append(Q(*or_args, conn_type=self.OR))
                     continue
                 else:
                     op = self._lookup_to_op(lookup)
@@ -101,17 +110,50 @@ class Q(object):
                 field, op = key, self.EQ
             assert op in self.OP_TYPES
             if len(args) == 0 and len(kwargs) == 1:
-                self.field = field
-                self.op = op
                 if isinstance(value, EWSDateTime):
                     # We want to convert all values to UTC
                     if not getattr(value, 'tzinfo'):
                         raise ValueError("'%s' must be timezone aware" % field)
-                    self.value = value.astimezone(UTC)
-                else:
-                    self.value = value
+                    value = value.astimezone(UTC)
             else:
-                self.children.append(Q(**{key: value}))
+                children.append(Q(**{key: value}))
+                field, op, value = None, None, None
+
+        self._init(conn_type=conn_type, field=field, op=op, value=value, children=tuple(children), translated=False)
+
+    def _init(self, conn_type, field, op, value, children, translated):
+        # 'translated' makes sure we don't translate field names twice
+        for k, v in (('conn_type', conn_type), ('field', field), ('op', op), ('value', value), ('children', children),
+                     ('translated', translated)):
+            object.__setattr__(self, k, v)
+
+    @classmethod
+    def _new(cls, conn_type, field, op, value, children, translated):
+        # Create a Q object directly from its attributes
+        q = cls.__new__(cls)
+        q._init(conn_type=conn_type, field=field, op=op, value=value, children=children, translated=translated)
+        return q
+
+    def _replace(self, **kwargs):
+        # Return a copy of this Q object with some attributes changed. Children are shared, not copied.
+        for k in self.__slots__:
+            kwargs.setdefault(k, getattr(self, k))
+        return self._new(**kwargs)
+
+    def __setattr__(self, key, value):
+        raise AttributeError('Q objects are immutable')
+
+    def __delattr__(self, key):
+        raise AttributeError('Q objects are immutable')
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __reduce__(self):
+        return _restore_q, (self.__class__,) + tuple(getattr(self, k) for k in self.__slots__)
 
     @classmethod
     def from_filter_args(cls, folder_class, *args, **kwargs):
@@ -121,8 +163,8 @@ class Q(object):
             q_args = []
             for arg in args:
                 # Convert all search expressions to q objects
-                if isinstance(arg, str):
-                    q_args.append(Restriction.from_source(args[0], folder_class=folder_class).q)
+                if isinstance(arg, string_types):
+                    q_args.append(Restriction.from_source(arg, folder_class=folder_class).q)
                 else:
                     if not isinstance(arg, Q):
                         raise ValueError("Non-keyword arg '%s' must be a Q object" % arg)
@@ -284,32 +326,48 @@ class Q(object):
         return expr
 
     def translate_fields(self, folder_class):
-        # Recursively translate Python attribute names to EWS FieldURI values
+        # Return a copy of this Q object with Python attribute names recursively translated to EWS FieldURI values
         if self.translated:
             return self
-        if self.field is not None:
-            if self.field in folder_class.complex_field_names():
-                raise ValueError("Complex field '%s' does not support filtering" % self.field)
-            self.field = folder_class.fielduri_for_field(self.field)
-        for c in self.children:
-            c.translate_fields(folder_class=folder_class)
-        self.translated = True
-        return self
+        field = self.field
+        if field is not None:
+            if field in folder_class._complex_field_names():
+                raise ValueError("Complex field '%s' does not support filtering" % field)
+            field = folder_class.fielduri_for_field(field)
+        children = tuple(c.translate_fields(folder_class=folder_class) for c in self.children)
+        return self._replace(field=field, children=children, translated=True)
 
     def to_xml(self, folder_class):
         # Translate this Q object to a valid Restriction XML tree
         from .folders import Folder
         if not self.translated:
             assert issubclass(folder_class, Folder)
-        self.translate_fields(folder_class=folder_class)
-        elem = self.xml_elem()
+        elem = self.translate_fields(folder_class=folder_class).xml_elem()
         if elem is None:
             return None
         from xml.etree.ElementTree import ElementTree
         restriction = create_element('m:Restriction')
-        restriction.append(self.xml_elem())
+        restriction.append(elem)
         return ElementTree(restriction).getroot()
 
+    def to_xml_str(self, folder_class):
+        """
+        Like to_xml(), but returns the serialized XML. Paged queries send the same restriction with every page, and
+        applications tend to send the same handful of queries over and over, so the result is cached. The repr() of a
+        translated Q object contains everything that goes into the XML, so it's used as the cache key.
+        """
+        from .folders import Folder
+        if not self.translated:
+            assert issubclass(folder_class, Folder)
+        q = self.translate_fields(folder_class=folder_class)
+        key = repr(q)
+        xml = _xml_cache.get(key)
+        if xml is None:
+            elem = q.to_xml(folder_class=folder_class)
+            xml = '' if elem is None else xml_to_str(elem)
+            _xml_cache[key] = xml
+        return xml or None
+
     def xml_elem(self):
         # Return an XML tree structure of this Q object. First, remove any empty children. If conn_type is AND or OR and
         # there is exactly one child, ignore the AND/OR and treat this node as a leaf. If this is an empty leaf
@@ -322,7 +380,6 @@ class Q(object):
             field = create_element('t:FieldURI', FieldURI=self.field)
             elem.append(field)
             constant = create_element('t:Constant')
-            # Use .set() to not fill up the create_element() cache with unique values
             constant.set('Value', value_to_xml_text(self.value))
             if self.op in self.CONTAINS_OPS:
                 elem.append(constant)
@@ -356,35 +413,27 @@ class Q(object):
         # | operator. Return a new Q with two children and conn_type OR
         return self.__class__(self, other, conn_type=self.OR)
 
+    # Operators that have an inverse operator
+    INVERSE_OPS = {EQ: NE, NE: EQ, GT: LTE, GTE: LT, LT: GTE, LTE: GT}
+
     def __invert__(self):
-        # ~ operator. If this is a leaf and op has an inverse, change op. Else return a new Q with conn_type NOT
+        # ~ operator. Return a new Q that matches the opposite
         if self.conn_type == self.NOT:
             # This is NOT NOT. Change to AND
-            self.conn_type = self.AND
-        if self.is_leaf():
-            if self.op == self.EQ:
-                self.op = self.NE
-                return self
-            if self.op == self.NE:
-                self.op = self.EQ
-                return self
-            if self.op == self.GT:
-                self.op = self.LTE
-                return self
-            if self.op == self.GTE:
-                self.op = self.LT
-                return self
-            if self.op == self.LT:
-                self.op = self.GTE
-                return self
-            if self.op == self.LTE:
-                self.op = self.GT
-                return self
+            return self._replace(conn_type=self.AND)
+        if self.is_leaf() and self.op in self.INVERSE_OPS:
+            return self._replace(op=self.INVERSE_OPS[self.op])
         return self.__class__(self, conn_type=self.NOT)
 
     def __eq__(self, other):
         return repr(self) == repr(other)
 
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(repr(self))
+
     def __str__(self):
         return self.expr()
 
@@ -396,13 +445,32 @@ class Q(object):
         return self.__class__.__name__ + repr(tuple(self.children))
 
 
+# Maps comparison operators in search expressions to Q lookups. None means equality.
+_ast_lookups = {
+    ast.Eq: None,
+    ast.NotEq: Q.LOOKUP_NOT,
+    ast.Gt: Q.LOOKUP_GT,
+    ast.GtE: Q.LOOKUP_GTE,
+    ast.Lt: Q.LOOKUP_LT,
+    ast.LtE: Q.LOOKUP_LTE,
+    ast.In: Q.LOOKUP_CONTAINS,
+}
+
+
+# The node type and value attribute of string literals in syntax trees from ast.parse(). ast.Constant exists since Python
+# 3.6, but ast.parse() only produces it since Python 3.8. ast.Str is deprecated since then.
+if sys.version_info >= (3, 8):
+    _ast_str_type, _ast_str_attr = ast.Constant, 'value'
+else:
+    _ast_str_type, _ast_str_attr = ast.Str, 's'
+
+
 @python_2_unicode_compatible
 class Restriction(object):
     """
     Implements an EWS Restriction type.
 
     """
-
     def __init__(self, q):
         if not isinstance(q, Q):
             raise ValueError("'q' must be a Q object (%s)", type(q))
@@ -417,6 +485,11 @@ class Restriction(object):
         # folder=None is OK since q has already been translated
         return self.q.to_xml(folder_class=None)
 
+    @property
+    def xml_str(self):
+        # The serialized XML. Cached, so prefer this over 'xml' when the tree isn't needed
+        return self.q.to_xml_str(folder_class=None)
+
     @classmethod
     def from_source(cls, source, folder_class):
         """
@@ -426,97 +499,66 @@ class Restriction(object):
 
             start > '2009-01-15T13:45:56Z' and not (subject == 'EWS Test' or subject == 'Foo')
 
+        The expression is only parsed with ast.parse(), never evaluated. Parsed expressions are cached, and cache hits
+        don't take a lock.
         """
         from .folders import Folder
         assert issubclass(folder_class, Folder)
-        with _source_cache_lock:
-            # Something within the parser module seems to be deadlocking. Wrap in lock
-            if source not in _source_cache:
-                from parser import expr
-                log.debug('Parsing source: %s', source)
-                st = expr(source).tolist()
-                q = cls._parse_syntaxtree(st)
-                q.translate_fields(folder_class=folder_class)
-                _source_cache[source] = q
-        return cls(_source_cache[source])
+        # Field names are translated for a specific folder class, so the same source may give different results
+        key = (folder_class, source)
+        q = _source_cache.get(key)
+        if q is None:
+            log.debug('Parsing source: %s', source)
+            q = cls._parse_syntaxtree(ast.parse(source.strip(), mode='eval'))
+            q = q.translate_fields(folder_class=folder_class)
+            _source_cache[key] = q
+        return cls(q)
+
+    @staticmethod
+    def set_source_cache_size(maxsize):
+        # Sets the maximum number of search expressions that from_source() keeps parsed. The default is 1000.
+        assert maxsize >= 1
+        _source_cache.maxsize = maxsize
 
     @classmethod
-    def _parse_syntaxtree(cls, slist):
+    def _parse_syntaxtree(cls, node):
         """
-        Takes a Python syntax tree containing a search restriction expression and returns a Q object
+        Takes a node of a Python syntax tree (from ast.parse()) containing a search restriction expression and returns
+        a Q object
         """
-        from token import NAME, EQEQUAL, NOTEQUAL, GREATEREQUAL, LESSEQUAL, LESS, GREATER, STRING, LPAR, RPAR, \
-            NEWLINE, ENDMARKER
-        from symbol import and_test, or_test, not_test, comparison, eval_input, sym_name, atom
-        key = slist[0]
-        if isinstance(slist[1], list):
-            if len(slist) == 2:
-                # Let nested 2-element lists pass transparently
-                return cls._parse_syntaxtree(slist[1])
-            if key == atom:
-                # This is a parens with contents. Continue without the parens since they are unnecessary when building
-                # a tree - a node *is* the parens.
-                assert slist[1][0] == LPAR
-                assert slist[3][0] == RPAR
-                return cls._parse_syntaxtree(slist[2])
-            if key == or_test:
-                children = []
-                for item in [cls._parse_syntaxtree(l) for l in slist[1:]]:
-                    if item is not None:
-                        children.append(item)
-                return Q(*children, conn_type=Q.OR)
-            if key == and_test:
-                children = []
-                for item in [cls._parse_syntaxtree(l) for l in slist[1:]]:
-                    if item is not None:
-                        children.append(item)
-                return Q(*children, conn_type=Q.AND)
-            if key == not_test:
-                children = []
-                for item in [cls._parse_syntaxtree(l) for l in slist[1:]]:
-                    if item is not None:
-                        children.append(item)
-                return Q(*children, conn_type=Q.NOT)
-            if key == comparison:
-                lookup = cls._parse_syntaxtree(slist[2])
-                field = cls._parse_syntaxtree(slist[1])
-                value = cls._parse_syntaxtree(slist[3])
-                if lookup:
-                    return Q(**{'%s__%s' % (field, lookup): value})
-                else:
-                    return Q(**{field: value})
-            if key == eval_input:
-                children = []
-                for item in [cls._parse_syntaxtree(l) for l in slist[1:]]:
-                    if item is not None:
-                        children.append(item)
-                return Q(*children, conn_type=Q.AND)
-            raise ValueError('Unknown element type: %s %s (slist %s len %s)' % (key, sym_name[key], slist, len(slist)))
-        else:
-            val = slist[1]
-            if key == NAME:
-                if val in ('and', 'or', 'not'):
-                    return None
-                if val == 'in':
-                    return Q.LOOKUP_CONTAINS
-                # Field name
-                return val
-            if key == STRING:
-                # This is a string value, so strip single/double quotes
-                return val.strip('"\'')
-            if key in (LPAR, RPAR, NEWLINE, ENDMARKER):
-                return None
+        if isinstance(node, ast.Expression):
+            return Q(cls._parse_syntaxtree(node.body), conn_type=Q.AND)
+        if isinstance(node, ast.BoolOp):
+            conn_type = Q.AND if isinstance(node.op, ast.And) else Q.OR
+            return Q(*[cls._parse_syntaxtree(n) for n in node.values], conn_type=conn_type)
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+            return Q(cls._parse_syntaxtree(node.operand), conn_type=Q.NOT)
+        if isinstance(node, ast.Compare):
+            if len(node.ops) != 1:
+                raise ValueError('Chained comparisons are not supported')
+            if not isinstance(node.left, ast.Name):
+                raise ValueError('Left side of a comparison must be a field name, not %s' % ast.dump(node.left))
             try:
-                return {
-                    EQEQUAL: None,
-                    NOTEQUAL: Q.LOOKUP_NOT,
-                    GREATER: Q.LOOKUP_GT,
-                    GREATEREQUAL: Q.LOOKUP_GTE,
-                    LESS: Q.LOOKUP_LT,
-                    LESSEQUAL: Q.LOOKUP_LTE,
-                }[key]
+                lookup = _ast_lookups[type(node.ops[0])]
             except KeyError:
-                raise ValueError('Unknown token type: %s %s' % (key, val))
+                raise ValueError('Unknown operator: %s' % ast.dump(node.ops[0]))
+            field, value = node.left.id, cls._parse_value(node.comparators[0])
+            if lookup:
+                return Q(**{'%s__%s' % (field, lookup): value})
+            return Q(**{field: value})
+        raise ValueError('Unknown element type: %s' % ast.dump(node))
+
+    @staticmethod
+    def _parse_value(node):
+        # Only string values are supported
+        if not isinstance(node, _ast_str_type):
+            raise ValueError('Value must be a string, not %s' % ast.dump(node))
+        value = getattr(node, _ast_str_attr)
+        if isinstance(value, bytes):
+            value = value.decode('utf-8')
+        if not isinstance(value, string_types):
+            raise ValueError('Value must be a string, not %r' % value)
+        return value
 
     def __and__(self, other):
         # Return a new Q with two children and conn_type AND
@@ -530,4 +572,4 @@ class Restriction(object):
         """
         Prints the XML syntax tree
         """
-        return xml_to_str(self.xml)
+        return self.xml_str
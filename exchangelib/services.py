@@ -13,11 +13,16 @@ Exchange EWS references:
 
 from __future__ import unicode_literals
 
-import itertools
 import logging
+import time
 import traceback
+from collections import deque
+from functools import partial
+from itertools import islice
+from xml.etree.ElementTree import ParseError
 from xml.parsers.expat import ExpatError
 
+import queue
 from future.utils import raise_from
 from six import text_type
 
@@ -30,9 +35,10 @@ from .errors import EWSWarning, TransportError, SOAPError, ErrorTimeoutExpired,
     ErrorTooManyObjectsOpened, ErrorInvalidLicense, ErrorInvalidSchemaVersionForMailboxVersion, \
     ErrorInvalidServerVersion, ErrorItemNotFound, ErrorADUnavailable, EWSError
 from .ewsdatetime import EWSDateTime
-from .transport import wrap, SOAPNS, TNS, MNS, ENS
-from .util import chunkify, create_element, add_xml_child, get_xml_attr, to_xml, post_ratelimited, ElementType, \
-    xml_to_str, set_xml_value
+from .executor import SharedProcessPool
+from .transport import wrap, serialize_body, SOAPNS, TNS, MNS, ENS
+from .util import chunkify, chunkify_by_size, create_element, add_xml_child, get_xml_attr, to_xml, post_ratelimited, \
+    ElementType, xml_to_str, set_xml_value, XMLWriter, ElementStream
 from .version import EXCHANGE_2010, EXCHANGE_2013
 
 log = logging.getLogger(__name__)
@@ -52,11 +58,31 @@ ASSOCIATED = 'Associated'
 ITEM_TRAVERSAL_CHOICES = (SHALLOW, SOFT_DELETED, ASSOCIATED)
 FOLDER_TRAVERSAL_CHOICES = (SHALLOW, DEEP, SOFT_DELETED)
 
+# Errors that tell us the server is overloaded. The session pool controller backs off when it sees these.
+THROTTLING_ERRORS = (ErrorServerBusy, ErrorTooManyObjectsOpened)
+THROTTLING_RESPONSE_CODES = {e.__name__ for e in THROTTLING_ERRORS}
+
+# Errors that are known and understood, and don't require a backtrace. ErrorServerBusy and ErrorTooManyObjectsOpened
+# have already lowered the session pool limit when they are raised.
+KNOWN_ERRORS = (
+    ErrorQuotaExceeded, ErrorCannotDeleteObject, ErrorCreateItemAccessDenied, ErrorTimeoutExpired, ErrorFolderNotFound,
+    ErrorNonExistentMailbox, ErrorMailboxStoreUnavailable, ErrorImpersonateUserDenied, ErrorInternalServerError,
+    ErrorInternalServerTransientError, ErrorNoRespondingCASInDestinationSite, ErrorImpersonationFailed,
+    ErrorMailboxMoveInProgress, ErrorAccessDenied, ErrorConnectionFailed, RateLimitError, ErrorServerBusy,
+    ErrorTooManyObjectsOpened, ErrorInvalidLicense, ErrorItemNotFound, ErrorADUnavailable,
+)
+
 
 class EWSService(object):
     SERVICE_NAME = None  # The name of the SOAP service
     element_container_name = None  # The name of the XML element wrapping the collection of returned items
     ERRORS_TO_CATCH_IN_RESPONSE = EWSWarning  # Treat the following errors as warnings when contained in an element
+    # If True, the response is parsed while it is downloaded, and elements are yielded as soon as they are complete.
+    # Only for services that are safe to repeat, because a response that isn't valid XML is requested again and parsed
+    # with a more forgiving parser. Services that override _get_elements_in_container() can't stream.
+    STREAM_RESPONSES = False
+    # Number of bytes to read from a streamed response at a time
+    STREAM_CHUNK_BYTES = 16 * 1024
 
     def __init__(self, protocol):
         self.protocol = protocol
@@ -70,46 +96,123 @@ class EWSService(object):
     def _get_payload(self, *args, **kwargs):
         raise NotImplementedError()
 
-    def _get_elements(self, payload):
-        assert isinstance(payload, ElementType)
+    def _get_elements(self, payload, decoder=None):
+        # 'payload' is an XML tree, or already serialized XML. If 'decoder' is set, the elements are decoded with it
+        # in a worker process, see _get_elements_decoded().
+        assert isinstance(payload, (ElementType, bytes))
+        if decoder is not None:
+            return self._get_elements_decoded(payload=payload, decoder=decoder)
+        if self.STREAM_RESPONSES:
+            return self._get_elements_streamed(payload=payload)
         try:
             response = self._get_response_xml(payload=payload)
             return self._get_elements_in_response(response=response)
-        except (ErrorQuotaExceeded, ErrorCannotDeleteObject, ErrorCreateItemAccessDenied, ErrorTimeoutExpired,
-                ErrorFolderNotFound, ErrorNonExistentMailbox, ErrorMailboxStoreUnavailable, ErrorImpersonateUserDenied,
-                ErrorInternalServerError, ErrorInternalServerTransientError, ErrorNoRespondingCASInDestinationSite,
-                ErrorImpersonationFailed, ErrorMailboxMoveInProgress, ErrorAccessDenied, ErrorConnectionFailed,
-                RateLimitError, ErrorServerBusy, ErrorTooManyObjectsOpened, ErrorInvalidLicense, ErrorItemNotFound,
-                ErrorADUnavailable):
-            # These are known and understood, and don't require a backtrace
-            # TODO: ErrorTooManyObjectsOpened means there are too many connections to the database. We should be able to
-            # act on this by lowering the self.protocol connection pool size.
+        except KNOWN_ERRORS:
             raise
         except Exception:
-            # This may run from a thread pool, which obfuscates the stack trace. Print trace immediately.
-            account = self.account if isinstance(self, EWSAccountService) else None
-            log.warning('EWS %s, account %s: Exception in _get_elements: %s', self.protocol.service_endpoint, account,
-                        traceback.format_exc(20))
+            self._log_exception()
             raise
 
-    def _get_response_xml(self, payload):
-        # Takes an XML tree and returns SOAP payload as an XML tree
-        assert isinstance(payload, ElementType)
+    def _get_elements_streamed(self, payload):
+        # Like _get_elements(), but yields the elements while the response is being downloaded. The session is held
+        # until the elements have been consumed, or the generator is closed.
+        n = 0
+        messages = self._get_response_stream(payload=payload, container_name=self.element_container_name)
+        try:
+            try:
+                for stream, message in messages:
+                    for elem in self._get_elements_in_message(message=message, stream=stream):
+                        n += 1
+                        yield elem
+            except ParseError as e:
+                log.warning('EWS %s, service %s: Could not parse streamed response (%s). Requesting it again',
+                            self.protocol.service_endpoint, self.SERVICE_NAME, e)
+                # Release the session of the broken response first. We may not get another one.
+                messages.close()
+                response = self._get_response_xml(payload=payload)
+                for elem in islice(self._get_elements_in_response(response=response), n, None):
+                    yield elem
+        except KNOWN_ERRORS:
+            raise
+        except Exception:
+            self._log_exception()
+            raise
+        finally:
+            messages.close()
+
+    def _get_elements_decoded(self, payload, decoder):
+        """
+        Like _get_elements(), but the response is parsed, and its elements are decoded with 'decoder', in a worker
+        process of executor.SharedProcessPool. Decoding large responses is CPU-bound and holds the GIL, so this lets
+        a process use more than one CPU. Only the raw response is sent to the worker process, and only the decoded
+        results are sent back. 'decoder' must be picklable and have a check() method, see folders.ItemDecoder.
+
+        Errors in the response are raised after the results that precede them have been yielded, like _get_elements()
+        does.
+        """
+        try:
+            results, exc = self._get_response_xml(
+                payload=payload, parse=partial(self._parse_response_in_process, decoder=decoder))
+        except KNOWN_ERRORS:
+            raise
+        except Exception:
+            self._log_exception()
+            raise
+        for r in results:
+            yield r
+        if exc is not None:
+            raise exc
+
+    def _log_exception(self):
+        # This may run from a thread pool, which obfuscates the stack trace. Print trace immediately.
+        account = self.account if isinstance(self, EWSAccountService) else None
+        log.warning('EWS %s, account %s: Exception in _get_elements: %s', self.protocol.service_endpoint, account,
+                    traceback.format_exc(20))
+
+    def _get_api_versions(self):
         # Microsoft really doesn't want to make our lives easy. The server may report one version in our initial version
         # guessing tango, but then the server may decide that any arbitrary legacy backend server may actually process
         # the request for an account. Prepare to handle ErrorInvalidSchemaVersionForMailboxVersion errors and set the
         # server version per-account.
-        from .version import API_VERSIONS, Version
+        #
+        # Returns the account, if any, the API version we expect to work, and the API versions to try, in order.
+        from .version import API_VERSIONS
         if isinstance(self, EWSAccountService):
             account = self.account
             hint = self.account.version.api_version
         else:
             account = None
             hint = self.protocol.version.api_version
-        api_versions = [hint] + [v for v in API_VERSIONS if v != hint]
+        return account, hint, [hint] + [v for v in API_VERSIONS if v != hint]
+
+    def _update_api_version(self, new_version):
+        # The API version that worked was different than our hint. Set new version for account
+        account, hint, _ = self._get_api_versions()
+        log.info('New API version for account %s (%s -> %s)', account, hint, new_version.api_version)
+        if isinstance(self, EWSAccountService):
+            self.account.version = new_version
+        else:
+            self.protocol.version = new_version
+        self.protocol.cache_version(version=new_version, account=account)
+
+    def _send_requests(self, payload, stream=False):
+        """
+        Sends the request with each API version we want to try, in order. Yields a (response, api_version, started)
+        tuple for each. 'api_version' is None if it's the version we expected to work, and 'started' is the time the
+        request was sent. The caller stops iterating when a version worked. Asking for the next response means that the
+        server rejected the version for the account.
+
+        If 'stream' is True, the session is held until the caller asks for the next response or closes the generator,
+        so the caller can read the response while it is downloaded. Callers must close the generator when they are done.
+        """
+        assert isinstance(payload, (ElementType, bytes))
+        account, hint, api_versions = self._get_api_versions()
+        # Only the SOAP header depends on the API version. Serialize the body once.
+        body = payload if isinstance(payload, bytes) else serialize_body(payload)
         for api_version in api_versions:
             session = self.protocol.get_session()
-            soap_payload = wrap(content=payload, version=api_version, account=account)
+            soap_payload = wrap(content=body, version=api_version, account=account)
+            started = time.time()
             r, session = post_ratelimited(
                 protocol=self.protocol,
                 session=session,
@@ -118,48 +221,187 @@ class EWSService(object):
                 data=soap_payload,
                 timeout=self.protocol.TIMEOUT,
                 verify=self.protocol.verify_ssl,
-                allow_redirects=False)
-            self.protocol.release_session(session)
+                allow_redirects=False,
+                stream=stream)
             log.debug('Trying API version %s for account %s', api_version, account)
-            try:
-                soap_response_payload = to_xml(r.text, encoding=r.encoding or 'utf-8')
-            except ExpatError as e:
-                raise_from(SOAPError('SOAP response is not XML: %s' % e), e)
-            try:
-                res = self._get_soap_payload(soap_response=soap_response_payload)
-            except (ErrorInvalidSchemaVersionForMailboxVersion, ErrorInvalidServerVersion):
-                assert account  # This should never happen for non-account services
-                # The guessed server version is wrong for this account. Try the next version
-                log.debug('API version %s was invalid for account %s', api_version, account)
-                continue
-            if api_version != hint:
-                # The api_version that worked was different than our hint. Set new version for account
-                log.info('New API version for account %s (%s -> %s)', account, hint, api_version)
-                new_version = Version.from_response(requested_api_version=api_version, response=r)
-                if isinstance(self, EWSAccountService):
-                    self.account.version = new_version
-                else:
-                    self.protocol.version = new_version
-            return res
+            if stream:
+                try:
+                    yield r, api_version if api_version != hint else None, started
+                finally:
+                    r.close()
+                    self.protocol.release_session(session)
+            else:
+                self.protocol.release_session(session)
+                yield r, api_version if api_version != hint else None, started
+            assert account  # This should never happen for non-account services
+            # The guessed server version is wrong for this account. Try the next version
+            log.debug('API version %s was invalid for account %s', api_version, account)
+        # Versions we have cached for this endpoint are obviously wrong
+        self.protocol.invalidate_cached_metadata()
         raise ErrorInvalidSchemaVersionForMailboxVersion('Tried versions %s but all were invalid for account %s' %
                                                          (api_versions, account))
 
-    def _get_soap_payload(self, soap_response):
+    def _get_response_xml(self, payload, parse=None):
+        # Takes an XML tree or serialized XML and returns SOAP payload as an XML tree. The response is parsed with
+        # 'parse', which has the signature of _parse_response() and defaults to it.
+        parse = parse or self._parse_response
+        responses = self._send_requests(payload=payload)
+        try:
+            for r, api_version, started in responses:
+                try:
+                    new_version, response_codes, res = parse(content=r.content, api_version=api_version)
+                except (ErrorInvalidSchemaVersionForMailboxVersion, ErrorInvalidServerVersion):
+                    continue
+                except THROTTLING_ERRORS:
+                    self.protocol.pool_controller.throttled(started=started)
+                    raise
+                if any(code in THROTTLING_RESPONSE_CODES for code in response_codes):
+                    self.protocol.pool_controller.throttled(started=started)
+                if new_version is not None:
+                    self._update_api_version(new_version=new_version)
+                return res
+        finally:
+            responses.close()
+
+    def _parse_response(self, content, api_version=None):
+        """
+        Parses the raw bytes of a response. Returns a (version, response_codes, messages) tuple: the ResponseMessage
+        elements and their response codes. 'version' is None, unless 'api_version' is set. Then it is the server
+        version in the SOAP header of a response to a request with that API version.
+        """
+        from .version import Version
+        try:
+            # Parse the raw bytes. Decoding the body to text first would just make another copy of it.
+            soap_response_payload = to_xml(content)
+        except ExpatError as e:
+            raise_from(SOAPError('SOAP response is not XML: %s' % e), e)
+        header, body = self._get_soap_parts(soap_response=soap_response_payload)
+        res = self._get_soap_payload(body=body)
+        response_codes = [get_xml_attr(msg, '{%s}ResponseCode' % MNS) for msg in res]
+        if api_version is None:
+            return None, response_codes, res
+        return Version.from_soap_header(requested_api_version=api_version, header=header), response_codes, res
+
+    def _parse_and_decode(self, content, api_version, decoder):
+        # Like _parse_response(), but returns the decoded elements of the response, and the error that stopped the
+        # decoding, if any, instead of the messages. Elements that are error tuples are returned as-is.
+        version, response_codes, res = self._parse_response(content=content, api_version=api_version)
+        results = []
+        try:
+            for elem in self._get_elements_in_response(response=res):
+                results.append(elem if isinstance(elem, tuple) else decoder(elem))
+        except Exception as e:
+            return version, response_codes, (results, e)
+        return version, response_codes, (results, None)
+
+    def _parse_response_in_process(self, content, api_version, decoder):
+        res = SharedProcessPool.get_instance().apply(_parse_and_decode_in_process, (
+            self.__class__, self.protocol.service_endpoint, content, api_version, decoder
+        ))
+        if res is None:
+            # The worker process doesn't have the same item fields as we do. Decode here instead.
+            log.debug('Decoding %s response in this process', self.SERVICE_NAME)
+            return self._parse_and_decode(content=content, api_version=api_version, decoder=decoder)
+        return res
+
+    def _get_response_stream(self, payload, container_name):
+        """
+        Like _get_response_xml(), but sends the request with stream=True and parses the response while it is being
+        downloaded. Yields a (stream, message) tuple for each ResponseMessage element as soon as its child element named
+        'container_name' starts, or when the message is complete if it has no such child. Children of the container can
+        be consumed as they arrive with stream.iter_children().
+
+        The session is held until the response has been consumed or the generator is closed.
+        """
+        from .version import Version
+        responses = self._send_requests(payload=payload, stream=True)
+        try:
+            for r, api_version, started in responses:
+                stream = ElementStream(r.iter_content(chunk_size=self.STREAM_CHUNK_BYTES))
+                try:
+                    header, response = self._get_soap_parts_streamed(stream=stream)
+                except (ErrorInvalidSchemaVersionForMailboxVersion, ErrorInvalidServerVersion):
+                    continue
+                except THROTTLING_ERRORS:
+                    self.protocol.pool_controller.throttled(started=started)
+                    raise
+                if api_version is not None:
+                    self._update_api_version(new_version=Version.from_soap_header(
+                        requested_api_version=api_version, header=header))
+                throttled = False
+                for message in self._get_response_messages_streamed(stream=stream, response=response,
+                                                                    container_name=container_name):
+                    if not throttled and get_xml_attr(message, '{%s}ResponseCode' % MNS) in THROTTLING_RESPONSE_CODES:
+                        self.protocol.pool_controller.throttled(started=started)
+                        throttled = True
+                    yield stream, message
+                return
+        finally:
+            responses.close()
+
+    def _get_soap_parts(self, soap_response):
+        # Returns the SOAP header, or None if there is none, and the SOAP body of a parsed response
         assert isinstance(soap_response, ElementType)
+        header = soap_response.find('{%s}Header' % SOAPNS)
         body = soap_response.find('{%s}Body' % SOAPNS)
         if body is None:
             raise TransportError('No Body element in SOAP response')
+        return header, body
+
+    def _get_soap_payload(self, body):
         response = body.find('{%s}%sResponse' % (MNS, self.SERVICE_NAME))
         if response is None:
-            fault = body.find('{%s}Fault' % SOAPNS)
-            if fault is None:
-                raise SOAPError('Unknown SOAP response: %s' % xml_to_str(body))
-            self._raise_soap_errors(fault=fault)  # Will throw SOAPError
+            self._raise_body_errors(body=body)
         response_messages = response.find('{%s}ResponseMessages' % MNS)
         if response_messages is None:
             return response.findall('{%s}%sResponse' % (MNS, self.SERVICE_NAME))
         return response_messages.findall('{%s}%sResponseMessage' % (MNS, self.SERVICE_NAME))
 
+    def _get_soap_parts_streamed(self, stream):
+        # Like _get_soap_parts(), but for a response that is being parsed. Parses the SOAP header and returns it,
+        # together with the '<SERVICE_NAME>Response' element, which has just started.
+        envelope = stream.root()
+        header, body = None, None
+        while body is None:
+            child = stream.next_child(envelope)
+            if child is None:
+                raise TransportError('No Body element in SOAP response')
+            if child.tag == '{%s}Header' % SOAPNS:
+                header = stream.finish(child)
+            elif child.tag == '{%s}Body' % SOAPNS:
+                body = child
+        response = stream.next_child(body)
+        if response is None or response.tag != '{%s}%sResponse' % (MNS, self.SERVICE_NAME):
+            self._raise_body_errors(body=stream.finish(body))
+        return header, response
+
+    def _get_response_messages_streamed(self, stream, response, container_name):
+        # Like _get_soap_payload(), but yields each message as soon as its child named 'container_name' has started.
+        # The children preceding the container, e.g. ResponseCode, are complete at that point.
+        response_messages = stream.find_child(response, '{%s}ResponseMessages' % MNS)
+        if response_messages is None:
+            for message in response.findall('{%s}%sResponse' % (MNS, self.SERVICE_NAME)):
+                yield message
+            return
+        message_tag = '{%s}%sResponseMessage' % (MNS, self.SERVICE_NAME)
+        while True:
+            message = stream.next_child(response_messages)
+            if message is None:
+                return
+            if message.tag != message_tag:
+                continue
+            stream.find_child(message, container_name)
+            yield message
+            stream.finish(message)
+            response_messages.remove(message)
+
+    def _raise_body_errors(self, body):
+        # The SOAP body doesn't contain the expected response. Raise the SOAP fault, if any
+        fault = body.find('{%s}Fault' % SOAPNS)
+        if fault is None:
+            raise SOAPError('Unknown SOAP response: %s' % xml_to_str(body))
+        self._raise_soap_errors(fault=fault)  # Will throw SOAPError
+
     def _raise_soap_errors(self, fault):
         assert isinstance(fault, ElementType)
         log_prefix = 'EWS %s, service %s' % (self.protocol.service_endpoint, self.SERVICE_NAME)
@@ -230,23 +472,48 @@ class EWSService(object):
     def _get_elements_in_response(self, response):
         assert isinstance(response, list)
         for msg in response:
-            assert isinstance(msg, ElementType)
-            try:
-                container = self._get_element_container(message=msg, name=self.element_container_name)
-                if isinstance(container, ElementType):
-                    for c in self._get_elements_in_container(container=container):
-                        yield c
+            for elem in self._get_elements_in_message(message=msg):
+                yield elem
+
+    def _get_elements_in_message(self, message, stream=None):
+        # If 'stream' is set, 'message' is still being parsed. See _get_response_stream()
+        assert isinstance(message, ElementType)
+        try:
+            container = self._get_element_container(message=message, name=self.element_container_name)
+            if isinstance(container, ElementType):
+                if stream is None:
+                    elements = self._get_elements_in_container(container=container)
                 else:
-                    yield (container, None)
-            except (ErrorTimeoutExpired, ErrorBatchProcessingStopped):
-                raise
-            except self.ERRORS_TO_CATCH_IN_RESPONSE as e:
-                yield (False, '%s' % e.value)
+                    elements = stream.iter_children(container)
+                for c in elements:
+                    yield c
+            else:
+                yield (container, None)
+        except (ErrorTimeoutExpired, ErrorBatchProcessingStopped):
+            raise
+        except self.ERRORS_TO_CATCH_IN_RESPONSE as e:
+            yield (False, '%s' % e.value)
 
     def _get_elements_in_container(self, container):
         return [elem for elem in container]
 
 
+class _WorkerProtocol(object):
+    # The part of a protocol that a service needs to parse responses in a worker process
+    def __init__(self, service_endpoint):
+        self.service_endpoint = service_endpoint
+
+
+def _parse_and_decode_in_process(service_cls, service_endpoint, content, api_version, decoder):
+    # Runs in a worker process of SharedProcessPool. Returns the result of _parse_and_decode(), or None if 'decoder'
+    # can't be used in this process.
+    if not decoder.check():
+        return None
+    service = service_cls.__new__(service_cls)
+    EWSService.__init__(service, protocol=_WorkerProtocol(service_endpoint=service_endpoint))
+    return service._parse_and_decode(content=content, api_version=api_version, decoder=decoder)
+
+
 class EWSAccountService(EWSService):
     def __init__(self, account):
         self.account = account
@@ -271,28 +538,83 @@ class PagingEWSMixIn(EWSService):
             log.debug('%s: Getting items at offset %s', log_prefix, next_offset)
             kwargs['offset'] = next_offset
             payload = self._get_payload(**kwargs)
-            response = self._get_response_xml(payload=payload)
-            rootfolder, next_offset = self._get_page(response)
-            if isinstance(rootfolder, ElementType):
-                container = rootfolder.find(self.element_container_name)
-                if container is None:
-                    raise TransportError('No %s elements in ResponseMessage (%s)' % (self.element_container_name,
-                                                                                     xml_to_str(rootfolder)))
-                for elem in self._get_elements_in_container(container=container):
-                    item_count += 1
-                    yield elem
-                if max_items and item_count >= max_items:
-                    # With CalendarViews where max_count is smaller than the actual item count in the view, it's
-                    # difficult to find out if pagination is finished - IncludesLastItemInRange is false, and
-                    # IndexedPagingOffset is not set. This hack is the least messy solution.
-                    log.debug("'max_items' count reached")
-                    break
+            if self.STREAM_RESPONSES:
+                next_offset, elements = self._get_page_elements_streamed(payload=payload)
+            else:
+                next_offset, elements = self._get_page_elements(payload=payload)
+            for elem in elements:
+                item_count += 1
+                yield elem
+            if max_items and item_count >= max_items:
+                # With CalendarViews where max_count is smaller than the actual item count in the view, it's
+                # difficult to find out if pagination is finished - IncludesLastItemInRange is false, and
+                # IndexedPagingOffset is not set. This hack is the least messy solution.
+                log.debug("'max_items' count reached")
+                break
             if not next_offset:
                 break
             if next_offset != item_count:
                 # Check paging offsets
                 raise TransportError('Unexpected next offset: %s -> %s' % (item_count, next_offset))
 
+    def _get_page_elements(self, payload):
+        # Returns the next offset and the elements in the page
+        response = self._get_response_xml(payload=payload)
+        rootfolder, next_offset = self._get_page(response)
+        if not isinstance(rootfolder, ElementType):
+            return next_offset, []
+        container = rootfolder.find(self.element_container_name)
+        if container is None:
+            raise TransportError('No %s elements in ResponseMessage (%s)' % (self.element_container_name,
+                                                                             xml_to_str(rootfolder)))
+        return next_offset, self._get_elements_in_container(container=container)
+
+    def _get_page_elements_streamed(self, payload):
+        # Like _get_page_elements(), but the elements are yielded while the response is being downloaded. The session is
+        # held until the elements have been consumed, or the generator is closed.
+        messages = self._get_response_stream(payload=payload, container_name='{%s}RootFolder' % MNS)
+        try:
+            stream, message = next(messages)
+        except StopIteration:
+            stream, message = None, None
+        except ParseError as e:
+            log.warning('EWS %s, service %s: Could not parse streamed response (%s). Requesting it again',
+                        self.protocol.service_endpoint, self.SERVICE_NAME, e)
+            return self._get_page_elements(payload=payload)
+        try:
+            rootfolder, next_offset = self._get_page([message] if message is not None else [])
+        except Exception:
+            messages.close()
+            raise
+
+        def _get_elements():
+            n = 0
+            try:
+                try:
+                    if isinstance(rootfolder, ElementType):
+                        container = stream.find_child(rootfolder, self.element_container_name)
+                        if container is None:
+                            raise TransportError('No %s elements in ResponseMessage (%s)' % (
+                                self.element_container_name, xml_to_str(rootfolder)))
+                        for elem in stream.iter_children(container):
+                            n += 1
+                            yield elem
+                    # Consume the rest of the response, so the session is released
+                    for _ in messages:
+                        pass
+                except ParseError as e:
+                    log.warning('EWS %s, service %s: Could not parse streamed response (%s). Requesting it again',
+                                self.protocol.service_endpoint, self.SERVICE_NAME, e)
+                    # Release the session of the broken response first. We may not get another one.
+                    messages.close()
+                    _, elements = self._get_page_elements(payload=payload)
+                    for elem in islice(elements, n, None):
+                        yield elem
+            finally:
+                messages.close()
+
+        return next_offset, _get_elements()
+
     def _get_page(self, response):
         assert len(response) == 1
         rootfolder = self._get_element_container(message=response[0], name='{%s}RootFolder' % MNS)
@@ -379,20 +701,139 @@ class GetRooms(EWSService):
         return getrooms
 
 
+def estimated_size(value):
+    # A rough estimate of the number of bytes 'value' adds to a request. We only care about values that can be large
+    from .folders import Item, FileAttachment, ItemAttachment
+    if value is None:
+        return 0
+    if isinstance(value, text_type):
+        return len(value.encode('utf-8'))
+    if isinstance(value, bytes):
+        return 4 * len(value) // 3  # Base64-encoded
+    if isinstance(value, (tuple, list)):
+        return sum(estimated_size(v) for v in value)
+    if isinstance(value, FileAttachment):
+        return estimated_size(value._content)  # Don't fetch content of existing attachments
+    if isinstance(value, ItemAttachment):
+        return estimated_size(value._item)
+    if isinstance(value, Item):
+        return sum(estimated_size(getattr(value, f)) for f in value.fieldnames())
+    return 0
+
+
+def write_item_ids(writer, items, log_msg=None):
+    # Writes an m:ItemIds element with an ItemId for each (item_id, changekey) tuple or Item in 'items' to an XMLWriter.
+    # Returns the number of IDs.
+    from .folders import ItemId
+    writer.start('m:ItemIds')
+    n = 0
+    for item in items:
+        n += 1
+        item_id = ItemId(*(item if isinstance(item, tuple) else (item.item_id, item.changekey)))
+        if log_msg:
+            log.debug(log_msg, item)
+        writer.empty(ItemId.request_tag(), (ItemId.ID_ATTR, item_id.id), (ItemId.CHANGEKEY_ATTR, item_id.changekey))
+    writer.end('m:ItemIds')
+    return n
+
+
 class EWSPooledMixIn(EWSService):
     CHUNKSIZE = None
+    # If set, a chunk is also capped by the estimated size of its items, so requests with large items don't exceed the
+    # request size limit of the server (maxRequestLength / maxAllowedContentLength in the EWS web.config). Services
+    # that set this must implement _estimated_item_size().
+    MAX_REQUEST_BYTES = None
+    # Estimated size of the XML markup and small field values of an item
+    ITEM_OVERHEAD_BYTES = 1024
+    # The maximum number of chunks that are requested or waiting to be consumed at any time. If None, this is twice the
+    # maximum number of concurrent sessions, so sessions are kept busy while the consumer processes results.
+    MAX_CHUNKS_IN_FLIGHT = None
+
+    def _estimated_item_size(self, item):
+        raise NotImplementedError()
+
+    def _chunkify(self, items, chunksize):
+        if self.MAX_REQUEST_BYTES is None:
+            return chunkify(items, chunksize)
+        return chunkify_by_size(items, chunksize, max_size=self.MAX_REQUEST_BYTES, size_func=self._estimated_item_size)
 
     def call(self, **kwargs):
         return self._pool_requests(payload_func=self._get_payload, **kwargs)
 
-    def _pool_requests(self, payload_func, items, **kwargs):
-        log.debug('Processing items in chunks of %s', self.CHUNKSIZE)
+    def _get_chunksize_tuner(self):
+        if not self.protocol.AUTOTUNE_CHUNKSIZE:
+            return None
+        return self.protocol.get_chunksize_tuner(self.__class__)
+
+    def _pool_requests(self, payload_func, items, ordered=True, decoder=None, **kwargs):
+        tuner = self._get_chunksize_tuner()
+        chunksize = self.CHUNKSIZE if tuner is None else tuner.chunksize
+        log.debug('Processing items in chunks of %s', chunksize)
+
+        def _get_chunk_elements(chunk):
+            if decoder is None:
+                return list(self._get_elements(payload=payload_func(chunk, **kwargs)))
+            return list(self._get_elements(payload=payload_func(chunk, **kwargs), decoder=decoder))
+
+        def _get_elements(chunk):
+            # Consume the response in the worker thread. Also measure the full round trip, including parsing
+            if tuner is None:
+                return _get_chunk_elements(chunk)
+            # Chunks that were capped by size or are the remainder say nothing about the best chunk size, but they still
+            # count as requests in flight.
+            with tuner.measure(n_items=len(chunk) if len(chunk) == chunksize else None):
+                return _get_chunk_elements(chunk)
+
         # Chop items list into suitable pieces and let worker threads chew on the work. The order of the output result
         # list must be the same as the input id list, so the caller knows which status message belongs to which ID.
-        return itertools.chain(*self.protocol.thread_pool.map(
-            lambda chunk: self._get_elements(payload=payload_func(chunk, **kwargs)),
-            chunkify(items, self.CHUNKSIZE)
-        ))
+        #
+        # Input is consumed lazily, and only a limited number of chunks are in flight at any time. Memory use is thus
+        # independent of the number of items. Results are yielded as soon as they are ready.
+        window = self.MAX_CHUNKS_IN_FLIGHT or 2 * self.protocol.pool_controller.maximum
+        if not ordered:
+            # Yield (input_index, element) tuples in the order the chunks complete, so a slow chunk doesn't hold back
+            # the results of the chunks after it.
+            done = queue.Queue()
+
+            def _get_indexed_elements(offset, chunk):
+                try:
+                    done.put((offset, len(chunk), _get_elements(chunk), None))
+                except Exception as e:
+                    done.put((offset, len(chunk), None, e))
+
+            def _next_done():
+                offset, chunk_len, elements, e = done.get()
+                if e is not None:
+                    raise e
+                # The input index of an element is only known if there is exactly one element per input item
+                if len(elements) != chunk_len:
+                    raise TransportError('Expected %s elements in %s response, got %s' % (
+                        chunk_len, self.SERVICE_NAME, len(elements)))
+                return [(offset + i, elem) for i, elem in enumerate(elements)]
+
+            offset, in_flight = 0, 0
+            for chunk in self._chunkify(items, chunksize):
+                self.protocol.thread_pool.apply_async(_get_indexed_elements, (offset, chunk))
+                offset += len(chunk)
+                in_flight += 1
+                if in_flight >= window:
+                    in_flight -= 1
+                    for indexed_elem in _next_done():
+                        yield indexed_elem
+            while in_flight:
+                in_flight -= 1
+                for indexed_elem in _next_done():
+                    yield indexed_elem
+            return
+        pending = deque()
+        for chunk in self._chunkify(items, chunksize):
+            pending.append(self.protocol.thread_pool.apply_async(_get_elements, (chunk,)))
+            if len(pending) >= window:
+                for elem in pending.popleft().get():
+                    yield elem
+        while pending:
+            for elem in pending.popleft().get():
+                yield elem
 
 
 class EWSPooledAccountService(EWSAccountService, EWSPooledMixIn):
@@ -419,31 +860,26 @@ class GetItem(EWSPooledAccountService):
     CHUNKSIZE = 100
     SERVICE_NAME = 'GetItem'
     element_container_name = '{%s}Items' % MNS
+    STREAM_RESPONSES = True
 
     def _get_payload(self, items, folder, additional_fields):
         # Takes a list of (item_id, changekey) tuples or Item objects and returns the XML for a GetItem request.
         #
         # We start with an IdOnly request. 'additional_properties' defines the additional fields we want. Supported
         # fields are available in self.folder.allowed_field_names().
-        from .folders import ItemId
-        getitem = create_element('m:%s' % self.SERVICE_NAME)
-        itemshape = create_element('m:ItemShape')
-        add_xml_child(itemshape, 't:BaseShape', IdOnly)
+        #
+        # This payload is built very often with lots of IDs, so we write the XML directly instead of building a tree.
+        writer = XMLWriter()
+        writer.start('m:%s' % self.SERVICE_NAME)
+        writer.start('m:ItemShape')
+        writer.text('t:BaseShape', IdOnly)
         if additional_fields:
-            additional_property_elems = folder.additional_property_elems(additional_fields)
-            add_xml_child(itemshape, 't:AdditionalProperties', additional_property_elems)
-        getitem.append(itemshape)
-        item_ids = create_element('m:ItemIds')
-        n = 0
-        for item in items:
-            n += 1
-            item_id = ItemId(*(item if isinstance(item, tuple) else (item.item_id, item.changekey)))
-            log.debug('Getting item %s', item)
-            set_xml_value(item_ids, item_id, self.account.version)
-        if not n:
+            writer.raw(folder.additional_properties_xml(additional_fields, version=self.account.version))
+        writer.end('m:ItemShape')
+        if not write_item_ids(writer, items, log_msg='Getting item %s'):
             raise AttributeError('"ids" must not be empty')
-        getitem.append(item_ids)
-        return getitem
+        writer.end('m:%s' % self.SERVICE_NAME)
+        return writer.getvalue()
 
 
 class CreateItem(EWSPooledAccountService):
@@ -454,9 +890,13 @@ class CreateItem(EWSPooledAccountService):
     MSDN: https://msdn.microsoft.com/en-us/library/office/aa565209(v=exchg.150).aspx
     """
     CHUNKSIZE = 25
+    MAX_REQUEST_BYTES = 10 * 1024 * 1024
     SERVICE_NAME = 'CreateItem'
     element_container_name = '{%s}Items' % MNS
 
+    def _estimated_item_size(self, item):
+        return self.ITEM_OVERHEAD_BYTES + estimated_size(item)
+
     def _get_payload(self, items, folder, message_disposition, send_meeting_invitations):
         # Takes a list of Item obejcts (CalendarItem, Message etc) and returns the XML for a CreateItem request.
         # convert items to XML Elements
@@ -489,11 +929,17 @@ class UpdateItem(EWSPooledAccountService):
     MSDN: https://msdn.microsoft.com/en-us/library/office/aa580254(v=exchg.150).aspx
     """
     CHUNKSIZE = 25
+    MAX_REQUEST_BYTES = 10 * 1024 * 1024
     SERVICE_NAME = 'UpdateItem'
     element_container_name = '{%s}Items' % MNS
 
+    def _estimated_item_size(self, item):
+        # Only the updated fields are sent
+        item, fieldnames = item
+        return self.ITEM_OVERHEAD_BYTES + sum(estimated_size(getattr(item, f)) for f in fieldnames)
+
     def _add_delete_item_elem(self, item_model, parent_elem, fieldname, fielduri):
-        if fieldname in item_model.required_fields():
+        if fieldname in item_model._required_fields():
             log.warning('%s is a required field and may not be deleted. Skipping', fieldname)
             return
         add_xml_child(parent_elem, 't:DeleteItemField', fielduri)
@@ -576,7 +1022,7 @@ class UpdateItem(EWSPooledAccountService):
             if not fieldnames:
                 raise AttributeError('"fieldnames" must not be empty')
             item_model = item.__class__
-            readonly_fields = item_model.readonly_fields()
+            readonly_fields = item_model._readonly_fields()
             itemchange = create_element('t:ItemChange')
             item_id = ItemId(item.item_id, item.changekey)
             log.debug('Updating item %s values %s', item_id, fieldnames)
@@ -673,34 +1119,20 @@ class DeleteItem(EWSPooledAccountService):
     def _get_payload(self, items, delete_type, send_meeting_cancellations, affected_task_occurrences,
                      suppress_read_receipts):
         # Takes a list of (item_id, changekey) tuples or Item objects and returns the XML for a DeleteItem request.
-        from .folders import ItemId
+        # Like GetItem, we write the XML directly.
+        attrs = [
+            ('DeleteType', delete_type),
+            ('SendMeetingCancellations', send_meeting_cancellations),
+            ('AffectedTaskOccurrences', affected_task_occurrences),
+        ]
         if self.account.version.build >= EXCHANGE_2013:
-            deleteitem = create_element(
-                'm:%s' % self.SERVICE_NAME,
-                DeleteType=delete_type,
-                SendMeetingCancellations=send_meeting_cancellations,
-                AffectedTaskOccurrences=affected_task_occurrences,
-                SuppressReadReceipts='true' if suppress_read_receipts else 'false',
-            )
-        else:
-            deleteitem = create_element(
-                'm:%s' % self.SERVICE_NAME,
-                DeleteType=delete_type,
-                SendMeetingCancellations=send_meeting_cancellations,
-                AffectedTaskOccurrences=affected_task_occurrences,
-            )
-
-        item_ids = create_element('m:ItemIds')
-        n = 0
-        for item in items:
-            n += 1
-            item_id = ItemId(*(item if isinstance(item, tuple) else (item.item_id, item.changekey)))
-            log.debug('Deleting item %s', item)
-            set_xml_value(item_ids, item_id, self.account.version)
-        if not n:
+            attrs.append(('SuppressReadReceipts', 'true' if suppress_read_receipts else 'false'))
+        writer = XMLWriter()
+        writer.start('m:%s' % self.SERVICE_NAME, *attrs)
+        if not write_item_ids(writer, items, log_msg='Deleting item %s'):
             raise AttributeError('"ids" must not be empty')
-        deleteitem.append(item_ids)
-        return deleteitem
+        writer.end('m:%s' % self.SERVICE_NAME)
+        return writer.getvalue()
 
 
 class FindItem(EWSFolderService, PagingEWSMixIn):
@@ -712,29 +1144,32 @@ class FindItem(EWSFolderService, PagingEWSMixIn):
     """
     SERVICE_NAME = 'FindItem'
     element_container_name = '{%s}Items' % TNS
+    STREAM_RESPONSES = True
 
     def call(self, **kwargs):
         return self._paged_call(**kwargs)
 
     def _get_payload(self, additional_fields, restriction, shape, depth, calendar_view, offset=0):
-        finditem = create_element('m:%s' % self.SERVICE_NAME, Traversal=depth)
-        itemshape = create_element('m:ItemShape')
-        add_xml_child(itemshape, 't:BaseShape', shape)
+        # This payload is built for every page, with the same shape and restriction. Write it directly, so the cached
+        # AdditionalProperties and Restriction elements can be reused.
+        writer = XMLWriter()
+        writer.start('m:%s' % self.SERVICE_NAME, ('Traversal', depth))
+        writer.start('m:ItemShape')
+        writer.text('t:BaseShape', shape)
         if additional_fields:
-            additional_property_elems = self.folder.additional_property_elems(additional_fields)
-            add_xml_child(itemshape, 't:AdditionalProperties', additional_property_elems)
-        finditem.append(itemshape)
+            writer.raw(self.folder.additional_properties_xml(additional_fields, version=self.account.version))
+        writer.end('m:ItemShape')
         if calendar_view is None:
-            view_type = create_element('m:IndexedPageItemView', Offset=text_type(offset), BasePoint='Beginning')
+            writer.empty('m:IndexedPageItemView', ('Offset', text_type(offset)), ('BasePoint', 'Beginning'))
         else:
-            view_type = calendar_view.to_xml(version=self.account.version)
-        finditem.append(view_type)
+            writer.element(calendar_view.to_xml(version=self.account.version))
         if restriction:
-            finditem.append(restriction.xml)
-        parentfolderids = create_element('m:ParentFolderIds')
-        parentfolderids.append(self.folder.to_xml(version=self.account.version))
-        finditem.append(parentfolderids)
-        return finditem
+            writer.raw(restriction.xml_str)
+        writer.start('m:ParentFolderIds')
+        writer.element(self.folder.to_xml(version=self.account.version))
+        writer.end('m:ParentFolderIds')
+        writer.end('m:%s' % self.SERVICE_NAME)
+        return writer.getvalue()
 
 
 class FindFolder(EWSFolderService, PagingEWSMixIn):
@@ -745,6 +1180,7 @@ class FindFolder(EWSFolderService, PagingEWSMixIn):
     """
     SERVICE_NAME = 'FindFolder'
     element_container_name = '{%s}Folders' % TNS
+    STREAM_RESPONSES = True
 
     def call(self, **kwargs):
         return self._paged_call(**kwargs)
@@ -949,7 +1385,7 @@ class DeleteAttachment(EWSAccountService):
         if not res:
             return res
         from .folders import RootItemId
-        fake_elem = create_element('FakeContainer')
+        fake_elem = message.makeelement('FakeContainer', {})  # Same element type as the parsed response
         for elem in message.findall(RootItemId.response_tag()):
             fake_elem.append(elem)
         return fake_elem
@@ -982,21 +1418,18 @@ class ExportItems(EWSPooledAccountService, ExpectResponseErrorsMixin):
     SERVICE_NAME = 'ExportItems'
     element_container_name = "{%s}Data" % MNS
 
-    def call(self, item_ids):
+    def call(self, item_ids, ordered=True):
         return self._pool_requests(
-            payload_func=self._get_payload, items=item_ids, version=self.account.version
+            payload_func=self._get_payload, items=item_ids, ordered=ordered, version=self.account.version
         )
 
     def _get_payload(self, items, version):
-        from .folders import ItemId
-        exportitems = create_element('m:%s' % self.SERVICE_NAME)
-        itemids = create_element('m:ItemIds')
-        exportitems.append(itemids)
-        for item in items:
-            item_id = ItemId(*(item if isinstance(item, tuple) else (item.item_id, item.changekey)))
-            set_xml_value(itemids, item_id, self.account.version)
-
-        return exportitems
+        # Like GetItem, we write the XML directly
+        writer = XMLWriter()
+        writer.start('m:%s' % self.SERVICE_NAME)
+        write_item_ids(writer, items)
+        writer.end('m:%s' % self.SERVICE_NAME)
+        return writer.getvalue()
 
     # We need to override this since ExportItemsResponseMessage is formated a
     #  little bit differently. Namely, all we want is the 64bit string in the
@@ -1014,6 +1447,7 @@ class UploadItems(EWSPooledAccountService):
     actions "Update" and "UpdateOrCreate".
     """
     CHUNKSIZE = 100
+    MAX_REQUEST_BYTES = 10 * 1024 * 1024
     SERVICE_NAME = 'UploadItems'
     element_container_name = '{%s}ItemId' % MNS
 
@@ -1029,6 +1463,10 @@ class UploadItems(EWSPooledAccountService):
             payload_func=self._get_payload, items=data
         )
 
+    def _estimated_item_size(self, item):
+        parent_folder, data_str = item
+        return self.ITEM_OVERHEAD_BYTES + len(data_str)
+
     def _get_payload(self, items):
         uploaditems = create_element('m:%s' % self.SERVICE_NAME)
         itemselement = create_element('m:Items')
@@ -0,0 +1,425 @@
+# coding=utf-8
+"""
+HTTP sessions used to talk to Exchange servers.
+
+All HTTP requests go through a session created by new_session(): the requests of services, and the requests that probe
+a server for its auth type and version. A session is bound to one set of credentials and keeps its connection open
+between requests, so the NTLM handshake is only done once per connection. There are two backends with the same
+interface:
+
+'requests' (the default) sends requests through a requests.Session.
+
+'urllib3' sends requests directly through urllib3. This skips the work requests does for every request, like merging
+session and request settings, running hooks and preparing request and response objects. Under high request rates,
+that work is a measurable share of the CPU time per request. Cookies are only handled when the server sets any, e.g.
+the X-BackEndCookie that Exchange uses to route requests to the same mailbox server. The NTLM, basic and digest auth
+types are supported. NTLM needs the 'pyspnego' and 'cryptography' packages. Install them with the 'urllib3' extra,
+i.e. 'pip install exchangelib[urllib3]'. Proxies configured in environment variables are ignored.
+
+Errors are raised as the exceptions of the requests package with both backends.
+"""
+from __future__ import unicode_literals
+
+import base64
+import logging
+import os
+import random
+import re
+
+import requests.adapters
+import requests.cookies
+import requests.exceptions
+import requests.sessions
+import requests.utils
+import urllib3
+import urllib3.exceptions
+from future.moves.urllib.parse import urljoin, urlparse
+from future.utils import raise_from
+from requests.auth import HTTPBasicAuth, HTTPDigestAuth
+from requests_ntlm import HttpNtlmAuth
+from six import text_type, string_types
+
+log = logging.getLogger(__name__)
+
+HTTP_BACKENDS = ('requests', 'urllib3')
+_http_backend = None
+
+
+def set_http_backend(name):
+    """
+    Selects the HTTP backend used for new sessions. Call this before creating any Protocol, e.g. when configuring the
+    application. The initial backend is read from the EXCHANGELIB_HTTP_BACKEND environment variable.
+    """
+    global _http_backend
+    if name not in HTTP_BACKENDS:
+        raise ValueError("'name' %r must be one of %s" % (name, HTTP_BACKENDS))
+    _http_backend = name
+
+
+def get_http_backend():
+    return _http_backend
+
+
+set_http_backend(os.environ.get('EXCHANGELIB_HTTP_BACKEND', 'requests'))
+
+
+def new_session(protocol=None):
+    """
+    Returns a session of the current HTTP backend. If 'protocol' is set, the session is set up for requests to the
+    service endpoint of the protocol, and leaving a 'with' block returns the session to the session pool of the
+    protocol. Otherwise, leaving a 'with' block closes the session.
+    """
+    if _http_backend == 'urllib3':
+        return Urllib3Session(protocol=protocol)
+    return RequestsSession(protocol=protocol)
+
+
+class SessionMixIn(object):
+    """
+    The interface shared by the sessions of all backends. Sessions have the 'auth' and 'headers' attributes and the
+    get(), head() and post() methods of a requests.Session, with the arguments 'url', 'headers', 'data', 'auth',
+    'allow_redirects', 'timeout', 'verify' and 'stream'. Responses have the 'status_code', 'reason', 'headers', 'url',
+    'history', 'request', 'content' and 'text' attributes and the iter_content() and close() methods of a
+    requests.Response.
+    """
+    # Headers of requests to the service endpoint of a protocol
+    PROTOCOL_HEADERS = {'Content-Type': 'text/xml; charset=utf-8', 'Accept-Encoding': 'compress, gzip'}
+
+    def _init_session(self, protocol):
+        self.session_id = random.randint(1, 32767)  # Used for debugging messages in services
+        self.protocol = protocol
+        if protocol is not None:
+            self.headers.update(self.PROTOCOL_HEADERS)
+
+    def close_socket(self, url):
+        # Close the connections of the session. This ensures we don't leave stray sockets around after program exit.
+        raise NotImplementedError()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.protocol is None:
+            self.close()
+        elif exc_type is None:
+            self.protocol.release_session(self)
+        else:
+            self.protocol.retire_session(self)
+
+
+class RequestsSession(SessionMixIn, requests.sessions.Session):
+    # A requests Session object that closes the underlying socket when we need it
+    def __init__(self, protocol=None):
+        super(RequestsSession, self).__init__()
+        self._init_session(protocol=protocol)
+        if protocol is not None:
+            # We want just one connection per session. No retries, since we wrap all requests in our own retry handler
+            scheme = 'https' if protocol.has_ssl else 'http'
+            self.mount('%s://' % scheme, requests.adapters.HTTPAdapter(
+                pool_block=True,
+                pool_connections=protocol.CONNECTIONS_PER_SESSION,
+                pool_maxsize=protocol.CONNECTIONS_PER_SESSION,
+                max_retries=0
+            ))
+
+    def close_socket(self, url):
+        _close_connections(self.get_adapter(url).poolmanager)
+
+    def close(self):
+        for adapter in self.adapters.values():
+            _close_connections(adapter.poolmanager)
+        super(RequestsSession, self).close()
+
+
+class Urllib3Session(SessionMixIn):
+    """
+    A session that sends requests with a urllib3.PoolManager. Accepts the requests auth objects created by
+    transport.get_auth_instance().
+    """
+    # Statuses of redirect responses, and whether the redirected request of a POST is a GET, like in requests
+    REDIRECT_STATUSES = {301: True, 302: True, 303: True, 307: False, 308: False}
+    MAX_REDIRECTS = 30
+
+    def __init__(self, protocol=None):
+        self.auth = None
+        self.headers = requests.utils.default_headers()
+        self.cookies = requests.cookies.RequestsCookieJar()
+        self._init_session(protocol=protocol)
+        self._maxsize = 1 if protocol is None else protocol.CONNECTIONS_PER_SESSION
+        self._pool_managers = {}  # One per value of 'verify'
+        # NTLM authenticates connections, not requests. This is True while our connection is authenticated.
+        self._ntlm_authenticated = False
+
+    def get(self, url, **kwargs):
+        kwargs.setdefault('allow_redirects', True)
+        return self.request('GET', url, **kwargs)
+
+    def head(self, url, **kwargs):
+        kwargs.setdefault('allow_redirects', False)
+        return self.request('HEAD', url, **kwargs)
+
+    def post(self, url, data=None, **kwargs):
+        return self.request('POST', url, data=data, **kwargs)
+
+    def request(self, method, url, headers=None, data=None, auth=None, allow_redirects=True, timeout=None, verify=True,
+                stream=False):
+        request_headers = self.headers.copy()
+        if headers:
+            request_headers.update(headers)
+        if isinstance(data, text_type):
+            data = data.encode('utf-8')
+        auth = self.auth if auth is None else auth
+        history = []
+        while True:
+            r = self._send_with_auth(method=method, url=url, headers=request_headers, body=data, auth=auth,
+                                     timeout=timeout, verify=verify, stream=stream)
+            if not allow_redirects or r.status_code not in self.REDIRECT_STATUSES or not r.headers.get('location'):
+                break
+            if len(history) >= self.MAX_REDIRECTS:
+                raise requests.exceptions.TooManyRedirects('Exceeded %s redirects.' % self.MAX_REDIRECTS)
+            r.content  # Release the connection
+            history.append(r)
+            redirect_url = urljoin(url, r.headers['location'])
+            to_get = self.REDIRECT_STATUSES[r.status_code]
+            if (to_get and method == 'POST') or (r.status_code == 303 and method != 'HEAD'):
+                method, data = 'GET', None
+                request_headers.pop('Content-Type', None)
+            if urlparse(redirect_url).netloc != urlparse(url).netloc:
+                # Don't send credentials to other servers
+                auth = None
+                request_headers.pop('Authorization', None)
+            url = redirect_url
+        r.history = history
+        return r
+
+    def _send_with_auth(self, method, url, headers, body, auth, timeout, verify, stream):
+        if isinstance(auth, HttpNtlmAuth):
+            return self._send_with_ntlm(method=method, url=url, headers=headers, body=body, auth=auth,
+                                        timeout=timeout, verify=verify, stream=stream)
+        if isinstance(auth, HTTPBasicAuth):
+            headers['Authorization'] = 'Basic %s' % base64.b64encode(
+                ('%s:%s' % (auth.username, auth.password)).encode('latin1')).decode('ascii')
+        elif isinstance(auth, HTTPDigestAuth):
+            # Reuse the digest implementation of requests. If we have a nonce from an earlier request, skip the 401.
+            auth.init_per_thread_state()
+            if auth._thread_local.last_nonce:
+                headers['Authorization'] = auth.build_digest_header(method, url)
+        elif auth is not None:
+            raise ValueError("Authentication model '%s' not supported" % auth.__class__)
+        r = self._send(method=method, url=url, headers=headers, body=body, timeout=timeout, verify=verify,
+                       stream=stream)
+        if isinstance(auth, HTTPDigestAuth) and r.status_code == 401:
+            challenge = r.headers.get('www-authenticate', '')
+            if 'digest' in challenge.lower():
+                r.content  # Release the connection
+                auth._thread_local.chal = requests.utils.parse_dict_header(
+                    re.sub(r'digest ', '', challenge, count=1, flags=re.IGNORECASE))
+                headers['Authorization'] = auth.build_digest_header(method, url)
+                r = self._send(method=method, url=url, headers=headers, body=body, timeout=timeout, verify=verify,
+                               stream=stream)
+        return r
+
+    def _send_with_ntlm(self, method, url, headers, body, auth, timeout, verify, stream):
+        if self._ntlm_authenticated:
+            r = self._send(method=method, url=url, headers=headers, body=body, timeout=timeout, verify=verify,
+                           stream=stream)
+            if r.status_code != 401:
+                return r
+            # The server closed our authenticated connection, and we got a new one. Start over.
+            r.content  # Release the connection
+            self._ntlm_authenticated = False
+        try:
+            import spnego
+        except ImportError as e:
+            raise_from(ImportError("NTLM auth with the 'urllib3' HTTP backend needs the 'pyspnego' package. Install "
+                                   "it with 'pip install exchangelib[urllib3]'"), e)
+        # The same handshake as requests_ntlm, but we send the NEGOTIATE message with the first request instead of
+        # waiting for a 401 to tell us to, and all three requests go to the same connection of our pool.
+        username = auth.username
+        if getattr(auth, 'domain', None):
+            # requests_ntlm before 1.2 splits 'DOMAIN\\user' into a 'domain' and a 'username' attribute
+            username = '%s\\%s' % (auth.domain, auth.username)
+        options = spnego.NegotiateOptions.none
+        if username and auth.password:
+            # Like requests_ntlm, use the NTLM implementation of spnego instead of SSPI when we have credentials
+            options = spnego.NegotiateOptions.use_ntlm
+        client = spnego.client(username, auth.password, hostname=urlparse(url).hostname, service='http',
+                               protocol='ntlm', options=options)
+        headers['Authorization'] = 'NTLM %s' % base64.b64encode(client.step()).decode('ascii')
+        r = self._send(method=method, url=url, headers=headers, body=body, timeout=timeout, verify=verify, stream=True)
+        channel_bindings = _get_channel_bindings(r) if getattr(auth, 'send_cbt', True) else None
+        r.content  # Release the connection
+        challenge = _get_auth_token(r, 'NTLM')
+        if r.status_code != 401 or challenge is None:
+            log.debug('Server did not respond with an NTLM challenge (status %s)', r.status_code)
+            return r
+        headers['Authorization'] = 'NTLM %s' % base64.b64encode(
+            client.step(base64.b64decode(challenge), channel_bindings=channel_bindings)).decode('ascii')
+        r = self._send(method=method, url=url, headers=headers, body=body, timeout=timeout, verify=verify,
+                       stream=stream)
+        del headers['Authorization']
+        self._ntlm_authenticated = r.status_code != 401
+        return r
+
+    def _get_pool_manager(self, verify):
+        pool_manager = self._pool_managers.get(verify)
+        if pool_manager is None:
+            if verify:
+                # Like requests, verify against the certifi CA bundle unless 'verify' is the path to a CA bundle
+                ca_certs = verify if isinstance(verify, string_types) else requests.utils.DEFAULT_CA_BUNDLE_PATH
+                kwargs = dict(cert_reqs='CERT_REQUIRED', ca_certs=ca_certs)
+            else:
+                kwargs = dict(cert_reqs='CERT_NONE')
+            pool_manager = urllib3.PoolManager(maxsize=self._maxsize, block=True, retries=False, **kwargs)
+            self._pool_managers[verify] = pool_manager
+        return pool_manager
+
+    def _send(self, method, url, headers, body, timeout, verify, stream):
+        request = Urllib3Request(method=method, url=url, headers=headers.copy())
+        if self.cookies:
+            # Only look at cookies when the server has set any. Some servers keep authentication state in cookies.
+            cookie = requests.cookies.get_cookie_header(self.cookies, request)
+            if cookie:
+                request.headers['Cookie'] = cookie
+        try:
+            raw = self._get_pool_manager(verify).urlopen(
+                method, url, body=body, headers=request.headers, timeout=timeout, retries=False, redirect=False,
+                preload_content=not stream, decode_content=True,
+            )
+        except urllib3.exceptions.HTTPError as e:
+            raise_from(_convert_error(e), e)
+        if 'set-cookie' in raw.headers:
+            requests.cookies.extract_cookies_to_jar(self.cookies, request, raw)
+        return Urllib3Response(raw=raw, request=request, stream=stream)
+
+    def close_socket(self, url):
+        self.close()
+
+    def close(self):
+        for pool_manager in self._pool_managers.values():
+            _close_connections(pool_manager)
+        self._ntlm_authenticated = False
+
+
+class Urllib3Request(object):
+    # The request of a Urllib3Response, for debug logging
+    def __init__(self, method, url, headers):
+        self.method = method
+        self.url = url
+        self.headers = headers
+
+
+class Urllib3Response(object):
+    # Wraps a urllib3.HTTPResponse with the parts of the requests.Response interface that we use
+    def __init__(self, raw, request, stream):
+        self.raw = raw
+        self.request = request
+        self.url = request.url
+        self.status_code = raw.status
+        self.reason = raw.reason
+        self.headers = raw.headers
+        self.history = []
+        self._content = None if stream else raw.data
+
+    @property
+    def content(self):
+        if self._content is None:
+            try:
+                self._content = self.raw.data
+            except urllib3.exceptions.HTTPError as e:
+                raise_from(_convert_error(e), e)
+        return self._content
+
+    @property
+    def text(self):
+        encoding = requests.utils.get_encoding_from_headers(self.headers) or 'utf-8'
+        try:
+            return text_type(self.content, encoding, errors='replace')
+        except LookupError:
+            return text_type(self.content, 'utf-8', errors='replace')
+
+    def iter_content(self, chunk_size=1, decode_unicode=False):
+        assert not decode_unicode
+        if self._content is not None:
+            for i in range(0, len(self._content), chunk_size):
+                yield self._content[i:i + chunk_size]
+            return
+        try:
+            for chunk in self.raw.stream(chunk_size, decode_content=True):
+                yield chunk
+        except urllib3.exceptions.ProtocolError as e:
+            raise_from(requests.exceptions.ChunkedEncodingError(e), e)
+        except urllib3.exceptions.HTTPError as e:
+            raise_from(_convert_error(e), e)
+
+    def close(self):
+        # Like requests, close the connection if the response was not consumed. Otherwise, this is a no-op.
+        self.raw.close()
+        self.raw.release_conn()
+
+
+def _close_connections(pool_manager):
+    # Closes all connections of a urllib3.PoolManager. PoolManager.clear() only forgets its connection pools in some
+    # versions of urllib3, leaving the sockets open until the pools are garbage collected. The pool manager can still be
+    # used afterwards.
+    for key in pool_manager.pools.keys():
+        pool = pool_manager.pools.get(key)
+        if pool is not None:
+            pool.close()
+    pool_manager.clear()
+
+
+def _convert_error(e):
+    # Converts a urllib3 exception to the exception requests raises in the same situation
+    if isinstance(e, urllib3.exceptions.NewConnectionError):
+        return requests.exceptions.ConnectionError(e)
+    if isinstance(e, urllib3.exceptions.ConnectTimeoutError):
+        return requests.exceptions.ConnectTimeout(e)
+    if isinstance(e, urllib3.exceptions.ReadTimeoutError):
+        return requests.exceptions.ReadTimeout(e)
+    if isinstance(e, urllib3.exceptions.SSLError):
+        return requests.exceptions.SSLError(e)
+    if isinstance(e, urllib3.exceptions.ProxyError):
+        return requests.exceptions.ProxyError(e)
+    if isinstance(e, (urllib3.exceptions.LocationValueError, urllib3.exceptions.LocationParseError)):
+        return requests.exceptions.InvalidURL(e)
+    if isinstance(e, urllib3.exceptions.DecodeError):
+        return requests.exceptions.ContentDecodingError(e)
+    return requests.exceptions.ConnectionError(e)
+
+
+def _get_auth_token(response, auth_type):
+    # Returns the token of the 'auth_type' challenge in the WWW-Authenticate header of the response, if any
+    prefix = auth_type.lower() + ' '
+    for challenge in response.headers.get('www-authenticate', '').split(','):
+        challenge = challenge.strip()
+        if challenge.lower().startswith(prefix):
+            return challenge[len(prefix):].strip()
+    return None
+
+
+def _get_channel_bindings(response):
+    # Returns the 'tls-server-end-point' channel bindings (RFC 5929) of the server certificate of a response to an HTTPS
+    # request, for servers that require Extended Protection for NTLM. Like requests_ntlm, we hash the certificate with
+    # its own signature hash algorithm, unless that is MD5 or SHA-1.
+    sock = getattr(response.raw.connection, 'sock', None)
+    try:
+        certificate = sock.getpeercert(True)
+    except AttributeError:
+        return None
+    if not certificate:
+        return None
+    from cryptography import x509
+    from cryptography.exceptions import UnsupportedAlgorithm
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import hashes
+    from spnego.channel_bindings import GssChannelBindings
+    try:
+        hash_algorithm = x509.load_der_x509_certificate(certificate, default_backend()).signature_hash_algorithm
+    except UnsupportedAlgorithm:
+        return None
+    if hash_algorithm is None or hash_algorithm.name in ('md5', 'sha1'):
+        hash_algorithm = hashes.SHA256()
+    digest = hashes.Hash(hash_algorithm, default_backend())
+    digest.update(certificate)
+    return GssChannelBindings(application_data=b'tls-server-end-point:' + digest.finalize())
@@ -2,9 +2,9 @@
 from __future__ import unicode_literals
 
 import logging
+from contextlib import contextmanager
 from xml.etree.ElementTree import tostring
 
-import requests.sessions
 from future.utils import raise_from
 from requests.auth import HTTPBasicAuth, HTTPDigestAuth
 from requests_ntlm import HttpNtlmAuth
@@ -12,7 +12,8 @@ from six import text_type
 
 from .credentials import IMPERSONATION
 from .errors import UnauthorizedError, TransportError, RedirectError, RelativeRedirect
-from .util import create_element, add_xml_child, is_xml, get_redirect_url
+from .sessions import new_session
+from .util import create_element, add_xml_child, is_xml, get_redirect_url, LRUCache
 
 log = logging.getLogger(__name__)
 
@@ -48,7 +49,7 @@ def _test_docs_credentials(protocol):
     # Retrieve the result. We allow 401 errors to happen since the authentication type may be wrong, giving a 401
     # response.
     auth = get_auth_instance(credentials=protocol.credentials, auth_type=protocol.docs_auth_type)
-    with requests.sessions.Session() as s:
+    with new_session() as s:
         r = s.get(url=protocol.types_url, auth=auth, allow_redirects=False, verify=protocol.verify_ssl)
     return _test_response(auth=auth, response=r)
 
@@ -60,7 +61,7 @@ def _test_service_credentials(protocol):
     headers = {'Content-Type': 'text/xml; charset=utf-8'}
     data = dummy_xml(version=protocol.version.api_version)
     auth = get_auth_instance(credentials=protocol.credentials, auth_type=protocol.auth_type)
-    with requests.sessions.Session() as s:
+    with new_session() as s:
         r = s.post(url=protocol.service_endpoint, headers=headers, data=data, auth=auth, allow_redirects=False,
                    verify=protocol.verify_ssl)
     return _test_response(auth=auth, response=r)
@@ -94,11 +95,44 @@ def _is_unauthorized(txt):
     return False
 
 
+# Cache of (prefix, suffix) byte strings of SOAP envelopes. See wrap().
+_envelope_cache = LRUCache(maxsize=1000)
+_BODY_MARKER = '__EXCHANGELIB_BODY__'
+
+
 def wrap(content, version, account, ewstimezone=None, encoding='utf-8'):
     """
     Generate the necessary boilerplate XML for a raw SOAP request. The XML is specific to the server version.
     ExchangeImpersonation allows to act as the user we want to impersonate.
+
+    The envelope only depends on a few values, so we serialize it once and splice the content into the cached bytes.
+    'content' is an XML tree or its serialization, as returned by serialize_body(). Callers that wrap the same content
+    multiple times, e.g. when trying different API versions, should serialize it once.
     """
+    impersonated_address = account.primary_smtp_address if account and account.access_type == IMPERSONATION else None
+    key = version, impersonated_address, ewstimezone.ms_id if ewstimezone else None, encoding
+    envelope = _envelope_cache.get(key)
+    if envelope is None:
+        envelope = _create_envelope(version=version, impersonated_address=impersonated_address,
+                                    ewstimezone=ewstimezone, encoding=encoding)
+        _envelope_cache[key] = envelope
+    prefix, suffix = envelope
+    if not isinstance(content, bytes):
+        content = serialize_body(content, encoding=encoding)
+    return prefix + content + suffix
+
+
+def serialize_body(content, encoding='utf-8'):
+    # Serializes the content of a SOAP body for wrap()
+    body = tostring(content, encoding=encoding)
+    if body.startswith(b'<?xml'):
+        # ElementTree adds an XML declaration for encodings other than UTF-8 and ASCII
+        body = body[body.index(b'?>') + 2:].lstrip()
+    return body
+
+
+def _create_envelope(version, impersonated_address, ewstimezone, encoding):
+    # Returns the serialized SOAP envelope as the bytes before and after the content of the body
     envelope = create_element('s:Envelope', **{
         'xmlns:s': SOAPNS,
         'xmlns:t': TNS,
@@ -107,10 +141,10 @@ def wrap(content, version, account, ewstimezone=None, encoding='utf-8'):
     header = create_element('s:Header')
     requestserverversion = create_element('t:RequestServerVersion', Version=version)
     header.append(requestserverversion)
-    if account and account.access_type == IMPERSONATION:
+    if impersonated_address:
         exchangeimpersonation = create_element('t:ExchangeImpersonation')
         connectingsid = create_element('t:ConnectingSID')
-        add_xml_child(connectingsid, 't:PrimarySmtpAddress', account.primary_smtp_address)
+        add_xml_child(connectingsid, 't:PrimarySmtpAddress', impersonated_address)
         exchangeimpersonation.append(connectingsid)
         header.append(exchangeimpersonation)
     if ewstimezone:
@@ -120,14 +154,17 @@ def wrap(content, version, account, ewstimezone=None, encoding='utf-8'):
         header.append(timezonecontext)
     envelope.append(header)
     body = create_element('s:Body')
-    body.append(content)
+    body.text = _BODY_MARKER
     envelope.append(body)
-    return ('<?xml version="1.0" encoding="%s"?>' % encoding).encode(encoding) + tostring(envelope, encoding=encoding)
+    xml = ('<?xml version="1.0" encoding="%s"?>' % encoding).encode(encoding) + tostring(envelope, encoding=encoding)
+    # The marker is in the last element, so split at the last occurrence in case the header contains it, too
+    prefix, suffix = xml.rsplit(_BODY_MARKER.encode(encoding), 1)
+    return prefix, suffix
 
 
 def get_auth_instance(credentials, auth_type):
     """
-    Returns an *Auth instance suitable for the requests package
+    Returns an *Auth instance of the requests package. Sessions of all HTTP backends accept these.
     """
     try:
         model = AUTH_TYPE_MAP[auth_type]
@@ -154,7 +191,7 @@ def get_autodiscover_authtype(service_endpoint, data, timeout, verify):
     # was no redirect, continue trying a POST request with a valid payload.
     log.debug('Getting autodiscover auth type for %s %s', service_endpoint, timeout)
     headers = {'Content-Type': 'text/xml; charset=utf-8'}
-    with requests.sessions.Session() as s:
+    with new_session() as s:
         r = s.head(url=service_endpoint, headers=headers, timeout=timeout, allow_redirects=False, verify=verify)
         if r.status_code == 302:
             try:
@@ -171,23 +208,24 @@ def get_autodiscover_authtype(service_endpoint, data, timeout, verify):
     return _get_auth_method_from_response(response=r)
 
 
-def get_docs_authtype(docs_url, verify):
-    # Get auth type by tasting headers from the server. Don't do HEAD requests. It's too error prone.
+def get_docs_authtype(docs_url, verify, session=None):
+    # Get auth type by tasting headers from the server. Don't do HEAD requests. It's too error prone. If 'session' is
+    # set, the request is sent on that session, so the caller can reuse its connection.
     log.debug('Getting docs auth type for %s', docs_url)
     headers = {'Content-Type': 'text/xml; charset=utf-8'}
-    with requests.sessions.Session() as s:
+    with _probe_session(session) as s:
         r = s.get(url=docs_url, headers=headers, allow_redirects=True, verify=verify)
     return _get_auth_method_from_response(response=r)
 
 
-def get_service_authtype(service_endpoint, versions, verify):
+def get_service_authtype(service_endpoint, versions, verify, session=None):
     # Get auth type by tasting headers from the server. Only do post requests. HEAD is too error prone, and some servers
     # are set up to redirect to OWA on all requests except POST to /EWS/Exchange.asmx
     log.debug('Getting service auth type for %s', service_endpoint)
     headers = {'Content-Type': 'text/xml; charset=utf-8'}
     # We don't know the API version yet, but we need it to create a valid request because some Exchange servers only
     # respond when given a valid request. Try all known versions. Gross.
-    with requests.sessions.Session() as s:
+    with _probe_session(session) as s:
         for version in versions:
             data = dummy_xml(version=version)
             log.debug('Requesting %s from %s', data, service_endpoint)
@@ -198,6 +236,16 @@ def get_service_authtype(service_endpoint, versions, verify):
             raise ValueError("Authentication type '%s' not supported" % auth_method)
 
 
+@contextmanager
+def _probe_session(session):
+    # Use the session supplied by the caller and leave it open, or use a new session
+    if session is not None:
+        yield session
+        return
+    with new_session() as s:
+        yield s
+
+
 def _get_auth_method_from_response(response):
     # First, get the auth method from headers. Then, test credentials. Don't handle redirects - burden is on caller.
     log.debug('Request headers: %s', response.request.headers)
@@ -215,25 +263,25 @@ def _get_auth_method_from_response(response):
     if response.status_code != 401:
         raise TransportError('Unexpected response: %s %s' % (response.status_code, response.reason))
 
-    # Get auth type from headers
-    for key, val in response.headers.items():
-        if key.lower() == 'www-authenticate':
-            vals = _tokenize(val.lower())
-            for v in vals:
-                if v.startswith('realm'):
-                    realm = v.split('=')[1].strip('"')
-                    log.debug('realm: %s', realm)
-            # Prefer most secure auth method if more than one is offered. See discussion at
-            # http://docs.oracle.com/javase/7/docs/technotes/guides/net/http-auth.html
-            if 'digest' in vals:
-                log.debug('Auth type is %s', DIGEST)
-                return DIGEST
-            if 'ntlm' in vals:
-                log.debug('Auth type is %s', NTLM)
-                return NTLM
-            if 'basic' in vals:
-                log.debug('Auth type is %s', BASIC)
-                return BASIC
+    # Get auth type from headers. Multiple WWW-Authenticate headers are joined with commas.
+    val = response.headers.get('www-authenticate')
+    if val:
+        vals = _tokenize(val.lower())
+        for v in vals:
+            if v.startswith('realm'):
+                realm = v.split('=')[1].strip('"')
+                log.debug('realm: %s', realm)
+        # Prefer most secure auth method if more than one is offered. See discussion at
+        # http://docs.oracle.com/javase/7/docs/technotes/guides/net/http-auth.html
+        if 'digest' in vals:
+            log.debug('Auth type is %s', DIGEST)
+            return DIGEST
+        if 'ntlm' in vals:
+            log.debug('Auth type is %s', NTLM)
+            return NTLM
+        if 'basic' in vals:
+            log.debug('Auth type is %s', BASIC)
+            return BASIC
     raise UnauthorizedError('Got a 401, but no compatible auth type was reported by server')
 
 
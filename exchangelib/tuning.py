@@ -0,0 +1,179 @@
+# coding=utf-8
+"""
+Runtime tuning of the number of items per request of the pooled services (GetItem, CreateItem etc.)
+
+The static CHUNKSIZE of a service is a compromise that is wrong for both tiny and huge items, and for both fast and slow
+servers. A ChunkSizeTuner measures the throughput of real requests and converges on the chunk size with the best
+throughput for one service on one endpoint.
+
+Requests of pooled services run concurrently, so the throughput we care about is the aggregate throughput of all
+requests in flight, not the throughput of each request on its own. When requests share the available sessions, the
+latency of a single request favours smaller chunks than the aggregate throughput does. By Little's law, the aggregate
+throughput is the average number of items in flight divided by the latency. We track the number of requests in flight
+and weigh each measurement by the average concurrency during the request.
+"""
+from __future__ import unicode_literals
+
+import logging
+import time
+from contextlib import contextmanager
+from threading import Lock
+
+from .util import locked_shelve_open, user_cache_file
+
+log = logging.getLogger(__name__)
+
+CHUNKSIZE_PERSISTENT_STORAGE = user_cache_file('chunksizes')
+
+
+class ChunkSizeTuner(object):
+    """
+    Finds the chunk size with the best aggregate throughput (items per second) by hill-climbing on measurements of real
+    requests. Chunk sizes are picked from a geometric grid around the default CHUNKSIZE of the service. We stay at the
+    best known size, and every EXPLORE_INTERVAL requests we try the neighbouring size in the direction that was last
+    successful. If the neighbour has better throughput, it becomes the new best size. Otherwise, we try the other
+    direction next time.
+
+    The best size is persisted per endpoint so the next process can start where this one left off. Like the autodiscover
+    cache, the persistent storage must not contain sensitive information. We only store the endpoint URL, the service
+    name and the chunk size. The persistent storage is best-effort. If it can't be read or written, we start from the
+    default chunk size and keep the best size in memory.
+    """
+    MIN_CHUNKSIZE = 1
+    MAX_CHUNKSIZE = 1000
+    # Number of measurements of a chunk size before we trust its throughput
+    MIN_SAMPLES = 5
+    # Number of measurements of the best chunk size between each attempt at a neighbouring size
+    EXPLORE_INTERVAL = 10
+    # Weight of new measurements in the moving average of the throughput of a chunk size
+    ALPHA = 0.3
+
+    def __init__(self, service_endpoint, service_cls):
+        self.service_endpoint = service_endpoint
+        self.service_name = service_cls.SERVICE_NAME
+        self.sizes = self.get_sizes(service_cls.CHUNKSIZE)
+        self._best = self.sizes.index(service_cls.CHUNKSIZE)  # Index in self.sizes
+        persisted = self._load()
+        if persisted in self.sizes:
+            log.debug('%s: Using persisted chunk size %s for %s', self.service_endpoint, persisted, self.service_name)
+            self._best = self.sizes.index(persisted)
+        self._trial = None  # Index of the neighbour we're currently measuring, if any
+        self._direction = 1
+        self._rates = {}  # Moving average of items/sec per chunk size
+        self._samples = {}  # Number of measurements per chunk size
+        self._in_flight = 0  # Number of requests in flight
+        self._busy = 0.0  # The number of requests in flight, integrated over time
+        self._busy_updated = time.time()
+        self._lock = Lock()
+
+    @classmethod
+    def get_sizes(cls, chunksize):
+        # A geometric grid that contains 'chunksize' and has a factor of roughly sqrt(2) between neighbours
+        assert cls.MIN_CHUNKSIZE <= chunksize <= cls.MAX_CHUNKSIZE
+        sizes = {chunksize}
+        size = chunksize
+        while size > cls.MIN_CHUNKSIZE:
+            size = max(cls.MIN_CHUNKSIZE, min(size - 1, int(round(size / 2 ** 0.5))))
+            sizes.add(size)
+        size = chunksize
+        while True:
+            size = max(size + 1, int(round(size * 2 ** 0.5)))
+            if size > cls.MAX_CHUNKSIZE:
+                break
+            sizes.add(size)
+        return sorted(sizes)
+
+    @property
+    def chunksize(self):
+        with self._lock:
+            return self.sizes[self._best if self._trial is None else self._trial]
+
+    @contextmanager
+    def measure(self, n_items=None):
+        """
+        Wraps a request with 'n_items' items, and reports its throughput if the request succeeds. All requests must be
+        wrapped, so we know how many are in flight. Use 'n_items=None' for requests that should not be measured, e.g.
+        the last, smaller chunk of a call.
+        """
+        with self._lock:
+            self._update_busy(1)
+            started, busy_started = self._busy_updated, self._busy
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._update_busy(-1)
+                elapsed, busy = self._busy_updated - started, self._busy - busy_started
+        if n_items is not None and elapsed > 0:
+            self.report(n_items=n_items, elapsed=elapsed, concurrency=busy / elapsed)
+
+    def _update_busy(self, delta):
+        # Must be called with the lock held
+        now = time.time()
+        self._busy += self._in_flight * (now - self._busy_updated)
+        self._busy_updated = now
+        self._in_flight += delta
+
+    def report(self, n_items, elapsed, concurrency=1.0):
+        # Register that a request with 'n_items' items took 'elapsed' seconds, while on average 'concurrency' requests
+        # were in flight.
+        if elapsed <= 0 or n_items not in self.sizes:
+            # E.g. the last, smaller chunk of a call
+            return
+        rate = n_items * max(concurrency, 1.0) / float(elapsed)
+        with self._lock:
+            old_rate = self._rates.get(n_items)
+            self._rates[n_items] = rate if old_rate is None else self.ALPHA * rate + (1 - self.ALPHA) * old_rate
+            self._samples[n_items] = self._samples.get(n_items, 0) + 1
+            best_size = self.sizes[self._best]
+            if self._trial is None:
+                if n_items == best_size and self._samples[best_size] % self.EXPLORE_INTERVAL == 0:
+                    self._explore()
+                return
+            trial_size = self.sizes[self._trial]
+            if n_items != trial_size or self._samples[trial_size] < self.MIN_SAMPLES:
+                return
+            if self._rates[trial_size] > self._rates[best_size]:
+                log.debug('%s: Chunk size %s is faster than %s for %s (%.1f vs. %.1f items/sec)',
+                          self.service_endpoint, trial_size, best_size, self.service_name, self._rates[trial_size],
+                          self._rates[best_size])
+                self._best = self._trial
+                self._save(trial_size)
+            else:
+                self._direction = -self._direction
+            self._trial = None
+
+    def _explore(self):
+        trial = self._best + self._direction
+        if not 0 <= trial < len(self.sizes):
+            self._direction = -self._direction
+            trial = self._best + self._direction
+            if not 0 <= trial < len(self.sizes):
+                return
+        self._trial = trial
+        # Start counting from scratch, but keep the old moving average as a starting point
+        self._samples[self.sizes[trial]] = 0
+
+    @property
+    def _storage_file(self):
+        return CHUNKSIZE_PERSISTENT_STORAGE
+
+    @property
+    def _storage_key(self):
+        return str('%s %s' % (self.service_endpoint, self.service_name))
+
+    def _load(self):
+        try:
+            with locked_shelve_open(self._storage_file) as db:
+                return db.get(self._storage_key)
+        except Exception as e:
+            # E.g. the file is locked by another process, belongs to another user or is corrupt
+            log.warning('Could not read chunk sizes from %s: %s', self._storage_file, e)
+            return None
+
+    def _save(self, chunksize):
+        try:
+            with locked_shelve_open(self._storage_file) as db:
+                db[self._storage_key] = chunksize
+        except Exception as e:
+            log.warning('Could not write chunk sizes to %s: %s', self._storage_file, e)
@@ -1,39 +1,131 @@
 from __future__ import unicode_literals
 
+import getpass
 import itertools
 import logging
+import os
 import re
+import shelve
+import tempfile
 import time
-from copy import deepcopy
+from contextlib import contextmanager
 from datetime import datetime
 from decimal import Decimal
-from xml.etree.ElementTree import Element
+from threading import Lock, local
+from xml.etree.ElementTree import Element, ParseError
+from xml.sax.saxutils import escape as xml_escape
 
 from future.moves.urllib.parse import urlparse
+from lxml.etree import _Element as LxmlElement, XMLSyntaxError
 from future.utils import PY2
 from future.utils import raise_from
 from six import text_type, string_types
 
 from .errors import TransportError, RateLimitError, RedirectError, RelativeRedirect
 
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows
+    fcntl = None
+
 if PY2:
     from thread import get_ident
 
     class ConnectionResetError(OSError):
         pass
+
+
+    @contextmanager
+    def shelve_open(*args, **kwargs):
+        shelve_handle = shelve.open(*args, **kwargs)
+        try:
+            yield shelve_handle
+        finally:
+            shelve_handle.close()
 else:
     from threading import get_ident
 
+    shelve_open = shelve.open
+
+
+def user_cache_file(name):
+    # Returns the path of a cache file in the temp dir. The file name contains the name of the current user, so users
+    # don't share a cache file. A file created by another user may not be readable or writable by us.
+    try:
+        user = getpass.getuser()
+    except Exception:
+        # E.g. no user name in the environment and no entry in the password database
+        user = 'unknown'
+    return os.path.join(tempfile.gettempdir(), 'exchangelib.%s.%s.cache' % (re.sub(r'[^\w.-]', '_', user), name))
+
+
+@contextmanager
+def locked_shelve_open(filename):
+    # Like shelve_open(), but holds an exclusive lock on a separate lock file while the shelf is open, so processes
+    # sharing the file don't corrupt it. The dbm.dumb backend has no locking of its own. Only locks on platforms that
+    # have fcntl.
+    with open(filename + '.lock', 'a') as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        # The lock is released when the lock file is closed
+        with shelve_open(filename) as db:
+            yield db
+
 
 log = logging.getLogger(__name__)
 
-ElementType = type(Element('x'))  # Type is auto-generated inside cElementTree
+EtreeElement = type(Element('x'))  # Type is auto-generated inside cElementTree
+# Requests are built with ElementTree, but responses are parsed by the selected XML backend. For isinstance() checks.
+ElementType = (EtreeElement, LxmlElement)
 string_type = string_types[0]
 
 # Regex of UTF-8 control characters that are illegal in XML 1.0 (and XML 1.1)
 _illegal_xml_chars_RE = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1F\uD800-\uDFFF\uFFFE\uFFFF]')
 # UTF-8 byte order mark which may precede the XML from an Exchange server
 BOM = '\xef\xbb\xbf'
+BOM_BYTES = b'\xef\xbb\xbf'
+
+
+class LRUCache(object):
+    """
+    A dict-like cache that holds at most 'maxsize' entries, evicting the least recently used entries first. Lookups
+    don't take a lock, so cache hits are cheap even with many threads. Because of that, recency is only approximate
+    under contention, which is fine for a cache.
+    """
+    def __init__(self, maxsize):
+        assert maxsize >= 1
+        self.maxsize = maxsize
+        self._data = {}  # Maps key to a [value, last_used] list
+        self._clock = itertools.count()  # next() is atomic, so this is safe without a lock
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        entry = self._data.get(key)
+        if entry is None:
+            return default
+        entry[1] = next(self._clock)
+        return entry[0]
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._data[key] = [value, next(self._clock)]
+            if len(self._data) > self.maxsize:
+                # Evict the least recently used entries until the cache is three quarters full, so the cost of sorting
+                # is amortized over many inserts.
+                num_evict = len(self._data) - self.maxsize + self.maxsize // 4
+                for k, _ in sorted(self._data.items(), key=lambda i: i[1][1])[:num_evict]:
+                    del self._data[k]
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
 
 
 def chunkify(iterable, chunksize):
@@ -56,6 +148,25 @@ def chunkify(iterable, chunksize):
             yield chunk
 
 
+def chunkify_by_size(iterable, chunksize, max_size, size_func):
+    """
+    Like chunkify(), but also starts a new chunk when the total size of the items in a chunk would exceed ``max_size``.
+    ``size_func`` returns the size of an item. An item that is larger than ``max_size`` gets a chunk of its own.
+    """
+    chunk = []
+    total_size = 0
+    for i in iterable:
+        size = size_func(i)
+        if chunk and (len(chunk) == chunksize or total_size + size > max_size):
+            yield chunk
+            chunk = []
+            total_size = 0
+        chunk.append(i)
+        total_size += size
+    if chunk:
+        yield chunk
+
+
 def peek(iterable):
     """
     Checks if an iterable or iterator is empty and returns status and the rewinded iterable or iterator
@@ -70,11 +181,67 @@ def peek(iterable):
         return False, itertools.chain([first], iterable)
 
 
+# The library used to parse responses. 'etree' is xml.etree.ElementTree from the standard library. 'lxml' is
+# considerably faster on large responses. Requests are always built with ElementTree, because lxml doesn't allow the
+# prefixed element names ('t:ItemId' etc.) that we use.
+XML_BACKENDS = ('etree', 'lxml')
+_xml_backend = None
+# lxml parsers may be shared between threads, but then only one thread can use them at a time
+_lxml_parsers = local()
+
+
+def set_xml_backend(name):
+    """
+    Selects the XML backend used to parse responses. Call this before sending any requests, e.g. when configuring the
+    application. The initial backend is read from the EXCHANGELIB_XML_BACKEND environment variable.
+    """
+    global _xml_backend
+    if name not in XML_BACKENDS:
+        raise ValueError("'name' %r must be one of %s" % (name, XML_BACKENDS))
+    _xml_backend = name
+
+
+def get_xml_backend():
+    return _xml_backend
+
+
+set_xml_backend(os.environ.get('EXCHANGELIB_XML_BACKEND', 'etree'))
+
+# Parse like ElementTree does: without comments, processing instructions and entity expansion, and without a size limit
+# on text, because attachments can be large.
+LXML_PARSER_ARGS = dict(remove_comments=True, remove_pis=True, resolve_entities=False, huge_tree=True)
+
+
+def _get_lxml_parser():
+    try:
+        return _lxml_parsers.parser
+    except AttributeError:
+        from lxml.etree import XMLParser
+        _lxml_parsers.parser = XMLParser(**LXML_PARSER_ARGS)
+        return _lxml_parsers.parser
+
+
+def _fromstring(data):
+    # Parses bytes with the selected XML backend. Raises ParseError for invalid XML with all backends.
+    if _xml_backend == 'lxml':
+        from lxml.etree import fromstring
+        try:
+            return fromstring(data, parser=_get_lxml_parser())
+        except XMLSyntaxError as e:
+            raise_from(ParseError(text_type(e)), e)
+    from xml.etree.ElementTree import fromstring
+    return fromstring(data)
+
+
 def xml_to_str(tree, encoding='utf-8'):
-    from xml.etree.ElementTree import tostring
     # tostring returns bytecode unless encoding is 'unicode'. We ALWAYS want bytecode so we can convert to unicode
     if encoding == 'unicode':
         encoding = 'utf-8'
+    if isinstance(tree, LxmlElement):
+        from lxml.etree import tostring
+        # Tails are part of an element in lxml, but ElementTree doesn't serialize the tail of the top element
+        return tostring(tree, encoding=encoding, with_tail=False).decode(encoding)
+    from xml.etree.ElementTree import tostring
     return tostring(tree, encoding=encoding).decode(encoding)
 
 
@@ -151,16 +318,63 @@ def safe_xml_value(value, replacement='?'):
     return text_type(_illegal_xml_chars_RE.sub(replacement, value))
 
 
-# Keeps a cache of Element objects to deepcopy
-_deepcopy_cache = dict()
+# Escapes for XML attribute values in addition to &, < and >. Same as ElementTree, so values survive a round trip.
+_xml_attr_entities = {'"': '&quot;', '\n': '&#10;', '\r': '&#13;', '\t': '&#09;'}
+# Characters that an attribute value must not contain unless it is cleaned and escaped
+_xml_attr_special_RE = re.compile('[&<>"\n\r\t\x00-\x08\x0b\x0c\x0e-\x1F\uD800-\uDFFF\uFFFE\uFFFF]')
+
+
+def xml_attr_value(value):
+    # Cleans and escapes an attribute value. Most values, e.g. item IDs, need neither, so test for that first.
+    if _xml_attr_special_RE.search(value) is None:
+        return value
+    return xml_escape(safe_xml_value(value), _xml_attr_entities)
+
+
+class XMLWriter(object):
+    """
+    Writes XML directly to a buffer, without building an ElementTree first. Use this for simple payloads that are built
+    very often, e.g. long lists of item IDs. Text and attribute values are cleaned with safe_xml_value() and escaped.
+    The output is the same as what ElementTree would produce for the same elements.
+    """
+    def __init__(self):
+        self._parts = []
+
+    @staticmethod
+    def _attrs(attrs):
+        return ''.join(' %s="%s"' % (k, xml_attr_value(v)) for k, v in attrs)
+
+    def start(self, name, *attrs):
+        # 'attrs' are (name, value) tuples, to keep attribute order stable on all Python versions
+        self._parts.append('<%s%s>' % (name, self._attrs(attrs)))
+
+    def end(self, name):
+        self._parts.append('</%s>' % name)
+
+    def empty(self, name, *attrs):
+        self._parts.append('<%s%s />' % (name, self._attrs(attrs)))
+
+    def text(self, name, value, *attrs):
+        self._parts.append('<%s%s>%s</%s>' % (name, self._attrs(attrs), xml_escape(value_to_xml_text(value)), name))
+
+    def element(self, elem):
+        # Write an ElementTree element
+        self._parts.append(xml_to_str(elem))
+
+    def raw(self, xml):
+        # Write XML that is already serialized, e.g. a cached fragment
+        self._parts.append(xml)
+
+    def getvalue(self, encoding='utf-8'):
+        # Returns bytes, or text if 'encoding' is None
+        value = ''.join(self._parts)
+        return value if encoding is None else value.encode(encoding)
 
 
 def create_element(name, **attrs):
-    # copy.deepcopy() is an order of magnitude faster than creating a new Element() every time
-    key = (name, tuple(attrs.items()))  # dict requires key to be immutable
-    if name not in _deepcopy_cache:
-        _deepcopy_cache[key] = Element(name, **attrs)
-    return deepcopy(_deepcopy_cache[key])
+    # A new Element is cheaper than a copy of a cached template Element, let alone a deepcopy(). 'attrs' is a new dict
+    # on every call, so it's safe to hand it to the Element. See bench_xml.py.
+    return Element(name, attrs)
 
 
 def add_xml_child(tree, name, value):
@@ -169,20 +383,28 @@ def add_xml_child(tree, name, value):
     tree.append(set_xml_value(elem=create_element(name), value=value, version=None))
 
 
-def to_xml(text, encoding):
-    from xml.etree.ElementTree import fromstring, ParseError
-    processed = text.lstrip(BOM).encode(encoding or 'utf-8')
+def to_xml(text, encoding=None):
+    # 'text' is preferably the raw bytes of a response, e.g. requests.Response.content. The parsers detect the encoding
+    # and skip a BOM themselves, so bytes are parsed as-is. Text is encoded with 'encoding' first.
+    if isinstance(text, bytes):
+        processed = text
+        encoding = None
+    else:
+        processed = text.lstrip(BOM).encode(encoding or 'utf-8')
+        encoding = encoding or 'utf-8'
     try:
-        return fromstring(processed)
+        return _fromstring(processed)
     except ParseError:
         from io import BytesIO
         from lxml.etree import XMLParser, parse, tostring
         # Exchange servers may spit out the weirdest XML. lxml is pretty good at recovering from errors
         log.warning('Fallback to lxml processing of faulty XML')
-        magical_parser = XMLParser(encoding=encoding or 'utf-8', recover=True)
+        magical_parser = XMLParser(encoding=encoding, recover=True, **LXML_PARSER_ARGS)
         root = parse(BytesIO(processed), magical_parser)
         try:
-            return fromstring(tostring(root))
+            if _xml_backend == 'lxml' and root.getroot() is not None:
+                return root.getroot()
+            return _fromstring(tostring(root))
         except ParseError as e:
             line_no, col_no = e.lineno, e.offset
             try:
@@ -197,11 +419,112 @@ def to_xml(text, encoding):
 
 def is_xml(text):
     """
-    Helper function. Lightweight test if response is an XML doc
+    Helper function. Lightweight test if response is an XML doc. 'text' may also be bytes.
     """
+    if isinstance(text, bytes):
+        return text.startswith(b'<?xml') or text.startswith(BOM_BYTES + b'<?xml')
     return text.lstrip(BOM)[0:5] == '<?xml'
 
 
+class ChunkReader(object):
+    """
+    A read-only file-like object over an iterator of bytes chunks, e.g. requests.Response.iter_content()
+    """
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+
+    def read(self, size=-1):
+        # Parsers only need some data on each call, not exactly 'size' bytes
+        for chunk in self._chunks:
+            if chunk:
+                return chunk
+        return b''
+
+
+class ElementStream(object):
+    """
+    Parses an XML document incrementally from an iterator of bytes chunks. The tree is built like with fromstring(),
+    but only as far as the caller asks for: next_child() parses until the next child of an element starts, and finish()
+    parses until an element is complete. An element has its attributes as soon as it starts, but its text and children
+    are only guaranteed to be complete after finish(). Chunks are parsed one at a time, so the tree may already contain
+    elements from the rest of the current chunk.
+
+    iter_children() yields the children of an element as they are completed, and removes each child from the tree when
+    the caller asks for the next one, so the tree never holds much more than a chunk.
+    """
+    def __init__(self, chunks):
+        if _xml_backend == 'lxml':
+            from lxml.etree import iterparse
+            self._events = iterparse(ChunkReader(chunks), events=('start', 'end'), **LXML_PARSER_ARGS)
+        else:
+            from xml.etree.ElementTree import iterparse
+            self._events = iterparse(ChunkReader(chunks), events=('start', 'end'))
+        self._stack = []  # The elements that have started but not ended yet
+
+    def _next(self):
+        try:
+            event, elem = next(self._events)
+        except StopIteration:
+            raise ParseError('Unexpected end of document')
+        except XMLSyntaxError as e:
+            # Raise the same exception with all backends
+            raise_from(ParseError(text_type(e)), e)
+        if event == 'start':
+            self._stack.append(elem)
+        else:
+            self._stack.pop()
+        return event, elem
+
+    def _depth(self, elem):
+        # Returns the position of 'elem' in the stack, or None if 'elem' is complete
+        for i, e in enumerate(self._stack):
+            if e is elem:
+                return i
+        return None
+
+    def root(self):
+        # Parses until the root element starts, and returns it
+        assert not self._stack
+        event, elem = self._next()
+        return elem
+
+    def next_child(self, parent):
+        # Parses until the next child of 'parent' starts, and returns it. Children of 'parent' that have not been
+        # parsed completely are skipped. Returns None if 'parent' is complete.
+        depth = self._depth(parent)
+        if depth is None:
+            return None
+        while True:
+            event, elem = self._next()
+            if len(self._stack) == depth + 2 and event == 'start':
+                return elem
+            if len(self._stack) == depth:
+                return None
+
+    def find_child(self, parent, name):
+        # Like parent.find(name), but parses until a child named 'name' starts. Returns None if there is no such child.
+        while True:
+            child = self.next_child(parent)
+            if child is None or child.tag == name:
+                return child
+
+    def finish(self, elem):
+        # Parses until 'elem' is complete, and returns it
+        depth = self._depth(elem)
+        if depth is not None:
+            while len(self._stack) > depth:
+                self._next()
+        return elem
+
+    def iter_children(self, parent):
+        while True:
+            child = self.next_child(parent)
+            if child is None:
+                return
+            yield self.finish(child)
+            parent.remove(child)
+
+
 class DummyRequest(object):
     headers = {}
 
@@ -210,8 +533,15 @@ class DummyResponse(object):
     status_code = 401
     headers = {}
     text = ''
+    content = b''
     request = DummyRequest()
 
+    def iter_content(self, chunk_size=1, decode_unicode=False):
+        return iter(())
+
+    def close(self):
+        pass
+
 
 def get_domain(email):
     try:
@@ -257,7 +587,8 @@ def get_redirect_url(response, allow_relative=True, require_relative=False):
     return redirect_url, redirect_server, redirect_has_ssl
 
 
-def post_ratelimited(protocol, session, url, headers, data, timeout=None, verify=True, allow_redirects=False):
+def post_ratelimited(protocol, session, url, headers, data, timeout=None, verify=True, allow_redirects=False,
+                     stream=False):
     """
     There are two error-handling policies implemented here: a fail-fast policy intended for stnad-alone scripts which
     fails on all responses except HTTP 200. The other policy is intended for long-running tasks that need to respect
@@ -276,6 +607,9 @@ def post_ratelimited(protocol, session, url, headers, data, timeout=None, verify
     If the connecting user has hit a throttling policy, then the server will start to malfunction in many interesting
     ways, but never actually tell the user what is happening. There is no way to distinguish this situation from other
     malfunctions. The only cure is to stop making requests.
+
+    If 'stream' is True, the response body is not downloaded before it is consumed, e.g. with r.iter_content(). The
+    caller must close the response before the session is used again.
     """
     from socket import timeout as SocketTimeout
     import requests.exceptions
@@ -308,9 +642,10 @@ Response headers: %(response_headers)s'''
             log.debug('Session %(session_id)s thread %(thread_id)s: retry %(i)s timeout %(timeout)s POST\'ing to '
                       '%(url)s after %(wait)s s wait', log_vals)
             d1 = datetime.now()
+            started = time.time()
             try:
                 r = session.post(url=url, headers=headers, data=data, allow_redirects=False, timeout=timeout,
-                                 verify=verify)
+                                 verify=verify, stream=stream)
             except (requests.exceptions.ChunkedEncodingError, requests.exceptions.ConnectionError, ConnectionResetError,
                     requests.exceptions.ReadTimeout, SocketTimeout):
                 log.debug(
@@ -320,13 +655,19 @@ Response headers: %(response_headers)s'''
                 r.request.headers = headers
                 r.headers = {'DummyResponseHeader': None}
             d2 = datetime.now()
+            if r.status_code == 503:
+                protocol.pool_controller.throttled(started=started)
+            elif r.status_code == 200:
+                protocol.pool_controller.success(started=started, response_time=time.time() - started)
             log_vals['response_time'] = text_type(d2 - d1)
             log_vals['status_code'] = r.status_code
             log_vals['request_headers'] = r.request.headers
             log_vals['response_headers'] = r.headers
             log.debug(log_msg, log_vals)
             log.debug('Request data: %s', data)
-            log.debug('Response data: %s', getattr(r, 'text'))
+            if log.isEnabledFor(logging.DEBUG):
+                # Don't download a streamed response body unless we're actually logging it
+                log.debug('Response data: %s', r.text)
             # The genericerrorpage.htm/internalerror.asp is ridiculous behaviour for random outages. Redirect to
             # '/internalsite/internalerror.asp' or '/internalsite/initparams.aspx' is caused by e.g. SSL certificate
             # f*ckups on the Exchange server.
@@ -393,11 +734,14 @@ Response headers: %(response_headers)s'''
         protocol.retire_session(session)
         raise
     if r.status_code != 200:
-        if r.text and is_xml(r.text):
+        if r.content and is_xml(r.content):
             # Some genius at Microsoft thinks it's OK to send 500 error messages with valid SOAP response
             log.debug('Got status code %s but trying to parse content anyway', r.status_code)
         else:
             # This could be anything. Let higher layers handle this
+            if r.status_code == 401:
+                # The auth type we have for the server may be out of date
+                protocol.invalidate_cached_metadata()
             protocol.retire_session(session)
             log_msg += '\nRequest data: %(data)s'
             log_vals['data'] = data
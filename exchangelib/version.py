@@ -4,14 +4,13 @@ from __future__ import unicode_literals
 import logging
 from xml.etree.ElementTree import ParseError
 
-import requests.adapters
-import requests.sessions
 from future.utils import raise_from, python_2_unicode_compatible
 from six import text_type
 
 from .errors import UnauthorizedError, TransportError, EWSWarning
+from .sessions import new_session
 from .transport import TNS, SOAPNS, dummy_xml, get_auth_instance
-from .util import is_xml, to_xml, post_ratelimited
+from .util import is_xml, to_xml, post_ratelimited, xml_to_str
 
 log = logging.getLogger(__name__)
 
@@ -174,26 +173,43 @@ class Version(object):
         corresponding API version first.
         """
         log.debug('Asking server for version info')
+        return cls.guess_with_hint(protocol=protocol, shortname=cls.get_shortname(protocol=protocol))
+
+    @classmethod
+    def guess_with_hint(cls, protocol, shortname=None, api_version=None):
+        # Like guess(), but with a 'shortname' that the caller already got from get_shortname(), or an 'api_version'
+        # that the caller expects the server to support.
+        if api_version is None and shortname:
+            api_version = VERSIONS[shortname][0]
+        return cls._guess_version_from_service(protocol=protocol, hint=api_version)
+
+    @classmethod
+    def get_shortname(cls, protocol, session=None):
+        # Returns the 'shortname' from types.xsd, or None if we can't get it. If 'session' is set, it is used for the
+        # request instead of a new session.
+        #
         # We can't use a session object from the protocol pool for docs because sessions are created with service auth.
         try:
             auth = get_auth_instance(credentials=protocol.credentials, auth_type=protocol.docs_auth_type)
             shortname = cls._get_shortname_from_docs(auth=auth, types_url=protocol.types_url,
-                                                     verify_ssl=protocol.verify_ssl)
+                                                     verify_ssl=protocol.verify_ssl, session=session)
             log.debug('Shortname according to %s: %s', protocol.types_url, shortname)
         except (TransportError, UnauthorizedError) as e:
             log.info(text_type(e))
             shortname = None
-        api_version = VERSIONS[shortname][0] if shortname else None
-        return cls._guess_version_from_service(protocol=protocol, hint=api_version)
+        return shortname
 
     @staticmethod
-    def _get_shortname_from_docs(auth, types_url, verify_ssl):
+    def _get_shortname_from_docs(auth, types_url, verify_ssl, session=None):
         # Get the server version from types.xsd. We can't necessarily use the service auth type since it may not be the
         # same as the auth type for docs.
         log.debug('Getting %s with auth type %s', types_url, auth.__class__.__name__)
         # Some servers send an empty response if we send 'Connection': 'close' header
-        with requests.sessions.Session() as s:
-            r = s.get(url=types_url, auth=auth, allow_redirects=False, stream=False, verify=verify_ssl)
+        if session is None:
+            with new_session() as s:
+                r = s.get(url=types_url, auth=auth, allow_redirects=False, stream=False, verify=verify_ssl)
+        else:
+            r = session.get(url=types_url, auth=auth, allow_redirects=False, stream=False, verify=verify_ssl)
         log.debug('Request headers: %s', r.request.headers)
         log.debug('Response code: %s', r.status_code)
         log.debug('Response headers: %s', r.headers)
@@ -209,12 +225,12 @@ class Version(object):
             if 'The referenced account is currently locked out' in r.text:
                 raise TransportError('The service account is currently locked out')
             raise TransportError('Unexpected HTTP status %s when getting %s (%s)' % (r.status_code, types_url, r.text))
-        if not is_xml(r.text):
+        if not is_xml(r.content):
             raise TransportError('Unexpected result when getting %s. Maybe this is not an EWS server?%s' % (
                 types_url,
                 '\n\n%s[...]' % r.text[:200] if len(r.text) > 200 else '\n\n%s' % r.text if r.text else '',
             ))
-        return to_xml(r.text, encoding=r.encoding).get('version')
+        return to_xml(r.content).get('version')
 
     @classmethod
     def _guess_version_from_service(cls, protocol, hint=None):
@@ -261,38 +277,42 @@ class Version(object):
                 raise TransportError('The service account is currently locked out')
             raise TransportError('Unexpected HTTP status %s when getting %s (%s)' % (
                 r.status_code, protocol.service_endpoint, r.text))
-        log.debug('Response data: %s', r.text)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('Response data: %s', r.text)
         try:
-            header = to_xml(r.text, encoding=r.encoding).find('{%s}Header' % SOAPNS)
+            header = to_xml(r.content).find('{%s}Header' % SOAPNS)
             if header is None:
                 raise ParseError()
         except ParseError as e:
             raise_from(EWSWarning('Unknown XML response from %s (response: %s)' % (protocol.service_endpoint,
                                                                                    r.text)), e)
-        info = header.find('{%s}ServerVersionInfo' % TNS)
-        if info is None:
-            raise TransportError('No ServerVersionInfo in response: %s' % r.text)
-
-        version = cls.from_response(requested_api_version=api_version, response=r)
+        version = cls.from_soap_header(requested_api_version=api_version, header=header)
         log.debug('Service version is: %s', version)
         return version
 
     @classmethod
     def from_response(cls, requested_api_version, response):
         try:
-            header = to_xml(response.text, encoding=response.encoding).find('{%s}Header' % SOAPNS)
+            header = to_xml(response.content).find('{%s}Header' % SOAPNS)
             if header is None:
                 raise ParseError()
         except ParseError as e:
             raise_from(EWSWarning('Unknown XML response from %s (response: %s)' % (response, response.text)), e)
+        return cls.from_soap_header(requested_api_version=requested_api_version, header=header)
+
+    @classmethod
+    def from_soap_header(cls, requested_api_version, header):
+        # 'header' is the parsed SOAP header of a response, or None if the response had none
+        if header is None:
+            raise TransportError('No header in SOAP response')
         info = header.find('{%s}ServerVersionInfo' % TNS)
         if info is None:
-            raise TransportError('No ServerVersionInfo in response: %s' % response.text)
+            raise TransportError('No ServerVersionInfo in header: %s' % xml_to_str(header))
 
         try:
             build = Build.from_xml(info)
         except ValueError:
-            raise TransportError('Bad ServerVersionInfo in response: %s' % response.text)
+            raise TransportError('Bad ServerVersionInfo in header: %s' % xml_to_str(header))
         # Not all Exchange servers send the Version element
         api_version_from_server = info.get('Version') or build.api_version()
         if api_version_from_server != requested_api_version:
@@ -6,6 +6,7 @@ import os
 from yaml import load
 
 from exchangelib import DELEGATE, services, Credentials, Configuration, Account, EWSDateTime, EWSTimeZone, CalendarItem
+from exchangelib.protocol import BaseProtocol
 
 logging.basicConfig(level=logging.WARNING)
 
@@ -21,6 +22,9 @@ tz = EWSTimeZone.timezone('US/Pacific')
 
 t0 = datetime.now()
 
+# Let the chunk sizes of CreateItem and DeleteItem converge over the test runs
+BaseProtocol.AUTOTUNE_CHUNKSIZE = True
+
 config = Configuration(server=settings['server'],
                        credentials=Credentials(settings['username'], settings['password'], is_service_account=True),
                        verify_ssl=settings['verify_ssl'])
@@ -61,13 +65,15 @@ def avg(delta, n):
     return n / (d if d else 1)
 
 
-def perf_test(cbs, dbs, ps):
+def chunksizes():
+    return (config.protocol.get_chunksize_tuner(services.CreateItem).chunksize,
+            config.protocol.get_chunksize_tuner(services.DeleteItem).chunksize)
+
+
+def perf_test():
     t2 = datetime.now()
 
-    services.CreateItem.CHUNKSIZE = cbs
-    services.DeleteItem.CHUNKSIZE = dbs
-    config.protocol.poolsize = ps
-    print(('Config: batch %s/%s pool %s' % (cbs, dbs, ps)))
+    print(('Config: batch %s/%s pool %s' % (chunksizes() + (config.protocol.pool_controller.concurrency,))))
 
     ids = cal.bulk_create(items=calitems)
 
@@ -97,41 +103,11 @@ def perf_test(cbs, dbs, ps):
     return avg_create, avg_fetch, avg_delete, total
 
 
-from datetime import timedelta
 from time import sleep
 
-best_c = 0
-best_d = 0
-best_t = timedelta.max
-best_cbs = 0
-best_dbs = 0
-best_ps = 0
-
-
-def check(c, d, t, cbs, dbs, ps):
-    global best_c, best_d, best_t, best_cbs, best_dbs, best_ps
-    if c < best_c:
-        best_c, best_cbs, best_ps = c, cbs, ps
-        print(('New best save time: %s' % c))
-    if d < best_d:
-        best_d, best_dbs, best_ps = d, dbs, ps
-        print(('New best delete time: %s' % d))
-    if t < best_t:
-        best_t = t
-        print(('New best total time: %s' % t))
-
-
-def run(cbs, dbs, ps):
-    c, f, d, t = perf_test(cbs, dbs, ps)
-    check(c, d, t, cbs, dbs, ps)
+for _ in range(5):
+    perf_test()
     # Let server cool off a bit. Otherwise perf numbers deteriorate over time even though the same settings are used.
     sleep(60)
 
-
-for poolsize in (2, 2, 2):
-    for batchsize in (25, 25, 25):
-        run(batchsize, batchsize, poolsize)
-
-print(('Best batch/poolsize for create: %s / %s (%s / sec)' % (best_cbs, best_ps, best_c)))
-print(('Best batch/poolsize for delete: %s / %s (%s / sec)' % (best_dbs, best_ps, best_d)))
-print(('Best total time: %s' % best_t))
+print(('Tuned batch size for create/delete: %s / %s' % chunksizes()))
@@ -23,6 +23,8 @@ setup(
     keywords='Exchange EWS autodiscover',
     install_requires=['requests>=2.7', 'requests_ntlm>=0.2.0', 'dnspython>=1.14.0', 'pytz', 'lxml',
                       'cached_property', 'future', 'six'],
+    # NTLM auth with the 'urllib3' HTTP backend, see sessions.py
+    extras_require={'urllib3': ['pyspnego', 'cryptography']},
     packages=['exchangelib'],
     tests_require=['PyYAML'],
     test_suite='tests',
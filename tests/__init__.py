@@ -1,39 +1,58 @@
 # coding=utf-8
+import base64
 import datetime
+import gc
+import getpass
+import hashlib
 import os
+import pickle
 import random
+import socket
 import string
+import tempfile
+import threading
 import time
 import unittest
+from copy import copy, deepcopy
 from decimal import Decimal
 
 import requests
 from six import PY2, string_types, text_type
+from six.moves.BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from six.moves.socketserver import ThreadingMixIn
 from yaml import load
-from xml.etree.ElementTree import ParseError
+from xml.etree.ElementTree import ParseError, fromstring
 
 from exchangelib import close_connections
 from exchangelib.account import Account
 from exchangelib.autodiscover import AutodiscoverProtocol, discover
 from exchangelib.configuration import Configuration
-from exchangelib.credentials import DELEGATE, Credentials
+from exchangelib.credentials import DELEGATE, IMPERSONATION, Credentials
 from exchangelib.errors import RelativeRedirect, ErrorItemNotFound, ErrorInvalidOperation, AutoDiscoverRedirect, \
-    AutoDiscoverCircularRedirect, AutoDiscoverFailed, ErrorNonExistentMailbox
+    AutoDiscoverCircularRedirect, AutoDiscoverFailed, ErrorNonExistentMailbox, TransportError
 from exchangelib.ewsdatetime import EWSDateTime, EWSDate, EWSTimeZone, UTC, UTC_NOW
+from exchangelib.executor import SharedExecutor, ExecutorQuota, SharedProcessPool
 from exchangelib.folders import CalendarItem, Attendee, Mailbox, Message, ExtendedProperty, Choice, Email, Contact, \
     Task, EmailAddress, PhysicalAddress, PhoneNumber, IndexedField, RoomList, Calendar, DeletedItems, Drafts, Inbox, \
     Outbox, SentItems, JunkEmail, Messages, Tasks, Contacts, Item, AnyURI, Body, HTMLBody, FileAttachment, \
-    ItemAttachment, Attachment, ALL_OCCURRENCIES, MimeContent, MessageHeader
-from exchangelib.protocol import BaseProtocol
+    ItemAttachment, Attachment, ALL_OCCURRENCIES, MimeContent, MessageHeader, ItemDecoder, Folder
+from exchangelib.protocol import BaseProtocol, SessionPoolController, EndpointCache
 from exchangelib.queryset import QuerySet, DoesNotExist, MultipleObjectsReturned
 from exchangelib.restriction import Restriction, Q
-from exchangelib.services import GetServerTimeZones, GetRoomLists, GetRooms
-from exchangelib.transport import NTLM
-from exchangelib.util import xml_to_str, chunkify, peek, get_redirect_url, isanysubclass, to_xml, BOM
-from exchangelib.version import Build
+from exchangelib.sessions import HTTP_BACKENDS, new_session, set_http_backend, get_http_backend
+from exchangelib.services import GetServerTimeZones, GetRoomLists, GetRooms, GetItem, FindItem, TNS, MNS
+from exchangelib.transport import NTLM, BASIC, DIGEST, SOAPNS, wrap, serialize_body, get_auth_instance, \
+    get_service_authtype
+from exchangelib.tuning import ChunkSizeTuner
+from exchangelib.util import xml_to_str, chunkify, chunkify_by_size, peek, get_redirect_url, isanysubclass, to_xml, \
+    BOM, BOM_BYTES, is_xml, ElementType, XML_BACKENDS, set_xml_backend, get_xml_backend, LRUCache, XMLWriter, \
+    create_element, add_xml_child, ElementStream, DummyRequest, post_ratelimited
+from exchangelib.version import Build, Version
 
 if PY2:
     FileNotFoundError = OSError
+else:
+    import asyncio
 
 
 class BuildTest(unittest.TestCase):
@@ -147,9 +166,31 @@ class RestrictionTest(unittest.TestCase):
     </t:And>
 </m:Restriction>'''
         self.assertEqual(xml_to_str(r.xml), ''.join(l.lstrip() for l in result.split('\n')))
-        # from_source() calls from parser.expr which is a security risk. Make sure stupid things can't happen
+        # from_source() only parses the source, but make sure stupid things can't happen
         with self.assertRaises(SyntaxError):
             Restriction.from_source('raise Exception()', folder_class=Calendar)
+        with self.assertRaises(ValueError):
+            Restriction.from_source('__import__("os").getcwd()', folder_class=Calendar)
+
+    def test_parse_cache(self):
+        source = "subject == 'foo' or location in 'bar'"
+        r = Restriction.from_source(source, folder_class=Calendar)
+        self.assertIs(Restriction.from_source(source, folder_class=Calendar).q, r.q)
+        self.assertEqual(r.q.expr(), "calendar:Location contains 'bar' OR item:Subject == 'foo'")
+        # Field names are translated per folder class
+        with self.assertRaises(ValueError):
+            Restriction.from_source(source, folder_class=Inbox)
+        for source in ("subject == 'a' < 'b'", "'foo' == subject", "subject == 42", "subject is 'foo'"):
+            with self.assertRaises(ValueError):
+                Restriction.from_source(source, folder_class=Calendar)
+        from exchangelib.restriction import _source_cache
+        Restriction.set_source_cache_size(2)
+        try:
+            for i in range(5):
+                Restriction.from_source("subject == '%s'" % i, folder_class=Calendar)
+            self.assertLessEqual(len(_source_cache), 2)
+        finally:
+            Restriction.set_source_cache_size(1000)
 
     def test_q(self):
         tz = EWSTimeZone.timezone('Europe/Copenhagen')
@@ -191,6 +232,45 @@ class RestrictionTest(unittest.TestCase):
         with self.assertRaises(ValueError):
             Restriction(q.translate_fields(folder_class=Calendar))
 
+    def test_q_xml_cache(self):
+        q = Q(subject='foo', categories__contains='bar')
+        xml = q.to_xml_str(folder_class=Calendar)
+        self.assertEqual(xml, xml_to_str(q.to_xml(folder_class=Calendar)))
+        # Structurally identical Q objects share the cached XML
+        self.assertIs(Q(subject='foo', categories__contains='bar').to_xml_str(folder_class=Calendar), xml)
+        self.assertIs(str(Restriction(q.translate_fields(folder_class=Calendar))), xml)
+        # A changed Q object must not get the old XML
+        q = Q(subject='foo')
+        xml = q.to_xml_str(folder_class=Calendar)
+        self.assertIn('IsEqualTo', xml)
+        self.assertIn('IsNotEqualTo', (~q).to_xml_str(folder_class=Calendar))
+        self.assertIsNone(Q().to_xml_str(folder_class=Calendar))
+
+    def test_q_immutable(self):
+        q = Q(subject='foo', categories__contains='bar')
+        with self.assertRaises(AttributeError):
+            q.field = 'baz'
+        self.assertIs(copy(q), q)
+        self.assertIs(deepcopy(q), q)
+        self.assertEqual(pickle.loads(pickle.dumps(q)), q)
+        # Operators and translation return new objects that share the unchanged children
+        q2 = q & Q(location='baz')
+        self.assertIs(q2.children[0], q)
+        translated = q.translate_fields(folder_class=Calendar)
+        self.assertIsNot(translated, q)
+        self.assertFalse(q.translated)
+        self.assertEqual({c.field for c in q.children}, {'subject', 'categories'})
+        self.assertEqual({c.field for c in translated.children}, {'item:Subject', 'item:Categories'})
+        self.assertIs(translated.translate_fields(folder_class=Calendar), translated)
+        # Inverting twice gets us back where we started
+        leaf = Q(subject='foo')
+        self.assertEqual((~leaf).op, Q.NE)
+        self.assertEqual(leaf.op, Q.EQ)
+        self.assertEqual(~~leaf, leaf)
+        self.assertEqual((~~q).expr(), q.expr())
+        self.assertEqual((~q).conn_type, Q.NOT)
+        self.assertEqual(q.conn_type, Q.AND)
+
     def test_q_expr(self):
         self.assertEqual(Q().expr(), None)
         self.assertEqual((~Q()).expr(), None)
@@ -225,6 +305,19 @@ class UtilTest(unittest.TestCase):
         seq = (i for i in range(5))
         self.assertEqual(list(chunkify(seq, chunksize=2)), [[0, 1], [2, 3], [4]])
 
+    def test_chunkify_by_size(self):
+        seq = ['a', 'bb', 'ccc', 'dddd', 'e', 'f', 'g']
+        # Capped by count
+        self.assertEqual(list(chunkify_by_size(seq, chunksize=3, max_size=100, size_func=len)),
+                         [['a', 'bb', 'ccc'], ['dddd', 'e', 'f'], ['g']])
+        # Capped by size
+        self.assertEqual(list(chunkify_by_size(seq, chunksize=3, max_size=4, size_func=len)),
+                         [['a', 'bb'], ['ccc'], ['dddd'], ['e', 'f', 'g']])
+        # Items larger than max_size get a chunk of their own
+        self.assertEqual(list(chunkify_by_size(seq, chunksize=10, max_size=2, size_func=len)),
+                         [['a'], ['bb'], ['ccc'], ['dddd'], ['e', 'f'], ['g']])
+        self.assertEqual(list(chunkify_by_size([], chunksize=10, max_size=2, size_func=len)), [])
+
     def test_peek(self):
         # Test peeking into various sequence types
 
@@ -293,6 +386,1232 @@ class UtilTest(unittest.TestCase):
         to_xml(BOM+'<?xml version="1.0" encoding="UTF-8"?><foo>&broken</foo>', encoding='ascii')
         with self.assertRaises(ParseError):
             to_xml('foo', encoding='ascii')
+        # Bytes are parsed as-is
+        self.assertEqual(to_xml('<?xml version="1.0" encoding="UTF-8"?><foo>\xe6</foo>'.encode('utf-8')).text, '\xe6')
+        self.assertEqual(to_xml(BOM_BYTES + b'<?xml version="1.0" encoding="UTF-8"?><foo>bar</foo>').text, 'bar')
+        self.assertEqual(to_xml(BOM_BYTES + b'<?xml version="1.0" encoding="UTF-8"?><foo>&broken</foo>').tag, 'foo')
+        with self.assertRaises(ParseError):
+            to_xml(b'foo')
+        self.assertTrue(is_xml(BOM_BYTES + b'<?xml version="1.0"?><foo/>'))
+        self.assertTrue(is_xml(b'<?xml version="1.0"?><foo/>'))
+        self.assertFalse(is_xml(b'<html></html>'))
+
+    def test_xml_backends(self):
+        xml = (
+            '<?xml version="1.0" encoding="utf-8"?><t:Message xmlns:t="%s"><!-- Comment --><t:ItemId Id="AAA" '
+            'ChangeKey="BBB"/><t:Subject>Hello \xe6</t:Subject><t:Body BodyType="HTML">World</t:Body>'
+            '<t:Categories><t:String>foo</t:String></t:Categories><t:IsRead>true</t:IsRead></t:Message>' % TNS
+        ).encode('utf-8')
+        with self.assertRaises(ValueError):
+            set_xml_backend('foo')
+        old_backend = get_xml_backend()
+        try:
+            items = {}
+            for backend in XML_BACKENDS:
+                set_xml_backend(backend)
+                self.assertIsInstance(to_xml(xml), ElementType)
+                self.assertEqual(len(to_xml(xml)), 5)  # Comments are dropped
+                self.assertEqual(to_xml(xml.replace(b'World', b'&broken')).tag, '{%s}Message' % TNS)
+                with self.assertRaises(ParseError):
+                    to_xml(b'foo')
+                self.assertIn('ItemId xmlns:', xml_to_str(to_xml(xml)[0]))
+                stream = ElementStream(iter([xml[:100], xml[100:]]))
+                self.assertEqual([e.tag for e in stream.iter_children(stream.root())],
+                                 ['{%s}%s' % (TNS, t) for t in ('ItemId', 'Subject', 'Body', 'Categories', 'IsRead')])
+                with self.assertRaises(ParseError):
+                    stream = ElementStream(iter([xml[:100]]))
+                    list(stream.iter_children(stream.root()))
+                items[backend] = Message.from_xml(elem=to_xml(xml))
+            self.assertEqual(repr(items['lxml']), repr(items['etree']))
+            self.assertEqual(items['lxml'].subject, 'Hello \xe6')
+        finally:
+            set_xml_backend(old_backend)
+
+    def test_lru_cache(self):
+        cache = LRUCache(maxsize=4)
+        for i in range(4):
+            cache[i] = i * 10
+        self.assertEqual(cache.get(0), 0)  # 0 is now the most recently used
+        cache[4] = 40
+        # The cache was shrunk by a quarter, starting with the least recently used entries
+        self.assertEqual(len(cache), 3)
+        self.assertNotIn(1, cache)
+        self.assertNotIn(2, cache)
+        self.assertIn(0, cache)
+        self.assertIsNone(cache.get(1))
+        self.assertEqual(cache.get(1, 'foo'), 'foo')
+
+    def test_xml_writer(self):
+        # XMLWriter must produce the same XML as ElementTree
+        elem = create_element('m:Foo', Bar='a"b<c>&\nd')
+        child = create_element('t:ItemId')
+        child.set('Id', 'AAMk+/=')
+        child.set('ChangeKey', 'CQAA')
+        elem.append(child)
+        add_xml_child(elem, 't:Subject', 'x < y & \x03z')
+        add_xml_child(elem, 't:IsRead', True)
+        writer = XMLWriter()
+        writer.start('m:Foo', ('Bar', 'a"b<c>&\nd'))
+        writer.empty('t:ItemId', ('Id', 'AAMk+/='), ('ChangeKey', 'CQAA'))
+        writer.text('t:Subject', 'x < y & \x03z')
+        writer.text('t:IsRead', True)
+        writer.end('m:Foo')
+        self.assertEqual(writer.getvalue(), xml_to_str(elem).encode('utf-8'))
+
+    def test_wrap(self):
+        class MockAccount(object):
+            access_type = IMPERSONATION
+            primary_smtp_address = 'foo@example.com'
+
+        content = create_element('m:GetItem')
+        add_xml_child(content, 't:Foo', 'bar & baz')
+        self.assertEqual(
+            wrap(content=content, version='Exchange2010', account=None),
+            b'<?xml version="1.0" encoding="utf-8"?><s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/" '
+            b'xmlns:t="http://schemas.microsoft.com/exchange/services/2006/types" '
+            b'xmlns:m="http://schemas.microsoft.com/exchange/services/2006/messages"><s:Header>'
+            b'<t:RequestServerVersion Version="Exchange2010" /></s:Header><s:Body><m:GetItem>'
+            b'<t:Foo>bar &amp; baz</t:Foo></m:GetItem></s:Body></s:Envelope>'
+        )
+        # Envelopes are cached per version and impersonated account, and pre-serialized content is accepted
+        wrapped = wrap(content=serialize_body(content), version='Exchange2013', account=MockAccount())
+        self.assertEqual(wrapped, wrap(content=content, version='Exchange2013', account=MockAccount()))
+        self.assertIn(b'<t:RequestServerVersion Version="Exchange2013" />', wrapped)
+        self.assertIn(b'<t:PrimarySmtpAddress>foo@example.com</t:PrimarySmtpAddress>', wrapped)
+        self.assertNotIn(b'PrimarySmtpAddress', wrap(content=content, version='Exchange2013', account=None))
+
+
+class SessionPoolControllerTest(unittest.TestCase):
+    def test_aimd(self):
+        c = SessionPoolController(initial=4, maximum=8)
+        self.assertEqual(c.concurrency, 4)
+        # Additive increase: roughly one session per round of successful requests
+        for _ in range(4):
+            c.success(started=time.time(), response_time=0.1)
+        self.assertEqual(c.concurrency, 4)
+        for _ in range(5):
+            c.success(started=time.time(), response_time=0.1)
+        self.assertEqual(c.concurrency, 5)
+        # Never beyond the maximum
+        for _ in range(100):
+            c.success(started=time.time(), response_time=0.1)
+        self.assertEqual(c.concurrency, 8)
+        # Multiplicative decrease, but only once for requests sent before the previous decrease
+        started = time.time()
+        c.throttled(started=started)
+        self.assertEqual(c.concurrency, 4)
+        c.throttled(started=started)
+        self.assertEqual(c.concurrency, 4)
+        for _ in range(10):
+            c.throttled(started=time.time() + 1)
+        self.assertEqual(c.concurrency, 1)
+
+    def test_latency(self):
+        c = SessionPoolController(initial=8, maximum=8)
+        for _ in range(c.LATENCY_WINDOW):
+            c.success(started=time.time(), response_time=0.1)
+        self.assertEqual(c.concurrency, 8)
+        for _ in range(c.LATENCY_WINDOW):
+            c.success(started=time.time() + 1, response_time=1.0)
+        self.assertEqual(c.concurrency, 4)
+
+    def test_session_errors(self):
+        # A session that can't be created doesn't use up a slot of the pool
+        from six.moves import queue
+
+        class MockProtocol(BaseProtocol):
+            def create_session(self):
+                raise TransportError('No session')
+
+        protocol = MockProtocol(service_endpoint='https://example.com/EWS/Exchange.asmx',
+                                credentials=Credentials('DOMAIN\\user', 'secret'), auth_type=None, verify_ssl=True)
+        protocol._session_pool = queue.LifoQueue()
+        self.assertEqual(protocol.pool_controller.maximum, 2 * protocol.SESSION_POOLSIZE)
+        for _ in range(protocol.pool_controller.concurrency):
+            with self.assertRaises(TransportError):
+                protocol.get_session()
+        self.assertEqual(protocol._sessions_in_use, 0)
+
+
+class ChunkSizeTunerTest(unittest.TestCase):
+    def test_sizes(self):
+        self.assertEqual(ChunkSizeTuner.get_sizes(25)[:8], [1, 2, 3, 4, 6, 9, 13, 18])
+        self.assertIn(25, ChunkSizeTuner.get_sizes(25))
+        self.assertEqual(ChunkSizeTuner.get_sizes(1)[:3], [1, 2, 3])
+        self.assertEqual(ChunkSizeTuner.get_sizes(1000)[-1], 1000)
+
+    def test_convergence(self):
+        storage_file = os.path.join(tempfile.mkdtemp(), 'chunksizes')
+
+        class MockTuner(ChunkSizeTuner):
+            _storage_file = storage_file
+
+        class MockService(object):
+            SERVICE_NAME = 'CreateItem'
+            CHUNKSIZE = 25
+
+        def elapsed(n):
+            # Fixed request overhead and a cost per item that grows with the request size. Throughput peaks at 71
+            return 0.5 + 0.01 * n + 0.0001 * n * n
+
+        tuner = MockTuner(service_endpoint='https://example.com/EWS/Exchange.asmx', service_cls=MockService)
+        self.assertEqual(tuner.chunksize, 25)
+        for _ in range(1000):
+            n = tuner.chunksize
+            tuner.report(n_items=n, elapsed=elapsed(n))
+        self.assertIn(tuner.sizes[tuner._best], (49, 69, 98))
+        # The result is persisted per endpoint
+        new_tuner = MockTuner(service_endpoint='https://example.com/EWS/Exchange.asmx', service_cls=MockService)
+        self.assertEqual(new_tuner.chunksize, tuner.sizes[tuner._best])
+        new_tuner = MockTuner(service_endpoint='https://example.org/EWS/Exchange.asmx', service_cls=MockService)
+        self.assertEqual(new_tuner.chunksize, 25)
+
+    def test_aggregate_throughput(self):
+        class MockTuner(ChunkSizeTuner):
+            _storage_file = os.path.join(tempfile.mkdtemp(), 'chunksizes')
+
+        class MockService(object):
+            SERVICE_NAME = 'CreateItem'
+            CHUNKSIZE = 25
+
+        tuner = MockTuner(service_endpoint='https://example.com/EWS/Exchange.asmx', service_cls=MockService)
+        reported = []
+        tuner.report = lambda n_items, elapsed, concurrency: reported.append((n_items, concurrency))
+        # Two overlapping requests. Only the first one is measured.
+        with tuner.measure(n_items=25):
+            with tuner.measure(n_items=None):
+                time.sleep(0.1)
+        self.assertEqual(tuner._in_flight, 0)
+        self.assertEqual(len(reported), 1)
+        self.assertEqual(reported[0][0], 25)
+        self.assertGreater(reported[0][1], 1.5)
+        # Failed requests are not measured
+        with self.assertRaises(ValueError):
+            with tuner.measure(n_items=25):
+                raise ValueError()
+        self.assertEqual(tuner._in_flight, 0)
+        self.assertEqual(len(reported), 1)
+
+    def test_broken_storage(self):
+        storage_file = os.path.join(tempfile.mkdtemp(), 'chunksizes')
+        with open(storage_file, 'wb') as f:
+            f.write(b'garbage' * 100)
+        if not PY2:
+            # The dbm.dumb backend
+            with open(storage_file + '.dat', 'wb') as f:
+                f.write(b'garbage' * 100)
+            with open(storage_file + '.dir', 'w') as f:
+                f.write('garbage\n')
+
+        class MockTuner(ChunkSizeTuner):
+            _storage_file = storage_file
+
+        class MockService(object):
+            SERVICE_NAME = 'CreateItem'
+            CHUNKSIZE = 25
+
+        # The default chunk size is used, and saving doesn't fail
+        tuner = MockTuner(service_endpoint='https://example.com/EWS/Exchange.asmx', service_cls=MockService)
+        self.assertEqual(tuner.chunksize, 25)
+        tuner._save(35)
+
+
+class EndpointCacheTest(unittest.TestCase):
+    def test_cache(self):
+        storage_file = os.path.join(tempfile.mkdtemp(), 'endpoints')
+
+        class MockCache(EndpointCache):
+            _storage_file = storage_file
+
+        cache = MockCache()
+        endpoint = 'https://example.com/EWS/Exchange.asmx'
+        version = Version(build=Build(15, 0, 1178, 4), api_version='Exchange2013_SP1')
+        self.assertIsNone(cache.get(endpoint))
+        cache.set(service_endpoint=endpoint, auth_type=NTLM, docs_auth_type=NTLM, version=version)
+        auth_type, docs_auth_type, cached_version = cache.get(endpoint)
+        self.assertEqual((auth_type, docs_auth_type), (NTLM, NTLM))
+        self.assertEqual((cached_version.build, cached_version.api_version), (version.build, version.api_version))
+        self.assertIsNone(cache.get('https://example.org/EWS/Exchange.asmx'))
+
+        account_version = Version(build=Build(14, 3, 123, 4), api_version='Exchange2010_SP2')
+        cache.set_account_version(service_endpoint=endpoint, primary_smtp_address='foo@example.com',
+                                  version=account_version)
+        self.assertEqual(
+            cache.get_account_version(service_endpoint=endpoint, primary_smtp_address='FOO@example.com').api_version,
+            'Exchange2010_SP2'
+        )
+
+        # Entries expire
+        cache.TTL = -1
+        self.assertIsNone(cache.get(endpoint))
+        cache.TTL = EndpointCache.TTL
+
+        # Invalidation deletes account entries too
+        cache.delete(endpoint)
+        self.assertIsNone(cache.get(endpoint))
+        self.assertIsNone(cache.get_account_version(service_endpoint=endpoint, primary_smtp_address='foo@example.com'))
+
+    def test_broken_storage(self):
+        storage_file = os.path.join(tempfile.mkdtemp(), 'endpoints')
+        for suffix in ('', '.dat', '.dir'):
+            with open(storage_file + suffix, 'wb') as f:
+                f.write(b'garbage\n' * 100)
+
+        class MockCache(EndpointCache):
+            _storage_file = storage_file
+
+        # Storage errors are cache misses
+        cache = MockCache()
+        endpoint = 'https://example.com/EWS/Exchange.asmx'
+        version = Version(build=Build(15, 0, 1178, 4), api_version='Exchange2013_SP1')
+        cache.set(service_endpoint=endpoint, auth_type=NTLM, docs_auth_type=NTLM, version=version)
+        self.assertIsNone(cache.get(endpoint))
+        self.assertIsNone(cache.get_account_version(service_endpoint=endpoint, primary_smtp_address='foo@example.com'))
+        cache.delete(endpoint)
+
+    def test_storage_file(self):
+        # Each user has their own cache file
+        from exchangelib.protocol import ENDPOINT_PERSISTENT_STORAGE
+        self.assertEqual(os.path.dirname(ENDPOINT_PERSISTENT_STORAGE), tempfile.gettempdir())
+        self.assertIn('.%s.' % getpass.getuser(), os.path.basename(ENDPOINT_PERSISTENT_STORAGE))
+
+
+class ProtocolProbeTest(unittest.TestCase):
+    # Creates a Protocol for an unknown endpoint, against a mock server that needs basic auth
+    SERVICE_ENDPOINT = 'https://probe.example.com/EWS/Exchange.asmx'
+    TYPES_XSD = '<?xml version="1.0" encoding="utf-8"?><xs:schema xmlns:xs="http://www.w3.org/2001/XMLSchema" ' \
+                'version="Exchange2013_SP1"/>'
+    ENVELOPE = (
+        '<?xml version="1.0" encoding="utf-8"?><s:Envelope xmlns:s="%s"><s:Header>'
+        '<h:ServerVersionInfo xmlns:h="%s" MajorVersion="15" MinorVersion="0" MajorBuildNumber="1178" '
+        'MinorBuildNumber="4" Version="Exchange2013_SP1"/></s:Header><s:Body/></s:Envelope>' % (SOAPNS, TNS)
+    )
+
+    def setUp(self):
+        import exchangelib.protocol
+
+        class MockCache(EndpointCache):
+            _storage_file = os.path.join(tempfile.mkdtemp(), 'endpoints')
+
+        self.requests = []  # (thread ident, session, method, url, data) tuples
+        self.sessions = []
+        self.docs_status = 200
+        self.password = 'secret'
+        test = self
+
+        class MockResponse(object):
+            encoding = 'utf-8'
+            request = DummyRequest()
+
+            def __init__(self, status_code, content=b''):
+                self.status_code = status_code
+                self.reason = 'OK' if status_code == 200 else 'Error'
+                self.headers = {'www-authenticate': 'Basic realm="example.com"'} if status_code == 401 else {}
+                self.content = content
+                self.text = content.decode('utf-8')
+
+            def close(self):
+                pass
+
+        class MockSession(object):
+            def __init__(self, protocol=None):
+                self.session_id = len(test.sessions)
+                self.auth = None
+                self.closed = False
+                test.sessions.append(self)
+
+            def _respond(self, method, url, data, auth):
+                test.requests.append((threading.current_thread().ident, self, method, url, data))
+                if url.endswith('types.xsd') and test.docs_status != 200:
+                    return MockResponse(test.docs_status)
+                auth = auth or self.auth
+                if auth is None or auth.password != test.password:
+                    return MockResponse(401)
+                if url.endswith('types.xsd'):
+                    return MockResponse(200, test.TYPES_XSD.encode('utf-8'))
+                return MockResponse(200, test.ENVELOPE.encode('utf-8'))
+
+            def get(self, url, auth=None, **kwargs):
+                return self._respond('GET', url, None, auth)
+
+            def post(self, url, data=None, auth=None, **kwargs):
+                return self._respond('POST', url, data, auth)
+
+            def close_socket(self, url):
+                pass
+
+            def close(self):
+                self.closed = True
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *args):
+                self.close()
+
+        self._orig = exchangelib.protocol.new_session, exchangelib.protocol.endpoint_cache
+        exchangelib.protocol.new_session = MockSession
+        exchangelib.protocol.endpoint_cache = MockCache()
+
+    def tearDown(self):
+        import exchangelib.protocol
+        exchangelib.protocol.new_session, exchangelib.protocol.endpoint_cache = self._orig
+        exchangelib.protocol.CachingProtocol._protocol_cache.clear()
+
+    def create_protocol(self):
+        from exchangelib.protocol import Protocol
+        # Not a service account, so a 401 fails right away
+        credentials = Credentials('DOMAIN\\user', 'secret', is_service_account=False)
+        return Protocol(service_endpoint=self.SERVICE_ENDPOINT, credentials=credentials, auth_type=None,
+                        verify_ssl=True)
+
+    def test_probe(self):
+        protocol = self.create_protocol()
+        self.assertEqual((protocol.auth_type, protocol.docs_auth_type), (BASIC, BASIC))
+        self.assertEqual((protocol.version.build, protocol.version.api_version),
+                         (Build(15, 0, 1178, 4), 'Exchange2013_SP1'))
+        docs_requests = [r for r in self.requests if r[3].endswith('types.xsd')]
+        service_requests = [r for r in self.requests if r[3] == self.SERVICE_ENDPOINT]
+        # The docs are probed in another thread, on one session that is closed afterwards
+        self.assertEqual(len(docs_requests), 2)
+        self.assertNotEqual(docs_requests[0][0], threading.current_thread().ident)
+        self.assertEqual(len({r[1] for r in docs_requests}), 1)
+        self.assertTrue(docs_requests[0][1].closed)
+        # The service auth type probe and the version request share a session, which ends up in the session pool
+        self.assertEqual(len(service_requests), 2)
+        self.assertEqual({r[0] for r in service_requests}, {threading.current_thread().ident})
+        self.assertIs(service_requests[0][1], service_requests[1][1])
+        self.assertIs(protocol.get_session(), service_requests[0][1])
+        # The version from the docs is tried first
+        self.assertIn(b'Exchange2013_SP1', service_requests[1][4])
+
+    def test_probe_docs_error(self):
+        # Errors in the docs thread are raised in the thread creating the protocol
+        self.docs_status = 500
+        with self.assertRaises(TransportError):
+            self.create_protocol()
+        self.assertEqual(len([r for r in self.requests if r[3].endswith('types.xsd')]), 1)
+
+    def test_cached(self):
+        import exchangelib.protocol
+        self.create_protocol()
+        # A new process only needs one request, which also checks the credentials
+        exchangelib.protocol.CachingProtocol._protocol_cache.clear()
+        del self.requests[:]
+        protocol = self.create_protocol()
+        self.assertEqual((protocol.auth_type, protocol.docs_auth_type), (BASIC, BASIC))
+        self.assertEqual(protocol.version.api_version, 'Exchange2013_SP1')
+        self.assertEqual([(r[2], r[3]) for r in self.requests], [('POST', self.SERVICE_ENDPOINT)])
+        self.assertIn(b'Exchange2013_SP1', self.requests[0][4])
+
+        # Wrong credentials fail like they do without the cache, and invalidate the cache
+        exchangelib.protocol.CachingProtocol._protocol_cache.clear()
+        self.password = 'other'
+        with self.assertRaises(TransportError):
+            self.create_protocol()
+        self.assertIsNone(exchangelib.protocol.endpoint_cache.get(self.SERVICE_ENDPOINT))
+
+
+class ExecutorTest(unittest.TestCase):
+    def test_lazy_threads(self):
+        executor = SharedExecutor(max_workers=3)
+        executor.IDLE_TIMEOUT = 0.1
+        self.assertEqual(executor.num_threads, 0)
+        quota = ExecutorQuota(executor=executor, max_tasks=10)
+        results = [quota.apply_async(lambda i: i * 2, (i,)) for i in range(10)]
+        self.assertEqual([r.get(timeout=5) for r in results], [i * 2 for i in range(10)])
+        self.assertLessEqual(executor.num_threads, 3)
+        time.sleep(0.5)
+        self.assertEqual(executor.num_threads, 0)  # Idle threads have stopped
+
+    def test_quota(self):
+        executor = SharedExecutor(max_workers=10)
+        quota = ExecutorQuota(executor=executor, max_tasks=2)
+        lock = threading.Lock()
+        running = [0, 0]  # Current, max
+
+        def _task(i):
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            time.sleep(0.01)
+            with lock:
+                running[0] -= 1
+            if i == 3:
+                raise ValueError('foo')
+            return i
+
+        callback_results = []
+        results = [quota.apply_async(_task, (i,), callback=callback_results.append) for i in range(6)]
+        for i, r in enumerate(results):
+            if i == 3:
+                with self.assertRaises(ValueError):
+                    r.get(timeout=5)
+            else:
+                self.assertEqual(r.get(timeout=5), i)
+        self.assertEqual(running[1], 2)
+        self.assertEqual(sorted(callback_results), [0, 1, 2, 4, 5])
+
+    def test_nested_tasks(self):
+        # Tasks that wait for tasks of the same quota must not deadlock when they hold all slots
+        executor = SharedExecutor(max_workers=8)
+        quota = ExecutorQuota(executor=executor, max_tasks=2)
+        both_started = threading.Barrier(2) if hasattr(threading, 'Barrier') else None
+
+        def _outer(i):
+            if both_started is not None:
+                both_started.wait(5)
+            return quota.apply_async(lambda: i * 2).get(timeout=5)
+
+        results = [quota.apply_async(_outer, (i,)) for i in range(2)]
+        self.assertEqual([r.get(timeout=10) for r in results], [0, 2])
+        self.assertEqual(quota._running, 0)
+
+
+class PooledServiceTest(unittest.TestCase):
+    def test_streaming(self):
+        from multiprocessing.pool import ThreadPool
+        from exchangelib.protocol import Protocol
+        from exchangelib.services import EWSPooledMixIn
+
+        class MockService(EWSPooledMixIn):
+            CHUNKSIZE = 2
+            MAX_CHUNKS_IN_FLIGHT = 2
+
+            def _get_payload(self, items):
+                return items
+
+            def _get_elements(self, payload):
+                # Make later chunks finish first
+                time.sleep(0.01 * (10 - payload[0]))
+                return iter(payload)
+
+        consumed = []
+
+        def items():
+            for i in range(10):
+                consumed.append(i)
+                yield i
+
+        protocol = Protocol.__new__(Protocol)
+        protocol.pool_controller = SessionPoolController(initial=2, maximum=2)
+        protocol.thread_pool = ThreadPool(2)
+        try:
+            res = MockService(protocol=protocol).call(items=items())
+            self.assertEqual(consumed, [])  # Nothing happens until we start consuming
+            self.assertEqual(next(res), 0)
+            self.assertEqual(consumed, [0, 1, 2, 3])  # Only MAX_CHUNKS_IN_FLIGHT chunks were requested
+            self.assertEqual(list(res), list(range(1, 10)))
+        finally:
+            protocol.thread_pool.terminate()
+
+    def test_unordered(self):
+        from multiprocessing.pool import ThreadPool
+        from exchangelib.protocol import Protocol
+        from exchangelib.services import EWSPooledMixIn
+
+        from exchangelib.errors import TransportError
+
+        # Make later chunks finish first: a chunk waits until the results of the next chunk have been consumed
+        consumed = [threading.Event() for _ in range(6)]
+        consumed[5].set()
+
+        class MockService(EWSPooledMixIn):
+            CHUNKSIZE = 2
+
+            def _get_payload(self, items):
+                return items
+
+            def _get_elements(self, payload):
+                assert consumed[payload[0] // 2 + 1].wait(10)
+                return iter([i * 10 for i in payload])
+
+        protocol = Protocol.__new__(Protocol)
+        protocol.pool_controller = SessionPoolController(initial=5, maximum=5)
+        protocol.thread_pool = ThreadPool(5)
+        try:
+            res = []
+            for i, elem in MockService(protocol=protocol).call(items=range(10), ordered=False):
+                res.append((i, elem))
+                consumed[i // 2].set()
+            self.assertEqual(res, [(8, 80), (9, 90), (6, 60), (7, 70), (4, 40), (5, 50), (2, 20), (3, 30), (0, 0),
+                                   (1, 10)])
+
+            # We need exactly one element per input item to know which input item an element belongs to
+            class BrokenService(MockService):
+                def _get_elements(self, payload):
+                    return iter([42])
+
+            with self.assertRaises(TransportError):
+                list(BrokenService(protocol=protocol).call(items=range(10), ordered=False))
+        finally:
+            protocol.thread_pool.terminate()
+
+
+class ItemSerializationTest(unittest.TestCase):
+    def test_to_xml_plan(self):
+        # The compiled plan must follow register() and deregister()
+        class TestProp(ExtendedProperty):
+            property_id = 'deadbeaf-cafe-cafe-cafe-deadbeefcafe'
+            property_name = 'Test Property'
+            property_type = 'Integer'
+
+        version = Version(build=Build(15, 0, 1178, 4), api_version='Exchange2013_SP1')
+        plan = Message.to_xml_plan()
+        self.assertIs(Message.to_xml_plan(), plan)
+        self.assertEqual([f for f, _, _ in plan], Message.ordered_fieldnames())
+        Message.register(attr_name='dead_beef', attr_cls=TestProp)
+        try:
+            self.assertIn('dead_beef', [f for f, _, _ in Message.to_xml_plan()])
+            elem = Message(subject='Hello', body=HTMLBody('<b>World</b>'), dead_beef=42).to_xml(version=version)
+            children = {e.tag: e for e in elem}
+            self.assertEqual(children['t:Body'].get('BodyType'), 'HTML')
+            self.assertEqual(children['t:ExtendedProperty'][1].text, '42')
+        finally:
+            Message.deregister(attr_name='dead_beef')
+        self.assertNotIn('dead_beef', [f for f, _, _ in Message.to_xml_plan()])
+        self.assertNotIn('t:ExtendedProperty', [e.tag for e in Message(subject='Hello').to_xml(version=version)])
+        # Values that are assigned later and don't match the field type are serialized by their own type, like
+        # set_xml_value() does
+        item = Message()
+        item.subject, item.body = create_element('t:Foo'), Mailbox(email_address='foo@example.com')
+        elem = item.to_xml(version=version)
+        children = {e.tag: e for e in elem}
+        self.assertEqual([e.tag for e in children['t:Subject']], ['t:Foo'])
+        self.assertEqual([e.tag for e in children['t:Body']], ['t:Mailbox'])
+        self.assertEqual(children['t:Body'].get('BodyType'), 'Text')
+
+    def test_field_metadata(self):
+        class TestProp(ExtendedProperty):
+            property_id = 'deadbeaf-cafe-cafe-cafe-deadbeefcafe'
+            property_name = 'Test Property'
+            property_type = 'Integer'
+
+        self.assertIs(Message.fieldnames(), Message.fieldnames())
+        self.assertIs(Inbox._complex_field_names(), Inbox._complex_field_names())
+        self.assertIn('is_draft', Message.readonly_fields())
+        # Public methods return lists and sets that the caller may modify
+        self.assertIsInstance(Message.ordered_fieldnames(), list)
+        self.assertIsInstance(Message.readonly_fields(), set)
+        field_names = Inbox.allowed_field_names()
+        self.assertIsInstance(field_names, set)
+        field_names.add('foo')
+        self.assertNotIn('foo', Inbox.allowed_field_names())
+        fieldnames = Message.ordered_fieldnames()
+        fieldnames.append('foo')
+        self.assertNotIn('foo', Message.ordered_fieldnames())
+        # Registering a field must invalidate the metadata of the item class and of folders containing it
+        Message.register(attr_name='dead_beef', attr_cls=TestProp)
+        try:
+            self.assertIn('dead_beef', Message.fieldnames())
+            self.assertIn('dead_beef', Message.ordered_fieldnames())
+            self.assertIn('dead_beef', Inbox.allowed_field_names())
+            self.assertIn('dead_beef', Inbox.complex_field_names())
+        finally:
+            Message.deregister(attr_name='dead_beef')
+        self.assertNotIn('dead_beef', Message.fieldnames())
+        self.assertNotIn('dead_beef', Inbox.allowed_field_names())
+
+    def test_additional_properties_xml(self):
+        class TestProp(ExtendedProperty):
+            property_id = 'deadbeaf-cafe-cafe-cafe-deadbeefcafe'
+            property_name = 'Test Property'
+            property_type = 'Integer'
+
+        version = Version(build=Build(15, 0, 1178, 4), api_version='Exchange2013_SP1')
+        xml = Inbox.additional_properties_xml(['subject', 'is_read'], version=version)
+        self.assertEqual(
+            xml,
+            '<t:AdditionalProperties><t:FieldURI FieldURI="message:IsRead" /><t:FieldURI FieldURI="item:Subject" />'
+            '</t:AdditionalProperties>'
+        )
+        # Cached, regardless of the order of the fields
+        self.assertIs(Inbox.additional_properties_xml(('is_read', 'subject'), version=version), xml)
+        with self.assertRaises(ValueError):
+            Inbox.additional_properties_xml(['foo'], version=version)
+        Message.register(attr_name='dead_beef', attr_cls=TestProp)
+        try:
+            self.assertIn('Test Property', Inbox.additional_properties_xml(['subject', 'dead_beef'], version=version))
+        finally:
+            Message.deregister(attr_name='dead_beef')
+        with self.assertRaises(ValueError):
+            Inbox.additional_properties_xml(['subject', 'dead_beef'], version=version)
+
+    def test_from_xml(self):
+        elem = fromstring(
+            '<t:Message xmlns:t="%s"><t:ItemId Id="AAA" ChangeKey="BBB"/><t:Subject> Hello </t:Subject>'
+            '<t:UnknownField>foo</t:UnknownField><t:Body BodyType="HTML">World</t:Body><t:IsRead>true</t:IsRead>'
+            '<t:Categories><t:String>foo</t:String><t:String>bar</t:String></t:Categories>'
+            '<t:From><t:Mailbox><t:EmailAddress>foo@example.com</t:EmailAddress></t:Mailbox></t:From>'
+            '<t:ExtendedProperty><t:ExtendedFieldURI PropertySetId="c11ff724-aa03-4555-9952-8fa248a11c3e" '
+            'PropertyName="External ID" PropertyType="String"/><t:Value>123</t:Value></t:ExtendedProperty>'
+            '<t:DateTimeReceived>2017-01-02T03:04:05Z</t:DateTimeReceived></t:Message>' % TNS
+        )
+        item = Message.from_xml(elem=elem)
+        self.assertEqual((item.item_id, item.changekey), ('AAA', 'BBB'))
+        self.assertEqual(item.subject, 'Hello')
+        self.assertIsInstance(item.body, HTMLBody)
+        self.assertEqual(item.body, 'World')
+        self.assertEqual(item.is_read, True)
+        self.assertEqual(item.categories, ['foo', 'bar'])
+        self.assertEqual(getattr(item, 'from'), Mailbox(email_address='foo@example.com'))
+        self.assertEqual(item.extern_id, '123')
+        self.assertEqual(item.datetime_received, UTC.localize(EWSDateTime(2017, 1, 2, 3, 4, 5)))
+        # Missing fields get their default value
+        self.assertEqual(item.is_read_receipt_requested, False)
+        self.assertIsNone(item.to_recipients)
+
+    def test_lazy_from_xml(self):
+        xml = (
+            '<t:Message xmlns:t="%s"><t:ItemId Id="AAA" ChangeKey="BBB"/><t:Subject>Hello</t:Subject>'
+            '<t:Body BodyType="HTML">World</t:Body><t:IsRead>true</t:IsRead>'
+            '<t:ExtendedProperty><t:ExtendedFieldURI PropertySetId="c11ff724-aa03-4555-9952-8fa248a11c3e" '
+            'PropertyName="External ID" PropertyType="String"/><t:Value>123</t:Value></t:ExtendedProperty>'
+            '<t:Attachments><t:FileAttachment><t:AttachmentId Id="CCC"/><t:Name>foo.txt</t:Name></t:FileAttachment>'
+            '</t:Attachments></t:Message>' % TNS
+        )
+        item = Message.from_xml(elem=fromstring(xml), lazy=True)
+        self.assertEqual((item.item_id, item.changekey), ('AAA', 'BBB'))
+        # Nothing is decoded before it is accessed
+        with self.assertRaises(AttributeError):
+            object.__getattribute__(item, 'subject')
+        self.assertEqual(item.subject, 'Hello')
+        self.assertEqual(object.__getattribute__(item, 'subject'), 'Hello')
+        self.assertEqual(item.is_read_receipt_requested, False)
+        self.assertEqual(item.attachments[0].parent_item, item)
+        # Values we set are not overwritten when the remaining fields are decoded
+        item.is_read = False
+        item._hydrate()
+        self.assertIsNone(item._lazy)
+        self.assertEqual(item.is_read, False)
+        self.assertEqual(repr(item), repr(Message.from_xml(elem=fromstring(xml.replace('true', 'false')))))
+        with self.assertRaises(AttributeError):
+            item.foo
+        # Classes that adjust fields in __init__() decode everything up-front
+        task = Task.from_xml(elem=fromstring('<t:Task xmlns:t="%s"><t:Subject>Hello</t:Subject></t:Task>' % TNS),
+                             lazy=True)
+        self.assertIsNone(task._lazy)
+
+    def test_lazy_validation(self):
+        # Lazy items validate fields when they are decoded, like __init__() does for eager items
+        xml = '<t:CalendarItem xmlns:t="%s"><t:LegacyFreeBusyStatus>XXX</t:LegacyFreeBusyStatus></t:CalendarItem>' % TNS
+        with self.assertRaises(AssertionError):
+            CalendarItem.from_xml(elem=fromstring(xml))
+        item = CalendarItem.from_xml(elem=fromstring(xml), lazy=True)
+        with self.assertRaises(AssertionError):
+            item.legacy_free_busy_status
+        item = CalendarItem.from_xml(elem=fromstring(xml.replace('XXX', 'Free')), lazy=True)
+        self.assertEqual(item.legacy_free_busy_status, 'Free')
+        with self.assertRaises(ValueError):
+            CalendarItem(start=EWSDateTime(2017, 1, 2, 3, 4, 5))
+
+
+class StreamingTest(unittest.TestCase):
+    # Canned SOAP responses, served by a mock session
+    ENVELOPE = (
+        '\ufeff<?xml version="1.0" encoding="utf-8"?><s:Envelope xmlns:s="%s" xmlns:m="%s" xmlns:t="%s"><s:Header>'
+        '<h:ServerVersionInfo xmlns:h="%s" MajorVersion="15" MinorVersion="0" MajorBuildNumber="1178" '
+        'MinorBuildNumber="4" Version="V2_23"/></s:Header><s:Body>%%s</s:Body></s:Envelope>' % (SOAPNS, MNS, TNS, TNS)
+    )
+    GET_ITEM = '<m:GetItemResponse><m:ResponseMessages>%s%s</m:ResponseMessages></m:GetItemResponse>' % (
+        ''.join(
+            '<m:GetItemResponseMessage ResponseClass="Success"><m:ResponseCode>NoError</m:ResponseCode><m:Items>'
+            '<t:Message><t:ItemId Id="%s" ChangeKey="BBB"/><t:Subject>Hello %s</t:Subject></t:Message>'
+            '</m:Items></m:GetItemResponseMessage>' % (i, i) for i in range(3)
+        ),
+        '<m:GetItemResponseMessage ResponseClass="Error"><m:MessageText>Not found</m:MessageText>'
+        '<m:ResponseCode>ErrorItemNotFound</m:ResponseCode></m:GetItemResponseMessage>',
+    )
+    FIND_ITEM = (
+        '<m:FindItemResponse><m:ResponseMessages><m:FindItemResponseMessage ResponseClass="Success">'
+        '<m:ResponseCode>NoError</m:ResponseCode><m:RootFolder TotalItemsInView="3" IncludesLastItemInRange="true">'
+        '<t:Items>%s</t:Items></m:RootFolder></m:FindItemResponseMessage></m:ResponseMessages></m:FindItemResponse>'
+        % ''.join('<t:Message><t:ItemId Id="%s" ChangeKey="BBB"/></t:Message>' % i for i in range(3))
+    )
+
+    def setUp(self):
+        self.shutdown_process_pool()
+
+    def tearDown(self):
+        self.shutdown_process_pool()
+
+    @staticmethod
+    def shutdown_process_pool():
+        # Tests must not share the worker processes, so test_decode_in_process() starts a pool with its own PROCESSES
+        with SharedProcessPool._instance_lock:
+            if SharedProcessPool._instance is not None:
+                SharedProcessPool._instance._pool.terminate()
+                SharedProcessPool._instance._pool.join()
+                SharedProcessPool._instance = None
+
+    def get_protocol(self, responses):
+        class MockResponse(object):
+            status_code = 200
+            headers = {}
+            encoding = 'utf-8'
+            request = DummyRequest()
+
+            def __init__(self, content):
+                self.content = content
+                self.closed = False
+                self.text_read = False
+                self.bytes_read = 0
+
+            @property
+            def text(self):
+                self.text_read = True
+                return self.content.decode('utf-8')
+
+            def iter_content(self, chunk_size=1, decode_unicode=False):
+                for i in range(0, len(self.content), 100):
+                    self.bytes_read = min(i + 100, len(self.content))
+                    yield self.content[i:i + 100]
+
+            def close(self):
+                self.closed = True
+
+        class MockSession(object):
+            session_id = 1
+            auth = None
+
+            def post(self, **kwargs):
+                r = MockResponse(content=(self.ENVELOPE % responses.pop(0)).encode('utf-8'))
+                protocol.requests.append((kwargs['stream'], r))
+                return r
+
+        class MockProtocol(object):
+            service_endpoint = 'https://example.com/EWS/Exchange.asmx'
+            TIMEOUT = 10
+            verify_ssl = True
+            version = Version(build=Build(15, 0, 1178, 4), api_version='Exchange2013_SP1')
+            pool_controller = SessionPoolController(initial=1, minimum=1, maximum=1)
+
+            def __init__(self):
+                self.requests = []
+                self.sessions = 0
+                self.max_sessions = 0
+
+            def get_session(self):
+                self.sessions += 1
+                self.max_sessions = max(self.max_sessions, self.sessions)
+                return MockSession()
+
+            def release_session(self, session):
+                self.sessions -= 1
+
+        MockSession.ENVELOPE = self.ENVELOPE
+        protocol = MockProtocol()
+        return protocol
+
+    def get_account(self, protocol):
+        class MockAccount(object):
+            access_type = DELEGATE
+            version = protocol.version
+
+        account = MockAccount()
+        account.protocol = protocol
+        return account
+
+    def test_element_stream(self):
+        stream = ElementStream(iter([b'<a><b x="1"><c>', b'foo</c></b><b x="2"/><d/>', b'</a>']))
+        root = stream.root()
+        b = stream.next_child(root)
+        # Attributes are available as soon as an element starts
+        self.assertEqual((b.tag, b.get('x')), ('b', '1'))
+        self.assertEqual(stream.finish(b)[0].text, 'foo')
+        self.assertEqual(stream.find_child(root, 'd').tag, 'd')
+        self.assertIsNone(stream.next_child(root))
+        self.assertEqual([e.get('x') for e in root if e.tag == 'b'], ['1', '2'])
+        # iter_children() removes children from the tree when the next child is requested
+        stream = ElementStream(iter([b'<a><b x="1"/>', b'<b x="2"/>', b'<b x="3"/></a>']))
+        root = stream.root()
+        self.assertEqual([(e.get('x'), root[0].get('x')) for e in stream.iter_children(root)],
+                         [('1', '1'), ('2', '2'), ('3', '3')])
+        self.assertEqual(len(root), 0)
+
+    def test_get_item(self):
+        protocol = self.get_protocol([self.GET_ITEM, self.GET_ITEM])
+        service = GetItem(account=self.get_account(protocol))
+        service.ERRORS_TO_CATCH_IN_RESPONSE = ErrorItemNotFound
+        self.assertTrue(service.STREAM_RESPONSES)
+        elements = service._get_elements(payload=b'<m:GetItem/>')
+        self.assertEqual(protocol.sessions, 0)  # Nothing happens before the first element is requested
+        first = next(elements)
+        self.assertEqual(first[0].get('Id'), '0')
+        self.assertEqual(protocol.sessions, 1)  # The session is held while the response is being consumed
+        # The first element is handed out before the whole response has been downloaded
+        stream, r = protocol.requests[0]
+        self.assertLess(r.bytes_read, len(r.content))
+        streamed = [first] + list(elements)
+        self.assertEqual(protocol.sessions, 0)
+        self.assertTrue(stream)
+        self.assertTrue(r.closed)
+        # The result is the same as when the whole response is parsed up-front
+        service.STREAM_RESPONSES = False
+        buffered = list(service._get_elements(payload=b'<m:GetItem/>'))
+        self.assertFalse(protocol.requests[1][0])
+        # The response is parsed from bytes, without decoding it to text first
+        self.assertFalse(any(r.text_read for _, r in protocol.requests))
+        def contents(elements):
+            return [e if isinstance(e, tuple) else [(c.tag, dict(c.attrib), c.text) for c in e.iter()]
+                    for e in elements]
+
+        self.assertEqual(contents(streamed), contents(buffered))
+        self.assertEqual(streamed[-1], (False, 'Not found'))
+
+    def test_decode_in_process(self):
+        class TestProp(ExtendedProperty):
+            property_id = 'deadbeaf-cafe-cafe-cafe-deadbeefcafe'
+            property_name = 'Test Property'
+            property_type = 'Integer'
+
+        protocol = self.get_protocol([self.GET_ITEM, self.GET_ITEM])
+        service = GetItem(account=self.get_account(protocol))
+        # Make sure nothing is decoded in this process. The worker process creates its own service.
+        service._parse_and_decode = None
+        old_processes, SharedProcessPool.PROCESSES = SharedProcessPool.PROCESSES, 2
+        try:
+            items = []
+            with self.assertRaises(ErrorItemNotFound):
+                for item in service._get_elements(payload=b'<m:GetItem/>', decoder=ItemDecoder(Folder)):
+                    items.append(item)
+            self.assertEqual(SharedProcessPool.get_instance().processes, 2)
+        finally:
+            SharedProcessPool.PROCESSES = old_processes
+        self.assertEqual([(i.__class__, i.item_id, i.subject) for i in items],
+                         [(Message, '%s' % i, 'Hello %s' % i) for i in range(3)])
+        self.assertEqual(protocol.sessions, 0)
+        self.assertFalse(protocol.requests[0][0])
+        # The worker processes don't know fields that are registered after they started. Then we decode here.
+        del service._parse_and_decode
+        Message.register(attr_name='dead_beef', attr_cls=TestProp)
+        try:
+            decoder = ItemDecoder(Folder)
+            self.assertTrue(decoder.check())
+            with self.assertRaises(ErrorItemNotFound):
+                for item in service._get_elements(payload=b'<m:GetItem/>', decoder=decoder):
+                    self.assertIsNone(item.dead_beef)
+        finally:
+            Message.deregister(attr_name='dead_beef')
+        self.assertFalse(decoder.check())
+
+    def test_invalid_xml(self):
+        # A response that is not valid XML is requested again and parsed by the more forgiving parser. Elements that
+        # were already yielded are not yielded again.
+        invalid = self.GET_ITEM.replace('Hello 2', 'Hello \x01')
+        protocol = self.get_protocol([invalid, invalid])
+        service = GetItem(account=self.get_account(protocol))
+        service.ERRORS_TO_CATCH_IN_RESPONSE = ErrorItemNotFound
+        elements = list(service._get_elements(payload=b'<m:GetItem/>'))
+        self.assertEqual([e[0].get('Id') if not isinstance(e, tuple) else e for e in elements],
+                         ['0', '1', '2', (False, 'Not found')])
+        self.assertEqual([stream for stream, _ in protocol.requests], [True, False])
+        self.assertTrue(protocol.requests[0][1].closed)
+        self.assertEqual(protocol.sessions, 0)
+        # The streamed response was closed before it was requested again, so we only needed one session at a time
+        self.assertEqual(protocol.max_sessions, 1)
+
+    def test_find_item(self):
+        protocol = self.get_protocol([self.FIND_ITEM])
+        account = self.get_account(protocol)
+        folder = Inbox(account=account, folder_id='XXX', changekey='YYY')
+        items = list(FindItem(folder=folder).call(additional_fields=None, restriction=None, shape='IdOnly',
+                                                  depth='Shallow', calendar_view=None))
+        self.assertEqual([Item.id_from_xml(e) for e in items], [('0', 'BBB'), ('1', 'BBB'), ('2', 'BBB')])
+        self.assertEqual(protocol.sessions, 0)
+
+    def test_closed_stream(self):
+        # The session is released when the consumer stops early
+        protocol = self.get_protocol([self.GET_ITEM])
+        elements = GetItem(account=self.get_account(protocol))._get_elements(payload=b'<m:GetItem/>')
+        next(elements)
+        self.assertEqual(protocol.sessions, 1)
+        elements.close()
+        self.assertEqual(protocol.sessions, 0)
+        self.assertTrue(protocol.requests[0][1].closed)
+
+    def test_queryset_fetch(self):
+        # GetItem may need the session that FindItem holds while its response is consumed, so QuerySet gets all ids
+        # before it fetches the items.
+        protocol = self.get_protocol([self.FIND_ITEM])
+        account = self.get_account(protocol)
+        sessions = []
+
+        def fetch(ids, folder, only_fields, lazy):
+            items = []
+            for item_id, changekey in ids:
+                # GetItem sends its requests while it consumes the ids
+                sessions.append(protocol.sessions)
+                items.append(Message(item_id=item_id, changekey=changekey))
+            return items
+
+        account.fetch = fetch
+        folder = Inbox(account=account, folder_id='XXX', changekey='YYY')
+        items = list(QuerySet(folder).only('subject', 'body').filter(subject='Hello'))
+        self.assertEqual([i.item_id for i in items], ['0', '1', '2'])
+        self.assertEqual(sessions, [0, 0, 0])
+
+
+class SessionTest(unittest.TestCase):
+    # Sends requests with each HTTP backend to a local server that checks credentials
+    USERNAME = 'DOMAIN\\user'
+    PASSWORD = 'secret'
+    REALM = 'exchange'
+    NONCE = 'f0c9d6f3d4a0e3e1'
+
+    def setUp(self):
+        test = self
+        self.requests = []  # (connection, path, Authorization header) of all requests
+        self.cookies = []  # Cookie header of all requests
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                self.do_POST()
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                auth = self.headers.get('Authorization')
+                test.requests.append((self.connection, self.path, auth, self.headers.get('Content-Type')))
+                test.cookies.append(self.headers.get('Cookie'))
+                if self.path == '/cookie':
+                    return self.reply(200, b'<Hello/>', headers=[('Set-Cookie', 'X-BackEndCookie=abc; path=/')])
+                if self.path == '/redirect':
+                    return self.reply(302, headers=[('Location', '/basic')])
+                if self.path == '/negotiate':
+                    return self.reply(401, headers=[('WWW-Authenticate', 'Negotiate'), ('WWW-Authenticate', 'NTLM')])
+                kind = self.path[1:]
+                if getattr(self, 'authenticated', False) or getattr(test, 'check_%s' % kind)(self, auth):
+                    return self.reply(200, b'<Hello/>', headers=[('Content-Type', 'text/xml; charset=utf-8')])
+                self.reply(401, headers=[('WWW-Authenticate', getattr(test, 'challenge_%s' % kind)(self, auth))])
+
+            def reply(self, status, body=b'', headers=()):
+                self.send_response(status)
+                for k, v in headers:
+                    self.send_header(k, v)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        class Server(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%s' % self.server.server_port
+        t = threading.Thread(target=self.server.serve_forever, kwargs=dict(poll_interval=0.05))
+        t.daemon = True
+        t.start()
+        self.old_backend = get_http_backend()
+
+    def tearDown(self):
+        set_http_backend(self.old_backend)
+        self.server.shutdown()
+        self.server.server_close()
+
+    def check_basic(self, handler, auth):
+        expected = base64.b64encode(('%s:%s' % (self.USERNAME, self.PASSWORD)).encode('latin1')).decode('ascii')
+        return auth == 'Basic %s' % expected
+
+    def challenge_basic(self, handler, auth):
+        return 'Basic realm="%s"' % self.REALM
+
+    def check_digest(self, handler, auth):
+        if not auth or not auth.startswith('Digest '):
+            return False
+        d = requests.utils.parse_dict_header(auth[7:])
+
+        def md5(s):
+            return hashlib.md5(s.encode('utf-8')).hexdigest()
+
+        ha1 = md5('%s:%s:%s' % (self.USERNAME, self.REALM, self.PASSWORD))
+        ha2 = md5('%s:%s' % (handler.command, d['uri']))
+        return d['nonce'] == self.NONCE and d['response'] == md5(
+            '%s:%s:%s:%s:%s:%s' % (ha1, d['nonce'], d['nc'], d['cnonce'], d['qop'], ha2))
+
+    def challenge_digest(self, handler, auth):
+        return 'Digest realm="%s", nonce="%s", qop="auth", algorithm=MD5' % (self.REALM, self.NONCE)
+
+    def check_ntlm(self, handler, auth):
+        # The NTLM handshake authenticates the connection. spnego checks the credentials in NTLM_USER_FILE.
+        if not auth or not auth.startswith('NTLM '):
+            return False
+        import spnego
+        token = base64.b64decode(auth[5:])
+        if token[8:12] == b'\x01\x00\x00\x00':
+            handler.ntlm_context = spnego.server(protocol='ntlm')
+        try:
+            handler.ntlm_token = handler.ntlm_context.step(token)
+        except spnego.exceptions.SpnegoError:
+            return False
+        handler.authenticated = handler.ntlm_context.complete
+        return handler.authenticated
+
+    def challenge_ntlm(self, handler, auth):
+        token = getattr(handler, 'ntlm_token', None)
+        handler.ntlm_token = None
+        return 'NTLM %s' % base64.b64encode(token).decode('ascii') if token else 'NTLM'
+
+    def test_basic_and_digest_auth(self):
+        for backend in HTTP_BACKENDS:
+            set_http_backend(backend)
+            for kind, auth_type in (('basic', BASIC), ('digest', DIGEST)):
+                with new_session() as s:
+                    auth = get_auth_instance(Credentials(self.USERNAME, self.PASSWORD), auth_type)
+                    for _ in range(2):
+                        r = s.post(url=self.url + '/' + kind, data=b'<Hello/>', auth=auth, allow_redirects=False)
+                        self.assertEqual((r.status_code, r.content, r.text), (200, b'<Hello/>', '<Hello/>'), backend)
+                    auth = get_auth_instance(Credentials(self.USERNAME, 'wrong'), auth_type)
+                    r = s.post(url=self.url + '/' + kind, data=b'<Hello/>', auth=auth, allow_redirects=False)
+                    self.assertEqual(r.status_code, 401, backend)
+            # Digest auth reuses the nonce, so only the first request with an auth object gets a 401
+            self.assertEqual([a is None for _, p, a, _ in self.requests if p == '/digest'],
+                             [True, False, False, True, False], backend)
+            del self.requests[:]
+
+    @unittest.skipIf(PY2, 'spnego is not available on Python 2')
+    def test_ntlm_auth(self):
+        with tempfile.NamedTemporaryFile('w', delete=False) as f:
+            f.write('DOMAIN:user:%s\n' % self.PASSWORD)
+        os.environ['NTLM_USER_FILE'] = f.name
+        try:
+            for backend in HTTP_BACKENDS:
+                set_http_backend(backend)
+                with new_session() as s:
+                    s.auth = get_auth_instance(Credentials(self.USERNAME, self.PASSWORD), NTLM)
+                    for _ in range(3):
+                        r = s.post(url=self.url + '/ntlm', data=b'<Hello/>', allow_redirects=False)
+                        self.assertEqual((r.status_code, r.content), (200, b'<Hello/>'), backend)
+                # The handshake and all following requests used the same connection
+                self.assertEqual(len(set(c for c, _, _, _ in self.requests)), 1, backend)
+                if backend == 'urllib3':
+                    # We don't wait for a 401 before sending the NEGOTIATE message
+                    self.assertEqual([a is None for _, _, a, _ in self.requests], [False, False, True, True])
+                del self.requests[:]
+                with new_session() as s:
+                    s.auth = get_auth_instance(Credentials(self.USERNAME, 'wrong'), NTLM)
+                    self.assertEqual(s.post(url=self.url + '/ntlm', data=b'<Hello/>').status_code, 401, backend)
+                del self.requests[:]
+            # requests_ntlm before 1.2 keeps the domain in a separate attribute
+            set_http_backend('urllib3')
+            with new_session() as s:
+                s.auth = get_auth_instance(Credentials(self.USERNAME, self.PASSWORD), NTLM)
+                s.auth.domain, s.auth.username = self.USERNAME.split('\\')
+                self.assertEqual(s.post(url=self.url + '/ntlm', data=b'<Hello/>').status_code, 200)
+        finally:
+            del os.environ['NTLM_USER_FILE']
+            os.unlink(f.name)
+
+    def test_cookies(self):
+        # Cookies set by the server, e.g. X-BackEndCookie, are sent with the following requests of the session
+        for backend in HTTP_BACKENDS:
+            set_http_backend(backend)
+            with new_session() as s:
+                for _ in range(2):
+                    self.assertEqual(s.post(url=self.url + '/cookie', data=b'<Hello/>').status_code, 200, backend)
+            self.assertEqual(self.cookies, [None, 'X-BackEndCookie=abc'], backend)
+            del self.cookies[:]
+
+    def test_protocol_session(self):
+        for backend in HTTP_BACKENDS:
+            set_http_backend(backend)
+            protocol = BaseProtocol(service_endpoint=self.url + '/basic', auth_type=BASIC, verify_ssl=True,
+                                    credentials=Credentials(self.USERNAME, self.PASSWORD))
+            session = protocol.create_session()
+            r, session = post_ratelimited(protocol=protocol, session=session, url=protocol.service_endpoint,
+                                          headers=None, data=b'<Hello/>', timeout=10, stream=True)
+            self.assertEqual(b''.join(r.iter_content(chunk_size=3)), b'<Hello/>', backend)
+            r.close()
+            self.assertEqual(self.requests[-1][3], 'text/xml; charset=utf-8')
+            # Redirects are followed only when asked to
+            r = session.post(url=self.url + '/redirect', data=b'<Hello/>', allow_redirects=False)
+            self.assertEqual(r.status_code, 302, backend)
+            r = session.get(url=self.url + '/redirect')
+            self.assertEqual((r.status_code, len(r.history)), (200, 1), backend)
+            session.close_socket(protocol.service_endpoint)
+            # The session can still be used, on a new connection
+            self.assertEqual(session.post(url=protocol.service_endpoint, data=b'<Hello/>').status_code, 200, backend)
+            self.assertIsNot(self.requests[-1][0], self.requests[-2][0])
+            session.close_socket(protocol.service_endpoint)
+
+    def test_get_service_authtype(self):
+        # Multiple WWW-Authenticate headers are combined
+        for backend in HTTP_BACKENDS:
+            set_http_backend(backend)
+            self.assertEqual(get_service_authtype(service_endpoint=self.url + '/negotiate', versions=['Exchange2010'],
+                                                  verify=True), NTLM, backend)
+
+    def test_connection_error(self):
+        s = socket.socket()
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+        s.close()
+        for backend in HTTP_BACKENDS:
+            set_http_backend(backend)
+            with new_session() as session:
+                with self.assertRaises(requests.exceptions.ConnectionError):
+                    session.post(url='http://127.0.0.1:%s/' % port, data=b'<Hello/>', timeout=5)
+
+
+@unittest.skipIf(PY2, 'asyncio is not available on Python 2')
+class AsyncTest(unittest.TestCase):
+    def test_call(self):
+        from exchangelib.aio import AsyncProtocol
+        from exchangelib.protocol import Protocol
+        from exchangelib.services import EWSPooledMixIn
+
+        class MockService(EWSPooledMixIn):
+            CHUNKSIZE = 2
+
+            def _get_payload(self, items, factor):
+                return [i * factor for i in items]
+
+            def _get_elements(self, payload):
+                return iter(payload)
+
+        protocol = Protocol.__new__(Protocol)
+        protocol.pool_controller = SessionPoolController(initial=4, maximum=4)
+        protocol.thread_pool = ExecutorQuota(executor=SharedExecutor.get_instance(), max_tasks=4)
+        async_protocol = AsyncProtocol.from_protocol(protocol)
+        self.assertIs(AsyncProtocol.from_protocol(protocol), async_protocol)
+        # Each event loop gets its own semaphore, so consecutive loops can use the same AsyncProtocol
+        for _ in range(2):
+            loop = asyncio.new_event_loop()
+            try:
+                res = loop.run_until_complete(async_protocol.call(MockService(protocol=protocol), items=range(7),
+                                                                  factor=3))
+            finally:
+                loop.close()
+            self.assertEqual(res, [0, 3, 6, 9, 12, 15, 18])
+        # The shared instance doesn't keep the protocol alive. Worker threads drop their last task right after they
+        # resolved the future, so give them a moment.
+        del protocol
+        for _ in range(100):
+            gc.collect()
+            if async_protocol.protocol is None:
+                break
+            time.sleep(0.01)
+        self.assertIsNone(async_protocol.protocol)
+        self.assertEqual(len([p for p in AsyncProtocol._instances if isinstance(p, Protocol)]), 0)
+
+    def test_queryset(self):
+        qs = QuerySet(folder=None)
+        qs._cache = [1, 2, 3]
+        loop = asyncio.new_event_loop()
+        res = []
+        try:
+            it = qs.__aiter__()
+            while True:
+                try:
+                    res.append(loop.run_until_complete(it.__anext__()))
+                except StopAsyncIteration:
+                    break
+        finally:
+            loop.close()
+        self.assertEqual(res, [1, 2, 3])
 
 
 class EWSTest(unittest.TestCase):